@@ -0,0 +1,637 @@
+"""
+Benchmark cho chat server, chạy hoàn toàn trên một máy Linux.
+
+    python bench.py connections --mode thread --sizes 1000,5000,10000
+    python bench.py connections --mode asyncio --sizes 1000,5000,10000
+    python bench.py protocol --image-sizes 100000,1000000,5000000
+    python bench.py fanout --room-sizes 10,100,1000,10000
+    python bench.py cluster --workers 1,2,4 --bots 400 --rooms 40
+    python bench.py history --messages 2000000 --rooms 100
+    python bench.py auth --bots 500 --kdf-workers 4
+    python bench.py users --existing 100000 --registrations 2000
+
+Mỗi kích thước N: bật server headless trong thư mục tạm, mở N kết nối
+(đăng nhập bằng tài khoản bot đã seed sẵn), trong đó --active bot vào
+phòng riêng và gửi tin để đo độ trễ khứ hồi. Kết quả in ra: thời gian
+kết nối hết N client, RSS và số thread của server, p50/p95/p99 độ trễ.
+
+protocol: so sánh ndjson và frame1 cho một gói ảnh đi hết đường
+client -> server -> client (encode, decode, encode lại, decode): số byte
+trên dây và CPU mỗi ảnh.
+
+fanout: CPU cho một broadcast trong phòng N thành viên (nửa ndjson, nửa
+frame1, connection giả không ghi socket), so với cách cũ encode lại cho
+từng người nhận; và user_list khi danh sách không đổi (dùng bản cache).
+
+cluster: throughput tin nhắn theo số worker process (--workers). Bot chia
+vào --rooms phòng (thành viên một phòng rơi vào nhiều worker khác nhau),
+mỗi bot gửi tin rồi chờ nhận lại tin của mình mới gửi tin tiếp; bot chạy
+trong --clients process để phía client không thành nút thắt. Kết quả: số
+tin gửi / giây và số lượt giao tin / giây. Chỉ tăng theo worker khi máy
+có đủ core cho cả server lẫn client.
+
+history: ghi --messages tin vào SQLiteHistory (--rooms phòng), rồi đo thời
+gian một trang get_history (tin mới nhất và trang trước một id ngẫu nhiên,
+tức cuộn ngược sâu) khi DB đã có hàng triệu tin.
+
+auth: login storm (--bots bot cùng đăng nhập lại, --concurrency kết nối mở
+song song) ba lượt trên cùng server: mật khẩu với mã băm sha256 kiểu cũ
+(lần này server băm lại bằng scrypt), mật khẩu với scrypt, rồi session
+token. Kết quả: số đăng nhập / giây và p50/p99 thời gian tới auth_ok.
+
+users: tốc độ đăng ký khi đã có --existing tài khoản (chỉ phần lưu tài
+khoản, không tính băm mật khẩu): UserStore (SQLite, một dòng mỗi lần đăng
+ký) so với cách cũ viết lại cả users.json; kèm thời gian chuyển users.json
+sang DB.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from chat_server import ChatServer
+from history_store import SQLiteHistory
+from passwords import hash_password, legacy_hash
+from user_store import UserStore
+from protocol import NDJSON, FRAMED, encode_packet, make_decoder
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BOT_PASSWORD = "benchpw123"
+
+
+# ===================== SERVER PROCESS =====================
+def raise_nofile():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def seed_users(workdir, names, legacy=False):
+    # một mã băm scrypt cho mọi bot (cùng salt) để seed nhanh
+    pw = legacy_hash(BOT_PASSWORD) if legacy else hash_password(BOT_PASSWORD)
+    db = {n: {"password": pw, "avatar": None} for n in names}
+    with open(os.path.join(workdir, "users.json"), "w", encoding="utf-8") as f:
+        json.dump(db, f)
+
+
+def spawn_server(workdir, port, extra_args=()):
+    cmd = [sys.executable, os.path.join(HERE, "chat_server.py"), "--headless",
+           "--host", "127.0.0.1", "--port", str(port), *extra_args]
+    proc = subprocess.Popen(cmd, cwd=workdir,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("server không khởi động được")
+
+
+def proc_stats(pid):
+    """(RSS kB, số thread) đọc từ /proc."""
+    rss, threads = 0, 0
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1])
+                elif line.startswith("Threads:"):
+                    threads = int(line.split()[1])
+    except OSError:
+        pass
+    return rss, threads
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+# ===================== BOT =====================
+async def open_bot(port, username):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port, limit=2 ** 24)
+    auth = {"type": "auth", "action": "login",
+            "username": username, "password": BOT_PASSWORD}
+    writer.write((json.dumps(auth) + "\n").encode("utf-8"))
+    line = await reader.readline()
+    if json.loads(line).get("type") != "auth_ok":
+        raise RuntimeError(f"auth thất bại: {username}")
+    return reader, writer
+
+
+async def login_bot(port, username, password=None, token=None):
+    """(reader, writer, gói trả lời auth) - không raise khi auth bị từ chối."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port, limit=2 ** 24)
+    auth = {"type": "auth", "action": "login", "username": username}
+    if password:
+        auth["password"] = password
+    if token:
+        auth["token"] = token
+    writer.write((json.dumps(auth) + "\n").encode("utf-8"))
+    line = await reader.readline()
+    return reader, writer, json.loads(line) if line else {}
+
+
+async def login_storm(port, names, concurrency, tokens=None):
+    """Mọi bot cùng đăng nhập; trả về (giây, độ trễ, token mới theo tên, số lỗi)."""
+    sem = asyncio.Semaphore(concurrency)
+    latencies, issued, writers = [], {}, []
+    failed = 0
+
+    async def one(name):
+        nonlocal failed
+        async with sem:
+            t0 = time.perf_counter()
+            token = tokens.get(name) if tokens else None
+            try:
+                reader, writer, reply = await login_bot(
+                    port, name, None if token else BOT_PASSWORD, token)
+            except OSError:
+                failed += 1
+                return
+            writers.append(writer)
+            if reply.get("type") != "auth_ok":
+                failed += 1
+                return
+            latencies.append(time.perf_counter() - t0)
+            issued[name] = reply.get("token")
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(n) for n in names))
+    elapsed = time.perf_counter() - t0
+    for w in writers:
+        w.close()
+    return elapsed, latencies, issued, failed
+
+
+async def drain(reader):
+    try:
+        while await reader.read(65536):
+            pass
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+
+
+async def wait_packet(reader, pred):
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("mất kết nối")
+        data = json.loads(line)
+        if pred(data):
+            return data
+
+
+async def active_bot(reader, writer, username, messages, latencies):
+    room = f"bench-{username}"
+    writer.write((json.dumps({"type": "join_room", "room": room}) + "\n").encode())
+    await wait_packet(reader, lambda d: d.get("type") == "room_joined")
+    for i in range(messages):
+        tag = f"{username}:{i}"
+        t0 = time.perf_counter()
+        writer.write((json.dumps({"type": "chat", "message": tag}) + "\n").encode())
+        await wait_packet(reader, lambda d: d.get("message") == tag)
+        latencies.append(time.perf_counter() - t0)
+    await drain(reader)
+
+
+async def run_connections(port, names, active, messages, concurrency, sample=None):
+    # sample() được gọi khi cả N kết nối còn mở (trước khi đóng writer)
+    sem = asyncio.Semaphore(concurrency)
+    bots = []
+
+    async def connect(name):
+        async with sem:
+            bots.append((name, *await open_bot(port, name)))
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(connect(n) for n in names))
+    connect_time = time.perf_counter() - t0
+
+    latencies = []
+    tasks = []
+    for i, (name, reader, writer) in enumerate(bots):
+        if i < active:
+            tasks.append(asyncio.create_task(
+                active_bot(reader, writer, name, messages, latencies)))
+        else:
+            tasks.append(asyncio.create_task(drain(reader)))
+
+    t1 = time.perf_counter()
+    while len(latencies) < active * messages:
+        await asyncio.sleep(0.05)
+        if time.perf_counter() - t1 > 120:
+            break
+    active_time = time.perf_counter() - t1
+    stats = sample() if sample else None
+
+    for t in tasks:
+        t.cancel()
+    for _, _, writer in bots:
+        writer.close()
+    return connect_time, active_time, latencies, stats
+
+
+async def cluster_bots(port, names, rooms, ready, go, start, seconds):
+    bots = []
+    for i, name in enumerate(names):
+        reader, writer = await open_bot(port, name)
+        room = rooms[i % len(rooms)]
+        writer.write((json.dumps({"type": "join_room", "room": room}) + "\n").encode())
+        await wait_packet(reader, lambda d: d.get("type") == "room_joined")
+        bots.append((name, reader, writer))
+    ready.put(len(bots))
+    await asyncio.get_running_loop().run_in_executor(None, go.wait)
+    until = start.value + seconds
+    await asyncio.sleep(max(0, start.value - time.time()))
+    counts = {"sent": 0, "delivered": 0}
+
+    async def loop(name, reader, writer):
+        i = 0
+        while time.time() < until:
+            tag = f"{name}:{i}"
+            i += 1
+            writer.write((json.dumps({"type": "chat", "message": tag}) + "\n").encode())
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                d = json.loads(line)
+                if d.get("type") == "chat":
+                    counts["delivered"] += 1
+                    if d.get("message") == tag:
+                        break
+            counts["sent"] += 1
+
+    tasks = [asyncio.create_task(loop(*b)) for b in bots]
+    await asyncio.wait(tasks, timeout=seconds + 5)
+    for t in tasks:
+        t.cancel()
+    for _, _, writer in bots:
+        writer.close()
+    return counts
+
+
+def cluster_client(port, names, rooms, ready, go, start, seconds, out):
+    counts = asyncio.run(cluster_bots(port, names, rooms, ready, go, start, seconds))
+    out.put((counts["sent"], counts["delivered"]))
+
+
+# ===================== COMMANDS =====================
+def cmd_connections(args):
+    limit = raise_nofile()
+    for n in [int(x) for x in args.sizes.split(",")]:
+        if n * 2 + 100 > limit:
+            print(f"N={n}: bỏ qua, RLIMIT_NOFILE={limit} không đủ")
+            continue
+        workdir = tempfile.mkdtemp(prefix="chatbench-")
+        names = [f"bot{i}" for i in range(n)]
+        seed_users(workdir, names)
+        port = free_port()
+        proc = spawn_server(workdir, port,
+                            ["--mode", args.mode, "--backlog", str(args.backlog)])
+        try:
+            active = min(args.active, n)
+            connect_time, active_time, lat, (rss, threads) = asyncio.run(run_connections(
+                port, names, active, args.messages, args.concurrency,
+                sample=lambda: proc_stats(proc.pid)))
+            ms = [x * 1000 for x in lat]
+            print(f"mode={args.mode} N={n} active={active} "
+                  f"connect={connect_time:.2f}s rss={rss / 1024:.1f}MB threads={threads} "
+                  f"msgs={len(ms)} in {active_time:.2f}s "
+                  f"p50={percentile(ms, 50):.2f}ms p95={percentile(ms, 95):.2f}ms "
+                  f"p99={percentile(ms, 99):.2f}ms")
+        finally:
+            proc.kill()
+            proc.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def cmd_protocol(args):
+    for size in [int(x) for x in args.image_sizes.split(",")]:
+        raw = os.urandom(size)
+        for proto in (NDJSON, FRAMED):
+            wire = 0
+            t0 = time.process_time()
+            for _ in range(args.rounds):
+                up = encode_packet({"type": "image", "filename": "a.png",
+                                    "data": raw, "caption": ""}, proto)
+                dec = make_decoder(proto)
+                dec.feed(up)
+                pkt = dec.next_packet()
+                if proto == NDJSON:
+                    # server chuẩn hóa ảnh về bytes như process_packet
+                    pkt["data"] = base64.b64decode(pkt["data"])
+                down = encode_packet(pkt, proto)
+                dec = make_decoder(proto)
+                dec.feed(down)
+                dec.next_packet()
+                wire = len(up) + len(down)
+            cpu = (time.process_time() - t0) / args.rounds
+            print(f"{proto:7s} image={size / 1e6:.2f}MB wire={wire / 1e6:.2f}MB "
+                  f"(+{(wire / (2 * size) - 1) * 100:.1f}%) cpu={cpu * 1000:.2f}ms/ảnh")
+
+
+class NullConnection:
+    """Connection giả cho fanout: nhận gói như ClientConnection, không gửi đi đâu."""
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.features = frozenset()
+        self.sent = 0
+
+    def send_bytes(self, data, low_priority=False):
+        self.sent += len(data)
+
+    def close(self):
+        pass
+
+
+def cpu_per_call(fn, rounds):
+    t0 = time.process_time()
+    for _ in range(rounds):
+        fn()
+    return (time.process_time() - t0) / rounds
+
+
+def cmd_fanout(args):
+    workdir = tempfile.mkdtemp(prefix="chatbench-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        server = ChatServer(history_fsync="never")
+        room = "Phòng chung"
+        message = "x" * args.message_size
+        try:
+            for n in [int(x) for x in args.room_sizes.split(",")]:
+                for conn in list(server.clients):
+                    server.remove_member(room, conn)
+                server.clients.clear()
+                server.sessions.clear()
+                for i in range(n):
+                    conn = NullConnection(FRAMED if i % 2 else NDJSON)
+                    server.clients[conn] = {"username": f"bot{i}", "room": None}
+                    server.sessions[f"bot{i}"] = {conn}
+                    server.add_member(room, conn)
+                server.users_version += 1
+                members = list(server.rooms[room]["members"])
+                packet = {"type": "chat", "sender": "bot0", "message": message,
+                          "room": room, "timestamp": "00:00:00"}
+
+                def per_member():
+                    for s in members:
+                        s.send_bytes(encode_packet(packet, s.protocol))
+
+                def rebuild_user_list():
+                    server.users_version += 1
+                    server.broadcast_user_list()
+
+                rounds = max(3, args.recipients // max(n, 1))
+                old = cpu_per_call(per_member, rounds)
+                new = cpu_per_call(lambda: server.broadcast_room(room, "bot0", message), rounds)
+                rebuilt = cpu_per_call(rebuild_user_list, rounds)
+                cached = cpu_per_call(server.broadcast_user_list, rounds)
+                print(f"N={n:6d} broadcast: encode/người={old * 1e3:8.3f}ms "
+                      f"encode 1 lần={new * 1e3:8.3f}ms ({new / n * 1e6:.2f}µs/người) | "
+                      f"user_list: dựng lại={rebuilt * 1e3:8.3f}ms cache={cached * 1e3:8.3f}ms")
+        finally:
+            server.history_store.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def cmd_cluster(args):
+    raise_nofile()
+    names = [f"bot{i}" for i in range(args.bots)]
+    rooms = [f"bench-{i}" for i in range(args.rooms)]
+    print(f"cpu={os.cpu_count()} bots={args.bots} rooms={args.rooms} "
+          f"client processes={args.clients}")
+    for workers in [int(x) for x in args.workers.split(",")]:
+        workdir = tempfile.mkdtemp(prefix="chatbench-")
+        seed_users(workdir, names)
+        port = free_port()
+        proc = spawn_server(workdir, port, ["--mode", args.mode, "--backlog", "1024",
+                                            "--workers", str(workers)])
+        procs = []
+        try:
+            # chờ mọi worker nghe cổng, không thì kết nối dồn vào worker đầu
+            time.sleep(0.5 + 0.3 * workers)
+            ctx = multiprocessing.get_context("spawn")
+            ready, out, go = ctx.Queue(), ctx.Queue(), ctx.Event()
+            start = ctx.Value("d", 0.0)
+            for c in range(args.clients):
+                p = ctx.Process(target=cluster_client, args=(
+                    port, names[c::args.clients], rooms, ready, go, start, args.seconds, out))
+                p.start()
+                procs.append(p)
+            connected = sum(ready.get(timeout=120) for _ in procs)
+            start.value = time.time() + 0.5
+            go.set()
+            sent = delivered = 0
+            for _ in procs:
+                s, d = out.get(timeout=args.seconds + 60)
+                sent += s
+                delivered += d
+            print(f"workers={workers} bots={connected} "
+                  f"gửi={sent / args.seconds:8.0f} tin/s giao={delivered / args.seconds:9.0f} lượt/s")
+        finally:
+            for p in procs:
+                p.join(5)
+                if p.is_alive():
+                    p.kill()
+            proc.terminate()
+            proc.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def cmd_history(args):
+    workdir = tempfile.mkdtemp(prefix="chatbench-")
+    try:
+        path = os.path.join(workdir, "history.db")
+        store = SQLiteHistory(path, None, None, fsync="never")
+        rooms = [f"room-{i}" for i in range(args.rooms)]
+        t0 = time.perf_counter()
+        for i in range(args.messages):
+            store.append({"timestamp": "2024-01-01 00:00:00", "username": f"bot{i % 997}",
+                          "message": f"tin nhắn số {i}", "room": rooms[i % len(rooms)]})
+        store.close()
+        write = time.perf_counter() - t0
+        size = sum(os.path.getsize(os.path.join(workdir, f)) for f in os.listdir(workdir))
+        print(f"ghi {args.messages} tin / {args.rooms} phòng trong {write:.1f}s "
+              f"({args.messages / write:.0f} tin/s), DB {size / 1e6:.0f}MB")
+
+        store = SQLiteHistory(path, None, None)
+        for label, deep in (("mới nhất", False), ("cuộn ngược sâu", True)):
+            lat = []
+            for _ in range(args.queries):
+                before = random.randint(1, args.messages) if deep else None
+                t0 = time.perf_counter()
+                store.page(random.choice(rooms), before, args.limit)
+                lat.append((time.perf_counter() - t0) * 1000)
+            print(f"{label:15s} limit={args.limit}: p50={percentile(lat, 50):.3f}ms "
+                  f"p99={percentile(lat, 99):.3f}ms max={max(lat):.3f}ms")
+        store.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def cmd_auth(args):
+    raise_nofile()
+    names = [f"bot{i}" for i in range(args.bots)]
+    workdir = tempfile.mkdtemp(prefix="chatbench-")
+    seed_users(workdir, names, legacy=True)
+    port = free_port()
+    extra = ["--mode", args.mode, "--backlog", "1024"]
+    if args.kdf_workers:
+        extra += ["--kdf-workers", str(args.kdf_workers)]
+    proc = spawn_server(workdir, port, extra)
+    print(f"cpu={os.cpu_count()} mode={args.mode} bots={args.bots} "
+          f"concurrency={args.concurrency}")
+    try:
+        tokens = None
+        for label, use_tokens in (("sha256 cũ -> scrypt", False),
+                                  ("mật khẩu scrypt", False),
+                                  ("session token", True)):
+            elapsed, lat, issued, failed = asyncio.run(login_storm(
+                port, names, args.concurrency, tokens if use_tokens else None))
+            ms = [x * 1000 for x in lat]
+            print(f"{label:20s} {len(lat) / elapsed:8.0f} đăng nhập/s "
+                  f"p50={percentile(ms, 50):7.1f}ms p99={percentile(ms, 99):7.1f}ms lỗi={failed}")
+            tokens = issued
+            # chờ server xử lý xong các lượt ngắt kết nối
+            time.sleep(1)
+    finally:
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def cmd_users(args):
+    workdir = tempfile.mkdtemp(prefix="chatbench-")
+    try:
+        legacy = os.path.join(workdir, "users.json")
+        record = {"password": hash_password(BOT_PASSWORD), "avatar": None}
+        users = {f"user{i}": record for i in range(args.existing)}
+        with open(legacy, "w", encoding="utf-8") as f:
+            json.dump(users, f, indent=2)
+
+        # cách cũ: mỗi lần đăng ký viết lại cả file (indent=2) rồi rename
+        n_old = max(1, min(args.registrations, args.old_registrations))
+        t0 = time.perf_counter()
+        for i in range(n_old):
+            users[f"new{i}"] = record
+            tmp = legacy + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(users, f, ensure_ascii=False, indent=2)
+            os.replace(tmp, legacy)
+        old = (time.perf_counter() - t0) / n_old
+        for i in range(n_old):
+            users.pop(f"new{i}")
+        with open(legacy, "w", encoding="utf-8") as f:
+            json.dump(users, f, indent=2)
+
+        t0 = time.perf_counter()
+        store = UserStore(os.path.join(workdir, "users.db"), legacy)
+        migrate = time.perf_counter() - t0
+        lat = []
+        t0 = time.perf_counter()
+        for i in range(args.registrations):
+            t1 = time.perf_counter()
+            store.add(f"new{i}", record)
+            lat.append((time.perf_counter() - t1) * 1000)
+        new = (time.perf_counter() - t0) / args.registrations
+        store.close()
+
+        print(f"{args.existing} tài khoản có sẵn, chuyển users.json -> DB: {migrate:.2f}s")
+        print(f"users.json (cũ): {1 / old:8.0f} đăng ký/s ({old * 1000:.1f}ms mỗi lần, đo {n_old} lần)")
+        print(f"UserStore:       {1 / new:8.0f} đăng ký/s "
+              f"(p50={percentile(lat, 50):.3f}ms p99={percentile(lat, 99):.3f}ms)")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark chat server")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("connections", help="idle + active connections, thread vs asyncio")
+    p.add_argument("--mode", choices=("thread", "asyncio"), default="thread")
+    p.add_argument("--sizes", default="1000,5000,10000")
+    p.add_argument("--active", type=int, default=50)
+    p.add_argument("--messages", type=int, default=20)
+    p.add_argument("--concurrency", type=int, default=200)
+    p.add_argument("--backlog", type=int, default=1024)
+    p.set_defaults(func=cmd_connections)
+
+    p = sub.add_parser("protocol", help="bytes trên dây và CPU mỗi ảnh: ndjson vs frame1")
+    p.add_argument("--image-sizes", default="100000,1000000,5000000")
+    p.add_argument("--rounds", type=int, default=10)
+    p.set_defaults(func=cmd_protocol)
+
+    p = sub.add_parser("fanout", help="CPU mỗi broadcast theo số thành viên phòng")
+    p.add_argument("--room-sizes", default="10,100,1000,10000")
+    p.add_argument("--message-size", type=int, default=200)
+    p.add_argument("--recipients", type=int, default=200000,
+                   help="tổng số lượt nhận mỗi phép đo, chia theo N để chọn số vòng")
+    p.set_defaults(func=cmd_fanout)
+
+    p = sub.add_parser("cluster", help="throughput tin nhắn theo số worker process")
+    p.add_argument("--workers", default="1,2,4")
+    p.add_argument("--mode", choices=("thread", "asyncio"), default="asyncio")
+    p.add_argument("--bots", type=int, default=400)
+    p.add_argument("--rooms", type=int, default=40)
+    p.add_argument("--seconds", type=float, default=10)
+    p.add_argument("--clients", type=int, default=4, help="số process chạy bot")
+    p.set_defaults(func=cmd_cluster)
+
+    p = sub.add_parser("history", help="độ trễ get_history theo trang khi DB có hàng triệu tin")
+    p.add_argument("--messages", type=int, default=2000000)
+    p.add_argument("--rooms", type=int, default=100)
+    p.add_argument("--limit", type=int, default=50)
+    p.add_argument("--queries", type=int, default=2000)
+    p.set_defaults(func=cmd_history)
+
+    p = sub.add_parser("auth", help="login storm: sha256 cũ, scrypt, session token")
+    p.add_argument("--mode", choices=("thread", "asyncio"), default="asyncio")
+    p.add_argument("--bots", type=int, default=500)
+    p.add_argument("--concurrency", type=int, default=200)
+    p.add_argument("--kdf-workers", type=int, default=None)
+    p.set_defaults(func=cmd_auth)
+
+    p = sub.add_parser("users", help="đăng ký / giây khi đã có nhiều tài khoản: SQLite vs users.json")
+    p.add_argument("--existing", type=int, default=100000)
+    p.add_argument("--registrations", type=int, default=2000)
+    p.add_argument("--old-registrations", type=int, default=50,
+                   help="số lần đo cách cũ (mỗi lần viết lại cả file)")
+    p.set_defaults(func=cmd_users)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
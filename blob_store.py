@@ -0,0 +1,79 @@
+import base64
+import hashlib
+import os
+import re
+import uuid
+
+_BLOB_ID = re.compile(r"^[0-9a-f]{64}$")
+
+READ_BLOCK = 48 * 1024  # chia hết cho 3 để base64 từng khối nối lại vẫn đúng
+
+
+class FileRegion:
+    """
+    Một đoạn file cần gửi ra socket. Connection gửi bằng os.sendfile (không
+    copy qua Python) khi có thể; b64=True thì đọc từng khối và base64 cho
+    client NDJSON, RAM chỉ tốn một khối.
+    """
+
+    def __init__(self, path, offset=0, count=None, b64=False):
+        self.path = path
+        self.offset = offset
+        self.count = os.path.getsize(path) - offset if count is None else count
+        self.b64 = b64
+
+    def __len__(self):
+        return self.count
+
+    def iter_blocks(self):
+        remaining = self.count
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            while remaining > 0:
+                block = f.read(min(READ_BLOCK, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+                yield base64.b64encode(block) if self.b64 else block
+
+
+class BlobStore:
+    """
+    Kho file đính kèm đánh địa chỉ theo nội dung: mỗi file lưu một lần tại
+    <dir>/<2 ký tự đầu sha256>/<sha256>, gửi trùng thì dùng lại file cũ.
+    """
+
+    def __init__(self, directory="attachments"):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, blob_id):
+        """Đường dẫn của blob, None nếu id sai hoặc không tồn tại."""
+        if not isinstance(blob_id, str) or not _BLOB_ID.match(blob_id):
+            return None
+        p = os.path.join(self.directory, blob_id[:2], blob_id)
+        return p if os.path.exists(p) else None
+
+    def _target(self, blob_id):
+        d = os.path.join(self.directory, blob_id[:2])
+        os.makedirs(d, exist_ok=True)
+        return os.path.join(d, blob_id)
+
+    def put_file(self, src, sha256):
+        """Chuyển file đã kiểm tra sha256 vào kho (rename, không copy)."""
+        target = self._target(sha256)
+        if os.path.exists(target):
+            os.remove(src)
+        else:
+            os.replace(src, target)
+        return sha256
+
+    def put_bytes(self, raw: bytes):
+        blob_id = hashlib.sha256(raw).hexdigest()
+        target = self._target(blob_id)
+        if not os.path.exists(target):
+            tmp = f"{target}.{uuid.uuid4().hex}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(raw)
+            os.replace(tmp, target)
+        return blob_id
@@ -1,132 +1,886 @@
 import socket
 import threading
+import asyncio
 import json
-import hashlib
+import base64
+from concurrent.futures import Future
 from datetime import datetime
+from collections import deque
 import os
+import time
 import tkinter as tk
 from tkinter import messagebox, simpledialog, scrolledtext
 
-USERS_FILE = "users.json"
-HISTORY_FILE = "chat_history.json"
+from blob_store import BlobStore, FileRegion
+from cluster import BusClient, run_cluster
+from replication import SNAPSHOT_CHUNK, ReplicationServer, StandbyClient
+from history_store import HistoryJournal, SQLiteHistory
+from passwords import (SESSION_TTL, KDFPool, SessionTokens, hash_password,
+                       verify_password)
+from metrics import FANOUT_BUCKETS, Metrics, MetricsHTTPServer
+from uploads import DEFAULT_MAX_UPLOAD, UploadError, UploadManager
+from room_shards import RoomRegistry, RoomShards
+from user_store import UserStore
+from protocol import (DEFLATE_LEVEL, FRAMED, NDJSON, Deflater, EncodedPacket,
+                      LineDecoder, ProtocolError, attachment_parts,
+                      choose_compression, choose_features, choose_protocol,
+                      encode_packet, make_decoder)
+
+USERS_FILE = "users.json"  # định dạng cũ, tự chuyển sang USERS_DB
+USERS_DB = "users.db"
+HISTORY_FILE = "chat_history.json"  # định dạng cũ, tự chuyển sang HISTORY_LOG
+HISTORY_LOG = "chat_history.jsonl"
+HISTORY_DB = "chat_history.db"
+HISTORY_BACKENDS = ("sqlite", "jsonl")
+HISTORY_PAGE_MAX = 200  # số tin tối đa mỗi get_history
+RESUME_REPLAY_MAX = 500  # số tin lỡ tối đa gửi lại khi resume
+PRESENCE_LOG = 256  # số delta presence gần nhất giữ lại cho client resume
+UPLOAD_DIR = "uploads"
+ATTACHMENT_DIR = "attachments"
+
+# Khi hàng đợi gửi của một client đầy:
+#   drop_oldest       - bỏ gói cũ nhất
+#   disconnect        - ngắt kết nối client chậm
+#   drop_low_priority - bỏ gói ưu tiên thấp (ảnh) trước, hết thì bỏ gói cũ nhất
+OVERFLOW_POLICIES = ("drop_oldest", "disconnect", "drop_low_priority")
+LOW_PRIORITY_TYPES = {"image"}
+
+DIRECTORY_PAGE_SIZE = 50
+DIRECTORY_PAGE_MAX = 100
+DIRECTORY_CACHE_SIZE = 1024  # số query giữ trang đã encode
+
+# các type client được gửi; type lạ gộp thành "other" trong metrics
+PACKET_TYPES = {
+    "chat", "private", "join_room", "create_room", "update_room", "delete_room",
+    "image", "upload_init", "upload_chunk", "upload_commit", "fetch_blob",
+    "admin_kick", "admin_change_password", "admin_rename_room", "presence_sync",
+    "list_rooms", "get_history",
+}
+# gói gắn với một phòng, chạy trong shard của phòng đó (room_shards.py):
+# chat / ảnh xếp hàng không chờ, tạo phòng / thao tác quản trị phòng chờ
+# xong mới đọc tiếp gói sau của kết nối; join_room tự gọi vào shard của
+# phòng đích
+SHARD_QUEUED_TYPES = {"chat", "image"}
+SHARD_CALL_TYPES = {
+    "create_room", "update_room", "delete_room", "admin_kick",
+    "admin_change_password", "admin_rename_room",
+}
 
 # ===================== UTILS =====================
-def load_users():
-    if not os.path.exists(USERS_FILE):
-        return {}
-    try:
-        with open(USERS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except:
-        return {}
-
-
-def save_users(db):
-    with open(USERS_FILE, "w", encoding="utf-8") as f:
-        json.dump(db, f, ensure_ascii=False, indent=2)
-
-
-def hash_pw(pw: str):
-    return hashlib.sha256(pw.encode("utf-8")).hexdigest()
-
-
-def load_history():
-    if not os.path.exists(HISTORY_FILE):
-        return []
-    try:
-        with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-            hist = json.load(f)
-    except:
-        return []
-
-    for e in hist:
-        if isinstance(e, dict) and "room" not in e:
-            e["room"] = "Phòng chung"
-
-    return hist
-
-
-def save_history(hist):
-    with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-        json.dump(hist[-1000:], f, ensure_ascii=False, indent=2)
+def new_room(creator, password=""):
+    return {
+        "creator": creator,
+        "password": password,
+        "is_private": password != "",
+        "members": set(),  # các socket đang ở trong phòng
+        "users": {},       # username -> set(socket), một user có thể có nhiều phiên
+    }
+
+
+def push_bounded(q, item, max_size, policy):
+    """
+    Đưa (payload, low_priority, ...) vào deque q có giới hạn theo policy.
+    Trả về số gói bị bỏ, hoặc None nếu phải ngắt kết nối.
+    """
+    if len(q) < max_size:
+        q.append(item)
+        return 0
+    if policy == "disconnect":
+        return None
+    if policy == "drop_low_priority":
+        if item[1]:
+            return 1
+        for i, queued in enumerate(q):
+            if queued[1]:
+                del q[i]
+                q.append(item)
+                return 1
+    q.popleft()
+    q.append(item)
+    return 1
 
 
 # ===================== SERVER =====================
 class ChatServer:
-    def __init__(self, host="0.0.0.0", port=5555):
+    """
+    mode="thread": mỗi kết nối một thread (mặc định, như cũ).
+    mode="asyncio": mọi kết nối chạy trên một event loop duy nhất.
+
+    room_shards: số thread worker chia nhau các phòng (chỉ mode="thread";
+    mode="asyncio" chạy mọi thứ trên event loop nên luôn là 0).
+
+    bus_path: chạy như một worker trong cụm nhiều process (cluster.py) -
+    nghe chung cổng bằng SO_REUSEPORT và trao đổi với worker khác qua broker.
+
+    replicate_port: mở cổng cho warm standby (replication.py) nhận snapshot
+    rồi stream thay đổi phòng / tài khoản / history.
+
+    kdf_workers: số thread băm / kiểm tra mật khẩu (passwords.py, mặc định
+    số CPU). session_ttl: số giây một session token còn dùng được (0 = không
+    cấp token).
+
+    deflate_level: mức nén zlib cho client đề nghị "deflate" (protocol.py);
+    0 = không nhận nén.
+    """
+
+    MODES = ("thread", "asyncio")
+
+    def __init__(self, host="0.0.0.0", port=5555, mode="thread", backlog=20,
+                 history_fsync="interval", history_flush_interval=0.05,
+                 history_retention=None, room_retention=None,
+                 history_backend="sqlite",
+                 outbound_queue=1000, overflow_policy="drop_oldest",
+                 max_upload_size=DEFAULT_MAX_UPLOAD,
+                 metrics_host="127.0.0.1", metrics_port=None,
+                 presence_interval=0.05, room_shards=4,
+                 worker_id=0, bus_path=None,
+                 replicate_host="127.0.0.1", replicate_port=None,
+                 kdf_workers=None, session_ttl=SESSION_TTL,
+                 deflate_level=DEFLATE_LEVEL):
+        if mode not in self.MODES:
+            raise ValueError(f"mode không hợp lệ: {mode}")
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"overflow_policy không hợp lệ: {overflow_policy}")
+        if history_backend not in HISTORY_BACKENDS:
+            raise ValueError(f"history_backend không hợp lệ: {history_backend}")
         self.host = host
         self.port = port
-
-        self.users = load_users()
-        self.history = load_history()
+        self.mode = mode
+        self.backlog = backlog
+        self.outbound_queue = outbound_queue
+        self.overflow_policy = overflow_policy
+        self.deflate_level = deflate_level
+
+        self.metrics = Metrics()
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port  # None = không mở HTTP endpoint
+        self.metrics_server = None
+
+        # cụm nhiều process: worker 0 là worker chính, nơi duy nhất ghi
+        # DB tài khoản và history; worker khác giữ bản sao trong bộ nhớ
+        self.worker_id = worker_id
+        self.bus_path = bus_path
+        self.bus = None
+        self.primary = worker_id == 0
+        self.remote = {}  # id worker -> {"users": {username}, "rooms": {phòng: [username]}}
+        self._published_local = None
+
+        # warm standby: None = không mở cổng replication
+        self.replicate_host = replicate_host
+        self.replicate_port = replicate_port
+        self.replicator = None
+
+        self.users = UserStore(USERS_DB, USERS_FILE, persist=self.primary)
+        # băm mật khẩu chạy trong pool; đăng nhập lại bằng token bỏ qua KDF
+        self.kdf = KDFPool(kdf_workers, metrics=self.metrics)
+        self.tokens = SessionTokens(session_ttl)
+        # history_retention=None: sqlite giữ hết, jsonl giữ 500 tin / phòng
+        if history_backend == "sqlite":
+            self.history_store = SQLiteHistory(
+                HISTORY_DB, HISTORY_LOG, HISTORY_FILE,
+                flush_interval=history_flush_interval,
+                fsync=history_fsync,
+                default_retention=history_retention,
+                retention=room_retention,
+                metrics=self.metrics,
+                persist=self.primary,
+            )
+        else:
+            self.history_store = HistoryJournal(
+                HISTORY_LOG, HISTORY_FILE,
+                flush_interval=history_flush_interval,
+                fsync=history_fsync,
+                default_retention=500 if history_retention is None else history_retention,
+                retention=room_retention,
+                metrics=self.metrics,
+                persist=self.primary,
+            )
+        self.uploads = UploadManager(UPLOAD_DIR, max_upload_size)
+        self.blobs = BlobStore(ATTACHMENT_DIR)
 
         self.server_socket = None
         self.clients = {}  # sock -> {"username":..., "room":...}
-
-        self.rooms = {
-            "Phòng chung": {
-                "creator": "SERVER",
-                "password": "",
-                "is_private": False,
-                "members": set(),
-            }
-        }
+        self.sessions = {}  # username -> set(sock), mọi phiên đang online
+        # tăng mỗi khi danh sách online / phòng đổi; user_list và room_list
+        # chỉ dựng + encode lại khi version khác bản đã cache
+        self.users_version = 0
+        self.rooms_version = 0  # tăng từ nhiều shard: qua rooms_changed()
+        self._rooms_lock = threading.Lock()
+        self._list_cache = {}  # "user_list"/"room_list" -> (version, EncodedPacket)
+
+        # presence: trạng thái đã phát cho client (delta tính so với đây)
+        self.presence_interval = presence_interval
+        self.presence_seq = 0
+        self.users_seq = 0  # luồng delta chỉ có user (client dùng "directory")
+        self._published_users = {}  # username -> None, giữ thứ tự
+        self._published_rooms = {}  # room -> summary
+        self._presence_lock = threading.RLock()
+        self._presence_scheduled = False
+        # delta gần nhất (seq, EncodedPacket) để client resume chỉ nhận phần
+        # đã lỡ; server_id đổi mỗi lần khởi động (seq presence bắt đầu lại)
+        self._presence_log = deque(maxlen=PRESENCE_LOG)
+        self._users_log = deque(maxlen=PRESENCE_LOG)
+        self.server_id = os.urandom(8).hex()
+
+        # seq tin nhắn theo phòng: tăng dần, lưu trong entry history (resume)
+        self.room_seqs = {}  # phòng -> seq tin cuối
+        self._seq_lock = threading.Lock()
+
+        # room directory: query -> set(sock) đang xem trang đó
+        self.directory_subs = {}
+        self._directory_cache = {}  # query -> (rooms_version, EncodedPacket)
+        self._directory_sent = {}   # query -> nội dung trang đã gửi lần cuối
+
+        # mỗi phòng thuộc một shard; join / tin nhắn / history của phòng chạy
+        # tuần tự trong shard đó, các phòng khác shard chạy song song. Registry
+        # phòng cũng chia theo shard: chỉ shard sở hữu thêm / xóa / sửa phòng.
+        # start() dựng lại theo self.mode cuối cùng (GUI đổi mode sau __init__)
+        self.room_shards = room_shards
+        self.shards = RoomShards(room_shards if mode == "thread" else 0)
+        self.rooms = RoomRegistry(self.shards)
+        self.rooms["Phòng chung"] = new_room("SERVER")
+        self._renamed = {}  # tên cũ -> tên mới, cho gói đã xếp hàng trước khi đổi tên
         self.running = False
         self.logger = None
 
+        # chỉ dùng cho mode="asyncio"
+        self._loop = None
+        self._async_stop = None
+
+        self.setup_metrics()
+
+    # ------------------ METRICS ------------------
+    def setup_metrics(self):
+        m = self.metrics
+        m.describe("chat_packets_in_total", "Gói nhận từ client theo type")
+        m.describe("chat_bytes_in_total", "Byte nhận từ client theo type")
+        m.describe("chat_packets_out_total", "Gói gửi tới client theo type")
+        m.describe("chat_bytes_out_total", "Byte gửi tới client theo type")
+        m.describe("chat_handler_seconds", "Thời gian process_packet theo type")
+        m.describe("chat_fanout_recipients", "Số người nhận mỗi broadcast", FANOUT_BUCKETS)
+        m.describe("chat_history_write_seconds", "Thời gian ghi một batch history")
+        m.describe("chat_history_records_total", "Số bản ghi history đã ghi")
+        m.describe("chat_history_fsync_total", "Số lần fsync file history")
+        m.describe("chat_auth_total", "Đăng nhập / đăng ký thành công")
+        m.describe("chat_auth_failures_total", "Auth thất bại theo lý do")
+        m.describe("chat_kdf_seconds", "Thời gian một lần băm / kiểm tra mật khẩu")
+        m.describe("chat_password_upgrades_total", "Mã băm mật khẩu cũ đã băm lại bằng scrypt")
+        m.describe("chat_deflate_raw_bytes_total", "Byte gửi tới client nén deflate, trước khi nén")
+        m.describe("chat_deflate_wire_bytes_total", "Byte gửi tới client nén deflate, sau khi nén")
+        m.describe("chat_deflate_seconds", "Thời gian nén một gói gửi đi")
+        m.gauge("chat_connections", lambda: len(self.clients), "Kết nối đã auth")
+        m.gauge("chat_users_online", lambda: len(self.sessions), "Tài khoản đang online")
+        m.gauge("chat_rooms", lambda: len(self.rooms), "Số phòng")
+        m.gauge("chat_outbound_queued",
+                lambda: sum(s.queue_depth() for s in list(self.clients)),
+                "Gói đang chờ trong hàng đợi gửi")
+        m.gauge("chat_outbound_dropped",
+                lambda: sum(s.dropped for s in list(self.clients)),
+                "Gói đã bỏ do hàng đợi đầy (kết nối đang mở)")
+        m.gauge("chat_history_queue", lambda: self.history_store._queue.qsize(),
+                "Bản ghi history chờ ghi xuống đĩa")
+        m.gauge("chat_kdf_pending", lambda: self.kdf.pending,
+                "Lần băm mật khẩu đang chạy / chờ trong pool")
+        m.gauge("chat_room_shard_backlog", lambda: self.shards.backlog(),
+                "Thao tác phòng đang chờ trong mailbox các shard")
+
+    def start_metrics(self):
+        if self.metrics_port is None or self.metrics_server:
+            return
+        try:
+            self.metrics_server = MetricsHTTPServer(
+                self.metrics, self.metrics_host, self.metrics_port).start()
+            print(f"METRICS: http://{self.metrics_host}:{self.metrics_server.port}/metrics")
+        except OSError as e:
+            print("METRICS không mở được:", e)
+
     # ------------------ SEND ------------------
     def send(self, sock, data: dict):
+        ptype = data.get("type")
         try:
-            payload = json.dumps(data) + "\n"
-            sock.sendall(payload.encode("utf-8"))
+            payload = encode_packet(data, sock.protocol)
+            sock.send_bytes(payload, low_priority=ptype in LOW_PRIORITY_TYPES)
         except:
-            pass
-
-    def broadcast_all(self, data: dict):
-        payload = json.dumps(data) + "\n"
+            return
+        self.metrics.inc("chat_packets_out_total", type=ptype)
+        self.metrics.inc("chat_bytes_out_total", len(payload), type=ptype)
+
+    def send_many(self, socks, data):
+        """
+        Gửi một gói (dict hoặc EncodedPacket) cho nhiều client. Mỗi giao thức
+        chỉ encode một lần; mọi hàng đợi giữ chung một memoryview.
+        """
+        packet = data if isinstance(data, EncodedPacket) else EncodedPacket(data)
+        ptype = packet.data.get("type")
+        low = ptype in LOW_PRIORITY_TYPES
         dead = []
-        for s in list(self.clients.keys()):
+        sent = 0
+        for s in socks:
             try:
-                s.sendall(payload.encode("utf-8"))
+                payload = packet.get(s.protocol)
+                s.send_bytes(payload, low_priority=low)
+                sent += len(payload)
             except:
                 dead.append(s)
+        self.metrics.observe("chat_fanout_recipients", len(socks))
+        self.metrics.inc("chat_packets_out_total", len(socks) - len(dead), type=ptype)
+        self.metrics.inc("chat_bytes_out_total", sent, type=ptype)
+        return dead
+
+    def send_attachment(self, sock, data: dict, path, low_priority=True):
+        """
+        Gửi gói kèm nội dung file mà không nạp file vào RAM: header trước,
+        nội dung được connection đọc thẳng từ đĩa (sendfile với frame1,
+        base64 từng khối với ndjson).
+        """
+        prefix, suffix = attachment_parts(data, os.path.getsize(path), sock.protocol)
+        region = FileRegion(path, b64=sock.protocol != FRAMED)
+        try:
+            sock.send_bytes((prefix, region, suffix), low_priority=low_priority)
+        except:
+            return
+        size = (len(region) + 2) // 3 * 4 if region.b64 else len(region)
+        self.metrics.inc("chat_packets_out_total", type=data.get("type"))
+        self.metrics.inc("chat_bytes_out_total", len(prefix) + size + len(suffix),
+                         type=data.get("type"))
+
+    def broadcast_all(self, data):
+        dead = self.send_many(list(self.clients.keys()), data)
         for ds in dead:
             self.remove_client(ds)
 
-    def broadcast_user_list(self):
-        lst = [info["username"] for info in self.clients.values()]
-        self.broadcast_all({"type": "user_list", "users": lst})
-
-    def send_room_list(self):
-        arr = []
-        for name, info in self.rooms.items():
-            arr.append({
+    def user_list_packet(self):
+        version = self.users_version
+        cached = self._list_cache.get("user_list")
+        if cached is None or cached[0] != version:
+            cached = (version, EncodedPacket({"type": "user_list", "users": self.online_users()}))
+            self._list_cache["user_list"] = cached
+        return cached[1]
+
+    def room_summaries(self):
+        return {
+            name: {
                 "name": name,
                 "creator": info["creator"],
                 "is_private": info["is_private"],
-                "members_count": len(info["members"]),
+                "members_count": len(info["members"]) + self.remote_members(name),
+            }
+            for name, info in list(self.rooms.items())
+        }
+
+    def room_list_packet(self):
+        version = self.rooms_version
+        cached = self._list_cache.get("room_list")
+        if cached is None or cached[0] != version:
+            arr = list(self.room_summaries().values())
+            cached = (version, EncodedPacket({"type": "room_list", "rooms": arr}))
+            self._list_cache["room_list"] = cached
+        return cached[1]
+
+    # ------------------ PRESENCE ------------------
+    # Client có feature "presence" nhận một snapshot ("presence") rồi chỉ nhận
+    # delta ("presence_delta") đánh số seq liên tiếp; thấy hụt seq thì gửi
+    # presence_sync để lấy snapshot mới. Thay đổi được gom trong
+    # presence_interval giây rồi phát một lần; client cũ nhận lại toàn bộ
+    # user_list / room_list, cũng tối đa một lần mỗi cửa sổ.
+    # Client có thêm "directory" không nhận phòng qua presence (xem phòng
+    # bằng list_rooms) nên đi trên luồng delta chỉ có user, với seq riêng.
+    def broadcast_user_list(self):
+        self.schedule_presence()
+
+    def send_room_list(self):
+        self.schedule_presence()
+
+    def schedule_presence(self):
+        if self.presence_interval <= 0:
+            self.flush_presence()
+            return
+        with self._presence_lock:
+            if self._presence_scheduled:
+                return
+            self._presence_scheduled = True
+        if self._loop:
+            # mode asyncio: flush chạy trên event loop như mọi thao tác khác
+            try:
+                self._loop.call_soon_threadsafe(
+                    self._loop.call_later, self.presence_interval, self.flush_presence)
+            except RuntimeError:
+                self._presence_scheduled = False
+        else:
+            t = threading.Timer(self.presence_interval, self.flush_presence)
+            t.daemon = True
+            t.start()
+
+    def presence_snapshot(self, with_rooms=True):
+        with self._presence_lock:
+            snap = {
+                "type": "presence",
+                "seq": self.presence_seq if with_rooms else self.users_seq,
+                "users": list(self._published_users),
+            }
+            if with_rooms:
+                snap["rooms"] = list(self._published_rooms.values())
+            return snap
+
+    def send_presence(self, sock):
+        """Trạng thái ban đầu cho một client (vừa đăng nhập hoặc xin resync)."""
+        if "presence" in sock.features:
+            self.send(sock, self.presence_snapshot("directory" not in sock.features))
+        else:
+            self.send_many([sock], self.user_list_packet())
+            if "directory" not in sock.features:
+                self.send_many([sock], self.room_list_packet())
+
+    def resume_presence(self, sock, seq, server_id):
+        """
+        Client resume: chỉ gửi các delta sau seq client đã có; seq của lần
+        khởi động / worker khác, hoặc đã trôi khỏi log thì gửi snapshot.
+        """
+        if "presence" not in sock.features:
+            self.send_presence(sock)
+            return
+        full = "directory" not in sock.features
+        with self._presence_lock:
+            log = self._presence_log if full else self._users_log
+            current = self.presence_seq if full else self.users_seq
+            missed = [d for n, d in log if seq is not None and n > seq]
+            if (server_id != self.server_id or seq is None or seq > current
+                    or len(missed) != current - seq):
+                self.send(sock, self.presence_snapshot(full))
+                return
+            for d in missed:
+                self.send_many([sock], d)
+
+    def flush_presence(self):
+        with self._presence_lock:
+            self._presence_scheduled = False
+            if self.bus:
+                self.publish_state()
+            users = self.online_users()
+            rooms = self.room_summaries()
+            online = set(users)
+            joined = [u for u in users if u not in self._published_users]
+            left = [u for u in self._published_users if u not in online]
+            updated = [r for name, r in rooms.items() if self._published_rooms.get(name) != r]
+            removed = [name for name in self._published_rooms if name not in rooms]
+            users_changed = bool(joined or left)
+            rooms_changed = bool(updated or removed)
+            if not (users_changed or rooms_changed):
+                return
+            self.presence_seq += 1
+            self._published_users = dict.fromkeys(users)
+            self._published_rooms = rooms
+            delta = EncodedPacket({
+                "type": "presence_delta",
+                "seq": self.presence_seq,
+                "user_joined": joined,
+                "user_left": left,
+                "room_updated": updated,
+                "room_removed": removed,
             })
-        self.broadcast_all({"type": "room_list", "rooms": arr})
+            self._presence_log.append((self.presence_seq, delta))
+            if users_changed:
+                self.users_seq += 1
+                users_delta = EncodedPacket({
+                    "type": "presence_delta",
+                    "seq": self.users_seq,
+                    "user_joined": joined,
+                    "user_left": left,
+                })
+                self._users_log.append((self.users_seq, users_delta))
+
+            full, users_only, legacy, legacy_users = [], [], [], []
+            for s in list(self.clients):
+                if "presence" in s.features:
+                    (users_only if "directory" in s.features else full).append(s)
+                else:
+                    (legacy_users if "directory" in s.features else legacy).append(s)
+            # gửi trong lock để delta đến client đúng thứ tự seq
+            dead = self.send_many(full, delta)
+            if users_changed:
+                dead += self.send_many(users_only, users_delta)
+                dead += self.send_many(legacy + legacy_users, self.user_list_packet())
+            if rooms_changed:
+                dead += self.send_many(legacy, self.room_list_packet())
+                dead += self.update_directory_subscribers()
+        for ds in dead:
+            self.remove_client(ds)
+
+    # ------------------ ROOM DIRECTORY ------------------
+    # list_rooms trả về một trang danh sách phòng (lọc theo tiền tố tên,
+    # công khai / riêng tư, sắp theo tên hoặc số thành viên). Trang của mỗi
+    # query được cache dạng đã encode theo rooms_version; client theo dõi
+    # trang đang xem và chỉ nhận lại trang đó khi nội dung của nó đổi.
+    def directory_query(self, data):
+        try:
+            offset = max(0, int(data.get("offset", 0)))
+            limit = min(DIRECTORY_PAGE_MAX, max(1, int(data.get("limit", DIRECTORY_PAGE_SIZE))))
+        except (TypeError, ValueError):
+            offset, limit = 0, DIRECTORY_PAGE_SIZE
+        visibility = data.get("visibility", "all")
+        if visibility not in ("all", "public", "private"):
+            visibility = "all"
+        sort = data.get("sort", "name")
+        if sort not in ("name", "members"):
+            sort = "name"
+        prefix = str(data.get("prefix") or "")[:64]
+        return (prefix, visibility, sort, offset, limit)
+
+    def directory_page(self, query):
+        """EncodedPacket room_page của query, chỉ dựng lại khi phòng thay đổi."""
+        version = self.rooms_version
+        cached = self._directory_cache.get(query)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        prefix, visibility, sort, offset, limit = query
+        key = prefix.casefold()
+        rooms = [
+            r for r in self.room_summaries().values()
+            if r["name"].casefold().startswith(key)
+            and (visibility == "all" or r["is_private"] == (visibility == "private"))
+        ]
+        if sort == "members":
+            rooms.sort(key=lambda r: (-r["members_count"], r["name"].casefold()))
+        else:
+            rooms.sort(key=lambda r: r["name"].casefold())
+        page = EncodedPacket({
+            "type": "room_page",
+            "prefix": prefix,
+            "visibility": visibility,
+            "sort": sort,
+            "offset": offset,
+            "limit": limit,
+            "total": len(rooms),
+            "rooms": rooms[offset:offset + limit],
+        })
+        if len(self._directory_cache) >= DIRECTORY_CACHE_SIZE:
+            self._directory_cache.clear()
+        self._directory_cache[query] = (version, page)
+        return page
+
+    def list_rooms(self, sock, data):
+        query = self.directory_query(data)
+        with self._presence_lock:
+            self.unsubscribe_directory(sock)
+            page = self.directory_page(query)
+            if data.get("subscribe", True) and sock in self.clients:
+                self.clients[sock]["directory"] = query
+                subs = self.directory_subs.setdefault(query, set())
+                if not subs:
+                    self._directory_sent[query] = page.data
+                subs.add(sock)
+            self.send_many([sock], page)
+
+    def unsubscribe_directory(self, sock):
+        info = self.clients.get(sock)
+        query = info.pop("directory", None) if info else None
+        if query is None:
+            return
+        subs = self.directory_subs.get(query)
+        if subs is not None:
+            subs.discard(sock)
+            if not subs:
+                del self.directory_subs[query]
+                self._directory_sent.pop(query, None)
+
+    def update_directory_subscribers(self):
+        """Gửi lại các trang đang được theo dõi mà nội dung đã đổi (gọi trong _presence_lock)."""
+        dead = []
+        for query, subs in list(self.directory_subs.items()):
+            page = self.directory_page(query)
+            last = self._directory_sent.get(query)
+            if last is not None and last["total"] == page.data["total"] \
+                    and last["rooms"] == page.data["rooms"]:
+                continue
+            self._directory_sent[query] = page.data
+            dead += self.send_many(list(subs), page)
+        return dead
+
+    # ------------------ CLUSTER ------------------
+    # Mỗi worker chỉ giữ socket của client kết nối vào nó. Thay đổi cục bộ
+    # được publish lên bus; worker khác áp dụng cho client của mình:
+    #   room / image / pm  - gửi tới thành viên / phiên cục bộ
+    #   history            - thêm vào history trong bộ nhớ (worker chính ghi file)
+    #   room_meta / rename_room / delete_room / kick - registry phòng
+    #   user               - tài khoản mới / mã băm mật khẩu đã nâng cấp
+    #   session            - session token vừa cấp
+    #   state              - user online + thành viên từng phòng của worker,
+    #                        gộp vào presence / số thành viên phòng
+    def start_bus(self):
+        if self.bus_path and not self.bus:
+            self.bus = BusClient(self.bus_path, self.worker_id, self.on_bus).start()
+
+    def publish(self, msg):
+        # entry history gửi đi sau history_store.append: worker chính đã gán
+        # id, standby giữ đúng id đó (cursor before_id còn đúng sau failover)
+        if self.bus:
+            self.bus.publish(msg)
+        if self.replicator:
+            self.replicator.publish(msg)
+
+    def publish_room(self, name, implicit=False):
+        # implicit: phòng tự tạo khi join, không ghi đè phòng worker khác đã có
+        # (create_room ở worker khác có thể chưa kịp tới)
+        room = self.rooms.get(name)
+        if room is not None:
+            self.publish({"op": "room_meta", "room": name, "implicit": implicit,
+                          "meta": {"creator": room["creator"], "password": room["password"]}})
+
+    def publish_state(self):
+        """Publish user online + thành viên phòng của worker này nếu đã đổi (trong _presence_lock)."""
+        rooms = {}
+        for name, room in list(self.rooms.items()):
+            names = [self.clients[s]["username"] for s in list(room["members"]) if s in self.clients]
+            if names:
+                rooms[name] = names
+        state = {"users": list(self.sessions), "rooms": rooms}
+        if state != self._published_local:
+            self._published_local = state
+            self.publish({"op": "state", "w": self.worker_id, **state})
+
+    def online_users(self):
+        if not self.remote:
+            return list(self.sessions)
+        users = dict.fromkeys(self.sessions)
+        for st in list(self.remote.values()):
+            users.update(st["users"])
+        return list(users)
+
+    def remote_online(self, username):
+        return any(username in st["users"] for st in list(self.remote.values()))
+
+    def remote_members(self, room):
+        return sum(len(st["rooms"].get(room, ())) for st in list(self.remote.values()))
+
+    def remote_in_room(self, room, username):
+        return any(username in st["rooms"].get(room, ()) for st in list(self.remote.values()))
+
+    def deliver_private(self, pm):
+        # gửi tới mọi thiết bị của người nhận và của người gửi
+        socks = self.sessions.get(pm["recipient"], set()) | self.sessions.get(pm["sender"], set())
+        for s in socks:
+            self.send(s, pm)
+
+    def apply_room_meta(self, name, meta, implicit=False):
+        room = self.rooms.get(name)
+        if room is not None and implicit:
+            return
+        if room is None:
+            self.rooms[name] = new_room(meta["creator"], meta["password"])
+        else:
+            room["creator"] = meta["creator"]
+            room["password"] = meta["password"]
+            room["is_private"] = meta["password"] != ""
+        self.rooms_changed()
+        self.send_room_list()
+
+    def on_bus(self, msg):
+        """Gói từ worker khác (thread đọc bus); mode asyncio chuyển sang event loop."""
+        if self._loop:
+            try:
+                self._loop.call_soon_threadsafe(self.handle_bus, msg)
+            except RuntimeError:
+                pass
+        else:
+            self.handle_bus(msg)
+
+    def handle_bus(self, msg):
+        op = msg.get("op")
+        room = msg.get("room")
+        if self.replicator and op != "history":
+            # worker chính của cụm chuyển cả thay đổi của worker khác sang
+            # standby; entry history thì sau khi đã được gán id (append_remote)
+            self.replicator.publish(msg)
+        # thao tác của một phòng đi qua shard của phòng như gói từ client
+        if op == "room":
+            self.shards.submit(room, self.deliver_room, room, msg["packet"])
+        elif op == "image":
+            self.shards.submit(room, self.deliver_image, room, msg["packet"])
+        elif op == "history":
+            entry = msg["entry"]
+            self.note_seq(entry["room"], entry.get("seq"))
+            self.shards.submit(entry["room"], self.append_remote, entry)
+        elif op == "pm":
+            self.deliver_private(msg["packet"])
+        elif op == "room_meta":
+            self.shards.submit(room, self.apply_room_meta, room, msg["meta"],
+                               msg.get("implicit", False))
+        elif op == "rename_room":
+            self.shards.submit(room, self.rename_room, room, msg["new_name"],
+                               msg.get("notice", False), False)
+            self.shards.submit(room, self.send_room_list)
+        elif op == "delete_room":
+            self.shards.submit(room, self._delete_room, room, False)
+        elif op == "kick":
+            self.shards.submit(room, self.kick_member, room, msg["target"], False)
+        elif op == "user":
+            self.users.put(msg["username"], msg["record"])
+        elif op == "session":
+            self.tokens.add(msg["digest"], msg["username"], msg["expires"], msg.get("room"))
+        elif op == "state":
+            self.remote[msg["w"]] = {"users": dict.fromkeys(msg["users"]), "rooms": msg["rooms"]}
+            self.remote_changed()
+        elif op == "gone":
+            self.remote.pop(msg["w"], None)
+            self.remote_changed()
+        elif op == "clear_history":
+            self.history_store.clear()
+            self.reset_seqs()
+        elif op == "reset":
+            self.reset_rooms()
+        elif op == "hello":
+            # worker mới: gửi lại registry phòng và trạng thái của mình
+            for name in list(self.rooms):
+                self.publish_room(name)
+            with self._presence_lock:
+                self._published_local = None
+            self.schedule_presence()
+
+    def append_remote(self, entry):
+        """Entry history của worker khác / primary: ghi (worker chính gán id) rồi mới gửi standby."""
+        self.history_store.append(entry)
+        if self.replicator:
+            self.replicator.publish({"op": "history", "entry": entry})
+
+    def remote_changed(self):
+        self.users_version += 1
+        self.rooms_changed()
+        self.schedule_presence()
+
+    # ------------------ REPLICATION ------------------
+    # Standby dùng chung cách áp dụng thay đổi với bus giữa các worker
+    # (handle_bus); riêng snapshot lúc mới nối thì thay toàn bộ trạng thái.
+    def start_replication(self):
+        # chỉ worker chính: nơi duy nhất gán id history và ghi DB
+        if self.replicate_port is None or self.replicator or not self.primary:
+            return
+        try:
+            self.replicator = ReplicationServer(
+                self, self.replicate_host, self.replicate_port).start()
+        except OSError as e:
+            print("REPLICATION không mở được:", e)
+
+    def replication_snapshot(self):
+        rooms = {
+            name: {"creator": r["creator"], "password": r["password"]}
+            for name, r in list(self.rooms.items())
+        }
+        yield {"op": "snapshot", "rooms": rooms, "sessions": self.tokens.export()}
+        users = self.users.items()
+        for i in range(0, len(users), SNAPSHOT_CHUNK):
+            yield {"op": "snapshot_users", "users": dict(users[i:i + SNAPSHOT_CHUNK])}
+        chunk = []
+        for entry in self.history_store.entries():
+            chunk.append(entry)
+            if len(chunk) >= SNAPSHOT_CHUNK:
+                yield {"op": "snapshot_history", "entries": chunk}
+                chunk = []
+        if chunk:
+            yield {"op": "snapshot_history", "entries": chunk}
+
+    def apply_replication(self, msg):
+        op = msg.get("op")
+        if op == "snapshot":
+            self.users.replace(msg.get("users", {}))
+            self.tokens.load(msg.get("sessions", {}))
+            self.reset_rooms(msg["rooms"])
+            self.history_store.clear()
+            self.reset_seqs()
+        elif op == "snapshot_users":
+            self.users.put_many(msg["users"])
+        elif op == "snapshot_history":
+            for entry in msg["entries"]:
+                self.history_store.append(entry)
+        elif op != "ping":
+            self.handle_bus(msg)
 
     # ------------------ HISTORY ------------------
-    def add_history(self, user, msg, room):
+    def add_history(self, user, msg, room, extra=None, seq=None):
         entry = {
             "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             "username": user,
             "message": msg,
             "room": room,
+            "seq": self.next_seq(room) if seq is None else seq,
         }
-        self.history.append(entry)
-        save_history(self.history)
+        if extra:
+            entry.update(extra)
+        self.history_store.append(entry)
+        self.publish({"op": "history", "entry": entry})
         # notify admin UI / logger if present
         try:
             if self.logger:
                 self.logger(f"[{room}] {user}: {msg}")
         except:
             pass
+        return entry
+
+    # ------------------ ROOM SEQ ------------------
+    # Mỗi tin trong phòng (gói chat phát cho thành viên và entry history của
+    # nó) mang "seq" tăng dần theo phòng. Client nhớ seq lớn nhất đã thấy,
+    # khi resume chỉ nhận các entry history có seq lớn hơn. Seq cuối của
+    # phòng đọc lại từ history ở lần dùng đầu, nên tiếp tục sau khởi động lại.
+    # Cụm nhiều worker: seq nhận từ worker khác đẩy bộ đếm lên (kiểu Lamport),
+    # hai tin gửi cùng lúc ở hai worker có thể trùng seq.
+    def _last_seq(self, room):
+        # gọi trong _seq_lock
+        seq = self.room_seqs.get(room)
+        if seq is None:
+            last = self.history_store.recent(room, 1)
+            seq = (last[-1].get("seq") or 0) if last else 0
+            self.room_seqs[room] = seq
+        return seq
+
+    def next_seq(self, room):
+        with self._seq_lock:
+            seq = self._last_seq(room) + 1
+            self.room_seqs[room] = seq
+            return seq
+
+    def note_seq(self, room, seq):
+        if seq is None:
+            return
+        with self._seq_lock:
+            if seq > self._last_seq(room):
+                self.room_seqs[room] = seq
+
+    def reset_seqs(self):
+        with self._seq_lock:
+            self.room_seqs.clear()
+
+    def missed_messages(self, room, after_seq):
+        """
+        Các entry history của phòng có seq > after_seq (cũ -> mới), đọc lùi
+        từng trang từ tin mới nhất. Trả về (entries, đủ chưa) - tối đa
+        RESUME_REPLAY_MAX tin mới nhất.
+        """
+        missed = []
+        before = None
+        while True:
+            page = self.history_store.page(room, before, 100)
+            if not page:
+                return missed[::-1], True
+            for e in reversed(page):
+                if (e.get("seq") or 0) <= after_seq:
+                    return missed[::-1], True
+                missed.append(e)
+                if len(missed) >= RESUME_REPLAY_MAX:
+                    return missed[::-1], False
+            before = page[0]["id"]
 
     # ------------------ ROOM ------------------
-    def broadcast_room(self, room_name, sender, message, mtype="chat"):
+    def post_room(self, room_name, sender, message, extra=None):
+        """
+        Ghi history rồi phát tin vào phòng, cùng một seq; trả về seq. Gói chat
+        mang id của entry history (worker chính gán) để client tải lại được
+        tin đã bỏ khỏi khung chat; worker phụ chưa có id thì gói không có id.
+        """
+        seq = self.next_seq(room_name)
+        entry = self.add_history(sender, message, room_name, extra, seq=seq)
+        self.broadcast_room(room_name, sender, message, seq=seq, msg_id=entry.get("id"))
+        return seq
+
+    def broadcast_room(self, room_name, sender, message, mtype="chat", seq=None, msg_id=None):
         if room_name not in self.rooms:
             return
 
@@ -137,20 +891,183 @@ class ChatServer:
             "room": room_name,
             "timestamp": datetime.now().strftime("%H:%M:%S"),
         }
+        if seq is not None:
+            packet["seq"] = seq
+        if msg_id is not None:
+            packet["id"] = msg_id
+
+        self.deliver_room(room_name, packet)
+        self.publish({"op": "room", "room": room_name, "packet": packet})
+
+    # Registry phòng thuộc về các shard: mọi thay đổi một phòng (tạo, xóa,
+    # thành viên vào / ra, đổi tên) chạy trong shard của phòng đó. Việc chạm
+    # tới phòng khác (vd. đưa thành viên về Phòng chung) được xếp vào shard
+    # của phòng kia bằng shards.submit.
+    def rooms_changed(self):
+        with self._rooms_lock:
+            self.rooms_version += 1
+
+    def current_name(self, room):
+        """Tên hiện tại của phòng đã bị đổi tên sau khi gói được xếp hàng."""
+        for _ in range(len(self._renamed)):
+            if room in self.rooms or room not in self._renamed:
+                break
+            room = self._renamed[room]
+        return room
+
+    def _put_room(self, name, room):
+        self.rooms[name] = room
+        self.rooms_changed()
+
+    def _drop_room(self, name):
+        self.rooms.pop(name, None)
+        self.shards.release(name)
+        self.rooms_changed()
+
+    def reset_rooms(self, rooms=None):
+        """
+        Registry chỉ còn Phòng chung và các phòng trong rooms ({tên: meta}),
+        không còn thành viên (dừng server / standby nhận snapshot). Mỗi phòng
+        được xóa / tạo lại trong shard của nó.
+        """
+        rooms = dict(rooms or {})
+        rooms["Phòng chung"] = {"creator": "SERVER", "password": ""}
+        for name in list(self.rooms):
+            if name not in rooms:
+                self.shards.submit(name, self._drop_room, name)
+        for name, meta in rooms.items():
+            self.shards.submit(name, self._put_room, name,
+                               new_room(meta["creator"], meta["password"]))
+
+    def deliver_room(self, room_name, packet):
+        """Gửi packet tới các thành viên của phòng đang kết nối vào worker này."""
+        room = self.rooms.get(room_name)
+        if room is None:
+            return
+        dead = self.send_many(list(room["members"]), packet)
+        for ds in dead:
+            self.remove_client(ds)
 
-        payload = json.dumps(packet) + "\n"
+    def add_member(self, room_name, sock):
+        room = self.rooms[room_name]
+        info = self.clients.get(sock)
+        if info is None:
+            return  # đã ngắt kết nối
+        username = info["username"]
+        room["members"].add(sock)
+        room["users"].setdefault(username, set()).add(sock)
+        info["room"] = room_name
+        self.rooms_changed()
+        # resume bằng token được vào lại phòng này (kể cả phòng riêng tư)
+        session = getattr(sock, "session", None)
+        if session:
+            item = self.tokens.set_room(session, room_name)
+            if item:
+                self.publish({"op": "session", "digest": session, "username": item[0],
+                              "expires": item[1], "room": room_name})
+
+    def remove_member(self, room_name, sock, username=None):
+        """Gọi trong shard của room_name; username khi client đã bị bỏ khỏi clients."""
+        room = self.rooms.get(room_name)
+        if username is None:
+            info = self.clients.get(sock)
+            username = info and info["username"]
+        if not room or not username:
+            return
+        room["members"].discard(sock)
+        self.rooms_changed()
+        socks = room["users"].get(username)
+        if socks is not None:
+            socks.discard(sock)
+            if not socks:
+                del room["users"][username]
+
+    def move_member(self, sock, room_name):
+        """Gọi trong shard của room_name: vào phòng mới ngay, rời phòng cũ trong shard của phòng cũ."""
+        info = self.clients.get(sock)
+        if info is None:
+            return
+        old = info["room"]
+        self.add_member(room_name, sock)
+        if old and old != room_name:
+            self.shards.submit(old, self.remove_member, old, sock, info["username"])
 
-        dead = []
-        for s in list(self.rooms[room_name]["members"]):
-            try:
-                s.sendall(payload.encode("utf-8"))
-            except:
-                dead.append(s)
+    def send_to_lobby(self, sock, room_name):
+        """Gọi trong shard của room_name: rời phòng ngay, vào Phòng chung trong shard của Phòng chung."""
+        self.remove_member(room_name, sock)
+        self.shards.submit("Phòng chung", self._enter_lobby, sock, room_name)
 
-        for ds in dead:
-            self.remove_client(ds)
+    def _enter_lobby(self, sock, from_room):
+        info = self.clients.get(sock)
+        # bỏ qua nếu đã ngắt kết nối / đã tự vào phòng khác trong lúc chờ
+        if info is not None and info["room"] == from_room:
+            self.add_member("Phòng chung", sock)
+
+    def rename_room(self, room, new_name, notice=False, publish=True):
+        """
+        Gọi trong shard của room; phòng mang tên mới vẫn ở shard này
+        (RoomShards.rename). Trả False nếu tên mới đã có / đang được giữ.
+        """
+        if room not in self.rooms or new_name in self.rooms:
+            return False
+        if not self.shards.rename(room, new_name):
+            return False
+        self.rooms[new_name] = self.rooms.pop(room)
+        self._renamed[room] = new_name
+        self._renamed.pop(new_name, None)
+        self.rooms_changed()
+        self.history_store.rename_room(room, new_name)
+        with self._seq_lock:
+            if room in self.room_seqs:
+                self.room_seqs[new_name] = self.room_seqs.pop(room)
+        if publish:
+            self.publish({"op": "rename_room", "room": room, "new_name": new_name,
+                          "notice": notice})
+
+        # Cập nhật room name cho tất cả members
+        for s in list(self.rooms[new_name]["members"]):
+            if s in self.clients:
+                self.clients[s]["room"] = new_name
+                if notice:
+                    self.send(s, {
+                        "type": "chat",
+                        "sender": "SERVER",
+                        "room": new_name,
+                        "message": f"Phòng đã được đổi tên từ '{room}' thành '{new_name}'",
+                        "timestamp": datetime.now().strftime("%H:%M:%S")
+                    })
+        return True
+
+    def kick_member(self, room, target, publish=True):
+        """Chuyển mọi phiên của target trong phòng về Phòng chung."""
+        if publish:
+            self.publish({"op": "kick", "room": room, "target": target})
+        if room not in self.rooms:
+            return
+        for target_sock in list(self.rooms[room]["users"].get(target, ())):
+            self.send_to_lobby(target_sock, room)
+            self.send(target_sock, {
+                "type": "chat",
+                "sender": "SERVER",
+                "room": room,
+                "message": f"Bạn đã bị xóa khỏi phòng '{room}' bởi quản trị viên!",
+                "timestamp": datetime.now().strftime("%H:%M:%S")
+            })
+            # Gửi thông tin phòng mới cho target
+            self.send(target_sock, {
+                "type": "room_joined",
+                "room": "Phòng chung",
+                "creator": "SERVER",
+                "is_admin": False
+            })
+        self.send_room_list()
 
     def join_room(self, sock, room_name, password=""):
+        # chờ xong mới trả về: gói sau của kết nối (chat...) được xếp vào
+        # shard của phòng mới sau khi đã vào phòng
+        return self.shards.call(room_name, self._join_room, sock, room_name, password)
+
+    def _join_room(self, sock, room_name, password=""):
         info = self.clients.get(sock)
         if not info:
             return
@@ -158,12 +1075,9 @@ class ChatServer:
         username = info["username"]
 
         if room_name not in self.rooms:
-            self.rooms[room_name] = {
-                "creator": username,
-                "password": "",
-                "is_private": False,
-                "members": set(),
-            }
+            self.rooms[room_name] = new_room(username)
+            self.rooms_changed()
+            self.publish_room(room_name, implicit=True)
 
         room = self.rooms[room_name]
 
@@ -171,23 +1085,16 @@ class ChatServer:
             self.send(sock, {"type": "error", "message": "Sai mật khẩu phòng."})
             return
 
-        # rời phòng cũ
-        old = info["room"]
-        if old and old in self.rooms:
-            self.rooms[old]["members"].discard(sock)
-
-        # vào phòng mới
-        room["members"].add(sock)
-        info["room"] = room_name
+        # rời phòng cũ, vào phòng mới
+        self.move_member(sock, room_name)
 
         # gửi history
-        hh = [e for e in self.history if e["room"] == room_name][-50:]
+        hh = self.history_store.recent(room_name, 50)
         self.send(sock, {"type": "history", "room": room_name, "history": hh})
 
         # thông báo join
         msg = f"{username} đã tham gia phòng {room_name}!"
-        self.broadcast_room(room_name, "SERVER", msg)
-        self.add_history("SERVER", msg, room_name)
+        self.post_room(room_name, "SERVER", msg)
 
         # gửi thông tin phòng
         self.send(sock, {
@@ -205,61 +1112,155 @@ class ChatServer:
             pass
 
     # ------------------ AUTH ------------------
-    def handle_auth(self, sock):
+    def handle_auth(self, sock, decoder):
         try:
-            raw = sock.recv(4096).decode("utf-8")
-            line = raw.split("\n", 1)[0]
-            p = json.loads(line)
+            p = decoder.next_packet()
+            while p is None:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    return None
+                decoder.feed(chunk)
+                p = decoder.next_packet()
         except:
             return None
 
+        return self.check_auth(sock, p)
+
+    def check_auth(self, sock, p):
+        """Kiểm tra gói auth (mode thread): chờ KDF ngay trên thread kết nối."""
+        pending = self.begin_auth(sock, p)
+        if pending is None:
+            return None
+        return self.finish_auth(sock, p, *pending)
+
+    def auth_fail(self, sock, reason, message):
+        self.metrics.inc("chat_auth_failures_total", reason=reason)
+        self.send(sock, {"type": "error", "message": message})
+
+    def begin_auth(self, sock, p):
+        """
+        Phần không tốn CPU của auth: kiểm tra gói, rồi đưa việc băm / so mật
+        khẩu vào self.kdf. Trả về (kiểu, Future) cho finish_auth, hoặc None
+        nếu đã từ chối. Đăng nhập bằng session token trả về Future đã xong.
+        """
         if p.get("type") != "auth":
-            self.send(sock, {"type": "error", "message": "Auth lỗi."})
+            self.auth_fail(sock, "bad_packet", "Auth lỗi.")
             return None
 
         username = p.get("username")
         password = p.get("password")
         action = p.get("action")
-        if not username or not password:
-            self.send(sock, {"type": "error", "message": "Thiếu thông tin."})
+        token = p.get("token")
+        if not username or not (password or (token and action in ("login", "resume"))):
+            self.auth_fail(sock, "missing_fields", "Thiếu thông tin.")
             return None
 
-        pw_hash = hash_pw(password)
+        if action in ("login", "resume") and token:
+            if self.tokens.check(token, username):
+                done = Future()
+                done.set_result(None)
+                return "resume" if action == "resume" else "token", done
+            if action == "resume" or not password:
+                self.auth_fail(sock, "bad_token", "Phiên đăng nhập đã hết hạn, vui lòng đăng nhập lại.")
+                return None
 
         if action == "register":
 
             # ----- RÀNG BUỘC USERNAME -----
             if len(username) < 3:
-                self.send(sock, {"type": "error", "message": "Tên đăng nhập phải có ít nhất 3 ký tự."})
+                self.auth_fail(sock, "invalid_username", "Tên đăng nhập phải có ít nhất 3 ký tự.")
                 return None
 
             if not username.isalnum():
-                self.send(sock, {"type": "error", "message": "Tên đăng nhập chỉ được chứa chữ và số."})
+                self.auth_fail(sock, "invalid_username", "Tên đăng nhập chỉ được chứa chữ và số.")
                 return None
 
             # ----- RÀNG BUỘC PASSWORD -----
             if len(password) < 6:
-                self.send(sock, {"type": "error", "message": "Mật khẩu phải có ít nhất 6 ký tự."})
+                self.auth_fail(sock, "weak_password", "Mật khẩu phải có ít nhất 6 ký tự.")
                 return None
 
             if username in self.users:
-                self.send(sock, {"type": "error", "message": "Tên tài khoản đã tồn tại."})
+                self.auth_fail(sock, "user_exists", "Tên tài khoản đã tồn tại.")
                 return None
 
-            # OK → tạo tài khoản
-            self.users[username] = {"password": pw_hash, "avatar": None}
-            save_users(self.users)
-
+            future = self.kdf.submit(hash_password, password)
 
         elif action == "login":
             if username not in self.users:
-                self.send(sock, {"type": "error", "message": "Không có tài khoản."})
+                self.auth_fail(sock, "unknown_user", "Không có tài khoản.")
                 return None
-            if self.users[username]["password"] != pw_hash:
-                self.send(sock, {"type": "error", "message": "Sai mật khẩu."})
+            future = self.kdf.submit(verify_password, password, self.users.get(username)["password"])
+
+        else:
+            self.auth_fail(sock, "bad_packet", "Auth lỗi.")
+            return None
+
+        if future is None:
+            self.auth_fail(sock, "busy", "Server đang bận, vui lòng thử lại.")
+            return None
+        return action, future
+
+    def finish_auth(self, sock, p, kind, future):
+        """Kết quả KDF đã có: tạo / nâng cấp tài khoản, cấp token, gửi auth_ok."""
+        username = p.get("username")
+        try:
+            result = future.result()
+        except Exception as e:
+            print("KDF lỗi:", e)
+            self.auth_fail(sock, "kdf_error", "Auth lỗi.")
+            return None
+
+        if kind == "register":
+            # OK → tạo tài khoản (add kiểm tra lại: hai lần đăng ký trùng tên chạy song song)
+            record = {"password": result, "avatar": None}
+            if not self.users.add(username, record):
+                self.auth_fail(sock, "user_exists", "Tên tài khoản đã tồn tại.")
                 return None
+            self.publish({"op": "user", "username": username, "record": record})
 
-        self.send(sock, {"type": "auth_ok", "username": username})
+        elif kind == "login":
+            ok, new_hash = result
+            if not ok:
+                self.auth_fail(sock, "bad_password", "Sai mật khẩu.")
+                return None
+            if new_hash:
+                # mã băm kiểu cũ: thay bằng scrypt vừa tính
+                record = dict(self.users.get(username), password=new_hash)
+                self.users.put(username, record)
+                self.publish({"op": "user", "username": username, "record": record})
+                self.metrics.inc("chat_password_upgrades_total")
+
+        token = p.get("token") if kind in ("token", "resume") else None
+        if token is None and self.tokens.ttl > 0:
+            token, digest, expires = self.tokens.issue(username)
+            self.publish({"op": "session", "digest": digest,
+                          "username": username, "expires": expires})
+
+        # auth_ok luôn là NDJSON, các gói sau dùng giao thức đã chọn
+        proto = choose_protocol(p.get("protocols"))
+        features = choose_features(p.get("features"))
+        compression = choose_compression(p.get("compression"), proto) if self.deflate_level else None
+        ok_packet = {"type": "auth_ok", "username": username,
+                     "protocol": proto, "features": features,
+                     "server_id": self.server_id}
+        if compression:
+            ok_packet["compression"] = compression
+        if token:
+            ok_packet["token"] = token
+            sock.session = self.tokens.digest(token)
+        if kind == "resume":
+            # register_client đưa về phòng cũ, chỉ gửi phần client đã lỡ
+            ok_packet["resumed"] = True
+            sock.resume = p
+        self.send(sock, ok_packet)
+        sock.protocol = proto
+        sock.features = frozenset(features)
+        if compression:
+            # gói xếp hàng từ đây trở đi được nén (auth_ok thì không)
+            sock.compression = compression
+            sock.deflater = Deflater(self.deflate_level, self.metrics)
+        self.metrics.inc("chat_auth_total", action=kind)
         try:
             if self.logger:
                 self.logger(f"Auth OK: {username}")
@@ -268,20 +1269,49 @@ class ChatServer:
         return username
 
     # ------------------ PACKET PROCESS ------------------
-    def process_packet(self, sock, data):
+    def handle_packet(self, sock, data, size=0):
+        """
+        Chuyển gói tới process_packet, trong shard của phòng nếu gói gắn với
+        một phòng. Metrics: số gói / byte vào và thời gian xử lý theo type.
+        """
+        ptype = data.get("type")
+        if ptype not in PACKET_TYPES:
+            ptype = "other"
+        self.metrics.inc("chat_packets_in_total", type=ptype)
+        self.metrics.inc("chat_bytes_in_total", size, type=ptype)
+        info = self.clients.get(sock)
+        if info and ptype in SHARD_QUEUED_TYPES:
+            # chốt phòng lúc nhận: tin gửi trước khi đổi phòng vẫn vào phòng cũ
+            room = info["room"]
+            self.shards.submit(room, self.run_packet, sock, data, ptype, room)
+        elif info and ptype in SHARD_CALL_TYPES:
+            self.shards.call(data.get("room"), self.run_packet, sock, data, ptype)
+        else:
+            self.run_packet(sock, data, ptype)
+
+    def run_packet(self, sock, data, ptype, room=None):
+        t0 = time.perf_counter()
+        try:
+            self.process_packet(sock, data, room)
+        finally:
+            self.metrics.observe("chat_handler_seconds", time.perf_counter() - t0, type=ptype)
+
+    def process_packet(self, sock, data, room=None):
         msg_type = data.get("type")
         info = self.clients.get(sock)
         if not info:
             return
 
         user = info["username"]
-        room = info["room"]
+        if room is None:
+            room = info["room"]
+        else:
+            room = self.current_name(room)
 
         # CHAT
         if msg_type == "chat":
             msg = data.get("message", "")
-            self.broadcast_room(room, user, msg)
-            self.add_history(user, msg, room)
+            self.post_room(room, user, msg)
             try:
                 if self.logger:
                     self.logger(f"[CHAT] ({room}) {user}: {msg}")
@@ -292,23 +1322,16 @@ class ChatServer:
         elif msg_type == "private":
             to = data.get("to")
             msg = data.get("message", "")
-            for s, inf in self.clients.items():
-                if inf["username"] == to:
-                    self.send(s, {
-                        "type": "private",
-                        "sender": user,
-                        "recipient": to,
-                        "message": msg,
-                        "timestamp": datetime.now().strftime("%H:%M:%S"),
-                    })
-                    self.send(sock, {
-                        "type": "private",
-                        "sender": user,
-                        "recipient": to,
-                        "message": msg,
-                        "timestamp": datetime.now().strftime("%H:%M:%S"),
-                    })
-                    break
+            if to in self.sessions or self.remote_online(to):
+                pm = {
+                    "type": "private",
+                    "sender": user,
+                    "recipient": to,
+                    "message": msg,
+                    "timestamp": datetime.now().strftime("%H:%M:%S"),
+                }
+                self.deliver_private(pm)
+                self.publish({"op": "pm", "packet": pm})
             try:
                 if self.logger:
                     self.logger(f"[PM] {user} -> {to}: {msg}")
@@ -323,12 +1346,9 @@ class ChatServer:
         elif msg_type == "create_room":
             name = data.get("room")
             pw = data.get("password", "")
-            self.rooms[name] = {
-                "creator": user,
-                "password": pw,
-                "is_private": pw != "",
-                "members": set()
-            }
+            self.rooms[name] = new_room(user, pw)
+            self.rooms_changed()
+            self.publish_room(name)
             self.send_room_list()
             try:
                 if self.logger:
@@ -357,17 +1377,14 @@ class ChatServer:
             if new_pw is not None:
                 self.rooms[room]["password"] = new_pw
                 self.rooms[room]["is_private"] = new_pw != ""
+                self.rooms_changed()
+                self.publish_room(room)
 
             # rename
             if new_name and new_name != room:
-                if new_name in self.rooms:
+                if not self.rename_room(room, new_name):
                     self.send(sock, {"type": "error", "message": "Tên phòng mới đã tồn tại."})
                     return
-                self.rooms[new_name] = self.rooms.pop(room)
-                # update members' current room name
-                for s in list(self.rooms[new_name]["members"]):
-                    if s in self.clients:
-                        self.clients[s]["room"] = new_name
 
             self.send_room_list()
             try:
@@ -399,27 +1416,66 @@ class ChatServer:
         # IMAGE
         elif msg_type == "image":
             filename = data.get("filename")
-            b64 = data.get("data")
+            raw = data.get("data")
             caption = data.get("caption", "")
+            if isinstance(raw, str):
+                # client NDJSON gửi base64, frame1 gửi bytes thô
+                try:
+                    raw = base64.b64decode(raw)
+                except:
+                    return
+            if not isinstance(raw, bytes):
+                return
+            if len(raw) > self.uploads.max_size:
+                self.send(sock, {"type": "error", "message": "Ảnh quá lớn."})
+                return
 
-            img_packet = {
-                "type": "image",
-                "sender": user,
-                "room": room,
-                "filename": filename,
-                "data": b64,
-                "caption": caption,
-                "timestamp": datetime.now().strftime("%H:%M:%S"),
-            }
+            blob_id = self.blobs.put_bytes(raw)
+            self.post_image(user, room, filename, blob_id, len(raw), caption)
 
-            # thông báo (dạng tin nhắn text)
-            self.broadcast_room(room, user, f"[ảnh] {filename}")
+        # UPLOAD THEO CHUNK (init -> chunk... -> commit)
+        elif msg_type in ("upload_init", "upload_chunk", "upload_commit"):
+            self.handle_upload(sock, user, room, data)
 
-            # gửi file thật
-            for s in self.rooms[room]["members"]:
-                self.send(s, img_packet)
+        # LẤY NỘI DUNG ẢNH THEO THAM CHIẾU
+        elif msg_type == "fetch_blob":
+            blob_id = data.get("blob")
+            path = self.blobs.path(blob_id)
+            if path is None:
+                self.send(sock, {"type": "error", "message": "Không tìm thấy ảnh."})
+                return
+            self.send_attachment(sock, {"type": "blob", "blob": blob_id,
+                                        "size": os.path.getsize(path)}, path,
+                                 low_priority=False)
+
+        # DANH SÁCH PHÒNG THEO TRANG (room directory)
+        elif msg_type == "list_rooms":
+            self.list_rooms(sock, data)
+
+        # LỊCH SỬ THEO TRANG: limit tin cũ hơn before_id (không có = mới nhất)
+        elif msg_type == "get_history":
+            room = data.get("room") or room
+            before_id = data.get("before_id")
+            try:
+                limit = min(HISTORY_PAGE_MAX, max(1, int(data.get("limit", 50))))
+                before_id = None if before_id is None else int(before_id)
+            except (TypeError, ValueError):
+                self.send(sock, {"type": "error", "message": "Yêu cầu lịch sử không hợp lệ."})
+                return
+            info_room = self.rooms.get(room)
+            if info_room is None:
+                self.send(sock, {"type": "error", "message": "Phòng không tồn tại."})
+                return
+            if info_room["is_private"] and sock not in info_room["members"]:
+                self.send(sock, {"type": "error", "message": "Không có quyền xem lịch sử phòng này."})
+                return
+            hh = self.history_store.page(room, before_id, limit)
+            self.send(sock, {"type": "history", "room": room, "history": hh,
+                             "before_id": before_id, "more": len(hh) == limit})
 
-            self.add_history(user, f"[ảnh] {filename}", room)
+        # XIN LẠI SNAPSHOT PRESENCE (client thấy hụt seq)
+        elif msg_type == "presence_sync":
+            self.send_presence(sock)
 
         # QTV - KICK USER
         elif msg_type == "admin_kick":
@@ -435,43 +1491,17 @@ class ChatServer:
                 self.send(sock, {"type": "error", "message": "Bạn không phải quản trị viên của phòng này."})
                 return
             
-            # Tìm socket của target user
-            target_sock = None
-            for s, inf in self.clients.items():
-                if inf["username"] == target and inf["room"] == room:
-                    target_sock = s
-                    break
-            
-            if not target_sock:
+            # Tìm target trong phòng (kể cả phiên ở worker khác)
+            if target not in self.rooms[room]["users"] and not self.remote_in_room(room, target):
                 self.send(sock, {"type": "error", "message": f"Không tìm thấy '{target}' trong phòng."})
                 return
             
-            # Xóa target từ phòng
-            self.rooms[room]["members"].discard(target_sock)
-            self.clients[target_sock]["room"] = "Phòng chung"
-            
             # Chuyển target về Phòng chung
-            self.rooms["Phòng chung"]["members"].add(target_sock)
-            self.send(target_sock, {
-                "type": "chat",
-                "sender": "SERVER",
-                "room": room,
-                "message": f"Bạn đã bị xóa khỏi phòng '{room}' bởi quản trị viên!",
-                "timestamp": datetime.now().strftime("%H:%M:%S")
-            })
+            self.kick_member(room, target)
             
             # Thông báo tới mọi người trong phòng
             msg = f"{user} đã xóa {target} khỏi phòng!"
-            self.broadcast_room(room, "SERVER", msg)
-            self.add_history("SERVER", msg, room)
-            
-            # Gửi thông tin phòng mới cho target
-            self.send(target_sock, {
-                "type": "room_joined",
-                "room": "Phòng chung",
-                "creator": "SERVER",
-                "is_admin": False
-            })
+            self.post_room(room, "SERVER", msg)
             
             self.broadcast_user_list()
             self.send_room_list()
@@ -499,6 +1529,8 @@ class ChatServer:
             # Thay đổi mật khẩu
             self.rooms[room]["password"] = new_password
             self.rooms[room]["is_private"] = new_password != ""
+            self.rooms_changed()
+            self.publish_room(room)
             
             # Thông báo tới mọi người trong phòng
             if new_password:
@@ -506,8 +1538,7 @@ class ChatServer:
             else:
                 msg = f"{user} đã xóa mật khẩu của phòng (phòng công khai)."
             
-            self.broadcast_room(room, "SERVER", msg)
-            self.add_history("SERVER", msg, room)
+            self.post_room(room, "SERVER", msg)
             self.send_room_list()
             
             try:
@@ -534,25 +1565,11 @@ class ChatServer:
                 self.send(sock, {"type": "error", "message": "Tên phòng mới không hợp lệ."})
                 return
             
-            if new_name in self.rooms:
+            # Thay đổi tên phòng, báo cho mọi thành viên
+            if not self.rename_room(room, new_name, notice=True):
                 self.send(sock, {"type": "error", "message": "Tên phòng mới đã tồn tại."})
                 return
             
-            # Thay đổi tên phòng
-            self.rooms[new_name] = self.rooms.pop(room)
-            
-            # Cập nhật room name cho tất cả members
-            for s in list(self.rooms[new_name]["members"]):
-                if s in self.clients:
-                    self.clients[s]["room"] = new_name
-                    self.send(s, {
-                        "type": "chat",
-                        "sender": "SERVER",
-                        "room": new_name,
-                        "message": f"Phòng đã được đổi tên từ '{room}' thành '{new_name}'",
-                        "timestamp": datetime.now().strftime("%H:%M:%S")
-                    })
-            
             self.send_room_list()
             
             try:
@@ -561,34 +1578,206 @@ class ChatServer:
             except:
                 pass
 
+    # ------------------ IMAGE / UPLOAD ------------------
+    def post_image(self, user, room, filename, blob_id, size, caption=""):
+        if room not in self.rooms:
+            return
+        img_packet = {
+            "type": "image",
+            "sender": user,
+            "room": room,
+            "filename": filename,
+            "blob": blob_id,
+            "size": size,
+            "caption": caption,
+            "timestamp": datetime.now().strftime("%H:%M:%S"),
+        }
+
+        # thông báo (dạng tin nhắn text) + history; gói ảnh mang cùng seq
+        img_packet["seq"] = self.post_room(room, user, f"[ảnh] {filename}",
+                                           {"blob": blob_id, "filename": filename})
+        self.deliver_image(room, img_packet)
+        self.publish({"op": "image", "room": room, "packet": img_packet})
+
+    def deliver_image(self, room, img_packet):
+        # client hỗ trợ "blob" chỉ nhận tham chiếu và tự fetch_blob khi xem;
+        # client cũ nhận cả file, đọc từ đĩa khi gửi
+        if room not in self.rooms:
+            return
+        members = list(self.rooms[room]["members"])
+        by_ref = [s for s in members if "blob" in s.features]
+        dead = self.send_many(by_ref, img_packet)
+        path = self.blobs.path(img_packet["blob"])
+        if path is not None:
+            for s in members:
+                if "blob" not in s.features:
+                    self.send_attachment(s, img_packet, path)
+        for ds in dead:
+            self.remove_client(ds)
+
+    def handle_upload(self, sock, user, room, data):
+        msg_type = data.get("type")
+        upload_id = data.get("upload_id")
+        try:
+            if msg_type == "upload_init":
+                offset = self.uploads.init(user, upload_id, data.get("filename"),
+                                           data.get("size"), data.get("sha256"))
+                if offset is None:
+                    self.send(sock, {"type": "upload_done", "upload_id": upload_id})
+                else:
+                    self.send(sock, {"type": "upload_ready", "upload_id": upload_id, "offset": offset})
+
+            elif msg_type == "upload_chunk":
+                chunk = data.get("data")
+                if isinstance(chunk, str):
+                    chunk = base64.b64decode(chunk)
+                if not isinstance(chunk, bytes):
+                    raise UploadError("Chunk không hợp lệ.")
+                self.uploads.chunk(user, upload_id, data.get("offset"), chunk, data.get("crc32"))
+
+            elif msg_type == "upload_commit":
+                meta, path = self.uploads.commit(user, upload_id)
+                self.send(sock, {"type": "upload_done", "upload_id": upload_id})
+                if path is None:
+                    return
+                blob_id = self.blobs.put_file(path, meta["sha256"])
+                self.uploads.finish(user, upload_id)
+                self.shards.submit(room, self.post_image, user, room, meta["filename"],
+                                   blob_id, meta["size"], data.get("caption", ""))
+
+        except UploadError as e:
+            self.send(sock, {
+                "type": "upload_error",
+                "upload_id": upload_id,
+                "stage": msg_type,
+                "offset": e.offset,
+                "message": e.message,
+            })
+        except Exception as e:
+            self.send(sock, {
+                "type": "upload_error",
+                "upload_id": upload_id,
+                "stage": msg_type,
+                "offset": 0,
+                "message": f"Lỗi upload: {e}",
+            })
+
     # ------------------ HANDLE CLIENT ------------------
-    def handle_client(self, sock, addr):
-        username = self.handle_auth(sock)
+    def handle_client(self, raw_sock, addr):
+        sock = ClientConnection(raw_sock, self.outbound_queue, self.overflow_policy)
+        decoder = LineDecoder()
+        username = self.handle_auth(sock, decoder)
         if not username:
-            try:
-                sock.close()
-            except:
-                pass
+            sock.close()
+            return
+
+        self.register_client(sock, username)
+
+        try:
+            decoder = make_decoder(sock.protocol, decoder.buffer, sock.compression)
+            while True:
+                before = len(decoder.buffer)
+                data = decoder.next_packet()
+                while data is not None:
+                    after = len(decoder.buffer)
+                    self.handle_packet(sock, data, before - after)
+                    before = after
+                    data = decoder.next_packet()
+
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                decoder.feed(chunk)
+
+        except:
+            pass
+
+        self.remove_client(sock)
+
+    def register_client(self, sock, username):
+        """Đưa client vừa auth xong vào Phòng chung (resume: phòng cũ) và gửi dữ liệu ban đầu."""
+        if sock.resume:
+            room = sock.resume.get("room")
+            info = self.rooms.get(room)
+            if info is None or (info["is_private"] and self.tokens.room_of(sock.session) != room):
+                room = "Phòng chung"
+            if not self.shards.call(room, self._resume_client, sock, username, room):
+                # phòng vừa bị xóa trước khi tới lượt: vào lại Phòng chung
+                self.shards.call("Phòng chung", self._resume_client, sock, username, "Phòng chung")
             return
+        self.shards.call("Phòng chung", self._register_client, sock, username)
+
+    def _resume_client(self, sock, username, room_name):
+        """
+        Client kết nối lại bằng session token (auth action "resume"): vào lại
+        phòng cũ, nhận delta presence và các tin đã lỡ (seq lớn hơn seq client
+        gửi lên) thay vì snapshot + 50 tin như lúc đăng nhập. False nếu
+        phòng đã bị xóa trước khi tới lượt.
+        """
+        resume = sock.resume
+        room = self.rooms.get(room_name)
+        if room is None:
+            return False
+        print(f"[SERVER] {username} resumed ({room_name})")
+
+        self.clients[sock] = {"username": username, "room": None}
+        if username not in self.sessions:
+            self.sessions[username] = set()
+            self.users_version += 1
+        self.sessions[username].add(sock)
+        self.add_member(room_name, sock)
+
+        self.resume_presence(sock, resume.get("presence_seq"), resume.get("server_id"))
+        self.broadcast_user_list()
+        self.send_room_list()
+
+        seqs = resume.get("rooms")
+        after = seqs.get(room_name) if isinstance(seqs, dict) else None
+        with self._seq_lock:
+            last = self._last_seq(room_name)
+        if room_name == resume.get("room") and isinstance(after, int) and after <= last:
+            hh, complete = self.missed_messages(room_name, after)
+            self.send(sock, {"type": "history", "room": room_name, "history": hh,
+                             "after_seq": after, "complete": complete})
+        else:
+            # phòng khác phòng client đang xem, hoặc history đã bị xóa
+            hh = self.history_store.recent(room_name, 50)
+            self.send(sock, {"type": "history", "room": room_name, "history": hh})
+
+        self.send(sock, {
+            "type": "room_joined",
+            "room": room_name,
+            "creator": room["creator"],
+            "is_admin": username == room["creator"],
+            "resumed": True,
+        })
+        self.post_room(room_name, "SERVER", f"{username} đã kết nối lại!")
+        sock.resume = None
+        return True
 
+    def _register_client(self, sock, username):
         print(f"[SERVER] {username} connected")
 
         # thêm vào danh sách online
-        self.clients[sock] = {"username": username, "room": "Phòng chung"}
-        self.rooms["Phòng chung"]["members"].add(sock)
-
-        # gửi danh sách user + phòng
+        self.clients[sock] = {"username": username, "room": None}
+        if username not in self.sessions:
+            self.sessions[username] = set()
+            self.users_version += 1
+        self.sessions[username].add(sock)
+        self.add_member("Phòng chung", sock)
+
+        # gửi danh sách user + phòng cho người mới, báo thay đổi cho mọi người
+        self.send_presence(sock)
         self.broadcast_user_list()
         self.send_room_list()
 
         # gửi lịch sử phòng chung
-        hh = [e for e in self.history if e["room"] == "Phòng chung"][-50:]
+        hh = self.history_store.recent("Phòng chung", 50)
         self.send(sock, {"type": "history", "room": "Phòng chung", "history": hh})
 
         # thông báo join
         join_msg = f"{username} đã tham gia phòng Phòng chung!"
-        self.broadcast_room("Phòng chung", "SERVER", join_msg)
-        self.add_history("SERVER", join_msg, "Phòng chung")
+        self.post_room("Phòng chung", "SERVER", join_msg)
 
         # gửi room_joined
         self.send(sock, {
@@ -598,30 +1787,6 @@ class ChatServer:
             "is_admin": False
         })
 
-        buffer = ""
-        try:
-            while True:
-                chunk = sock.recv(4096)
-                if not chunk:
-                    break
-                buffer += chunk.decode("utf-8")
-
-                while "\n" in buffer:
-                    line, buffer = buffer.split("\n", 1)
-                    line = line.strip()
-                    if not line:
-                        continue
-                    try:
-                        data = json.loads(line)
-                    except:
-                        continue
-                    self.process_packet(sock, data)
-
-        except:
-            pass
-
-        self.remove_client(sock)
-
     # ------------------ REMOVE CLIENT ------------------
     def remove_client(self, sock):
         if sock not in self.clients:
@@ -631,12 +1796,20 @@ class ChatServer:
         room = self.clients[sock]["room"]
 
         if room in self.rooms:
-            self.rooms[room]["members"].discard(sock)
-            msg = f"{username} đã rời phòng {room}!"
-            self.broadcast_room(room, "SERVER", msg)
-            self.add_history("SERVER", msg, room)
+            # remove_client có thể chạy ngay trong một shard (gửi lỗi khi
+            # broadcast) nên chỉ xếp việc vào shard của phòng, không chờ
+            self.shards.submit(room, self.remove_member, room, sock, username)
+            self.shards.submit(room, self.announce_leave, username, room)
 
+        with self._presence_lock:
+            self.unsubscribe_directory(sock)
         del self.clients[sock]
+        socks = self.sessions.get(username)
+        if socks is not None:
+            socks.discard(sock)
+            if not socks:
+                del self.sessions[username]
+                self.users_version += 1
 
         try:
             sock.close()
@@ -646,13 +1819,44 @@ class ChatServer:
         self.broadcast_user_list()
         self.send_room_list()
 
+    def announce_leave(self, username, room):
+        msg = f"{username} đã rời phòng {room}!"
+        self.post_room(room, "SERVER", msg)
+
     # ------------------ RUN ------------------
+    def setup_shards(self):
+        """
+        Số shard theo self.mode hiện tại: thread -> room_shards, asyncio -> 0
+        (chạy ngay trên event loop, shards.call không chặn loop). Nếu khác
+        lúc __init__ thì dừng shard cũ và chuyển các phòng sang registry mới.
+        """
+        n = self.room_shards if self.mode == "thread" else 0
+        if self.shards.n == n:
+            return
+        rooms = self.rooms.items()
+        self.shards.close()
+        self.shards = RoomShards(n)
+        self.rooms = RoomRegistry(self.shards)
+        for name, room in rooms:
+            self.rooms[name] = room
+
     def start(self):
+        self.setup_shards()
+        self.start_metrics()
+        if self.mode == "asyncio":
+            self.start_asyncio()
+            return
+
+        self.start_bus()
+        self.start_replication()
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.bus_path:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         # set timeout so we can stop cleanly
         self.server_socket.settimeout(1.0)
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(20)
+        self.server_socket.listen(self.backlog)
         self.running = True
 
         print(f"SERVER RUNNING: {self.host}:{self.port}")
@@ -668,16 +1872,55 @@ class ChatServer:
 
         print("SERVER STOPPED")
 
+    def start_asyncio(self):
+        self.start_bus()
+        self.start_replication()
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.bus_path:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(self.backlog)
+        self.server_socket.setblocking(False)
+        self.running = True
+
+        print(f"SERVER RUNNING (asyncio): {self.host}:{self.port}")
+        asyncio.run(self._serve_asyncio())
+        self._loop = None
+        print("SERVER STOPPED")
+
+    async def _serve_asyncio(self):
+        self._loop = asyncio.get_running_loop()
+        self._async_stop = asyncio.Event()
+        srv = await self._loop.create_server(
+            lambda: _AsyncClientProtocol(self),
+            sock=self.server_socket,
+        )
+        # stop() có thể được gọi trước khi loop kịp chạy
+        if self.running:
+            await self._async_stop.wait()
+        srv.close()
+
     def start_in_thread(self):
         threading.Thread(target=self.start, daemon=True).start()
 
     def stop(self):
         self.running = False
-        try:
-            if self.server_socket:
-                self.server_socket.close()
-        except:
-            pass
+        if self.metrics_server:
+            self.metrics_server.stop()
+            self.metrics_server = None
+        if self._loop:
+            # server socket thuộc về event loop, để loop tự đóng
+            try:
+                self._loop.call_soon_threadsafe(self._async_stop.set)
+            except RuntimeError:
+                pass
+        else:
+            try:
+                if self.server_socket:
+                    self.server_socket.close()
+            except:
+                pass
         # disconnect clients
         for s in list(self.clients.keys()):
             try:
@@ -686,24 +1929,28 @@ class ChatServer:
                 pass
         self.clients.clear()
         # reset rooms to only common room
-        self.rooms = {
-            "Phòng chung": {
-                "creator": "SERVER",
-                "password": "",
-                "is_private": False,
-                "members": set(),
-            }
-        }
-        self.broadcast_user_list()
-        self.send_room_list()
+        self.sessions.clear()
+        self.reset_rooms()
+        self.users_version += 1
+        self.publish({"op": "reset"})
+        with self._presence_lock:
+            self._published_users = {}
+            self._published_rooms = {}
+            self._presence_scheduled = False
+            self.directory_subs.clear()
+            self._directory_sent.clear()
         print("SERVER: stopped and clients disconnected")
 
     def clear_history(self):
-        self.history = []
-        save_history(self.history)
+        self.history_store.clear()
+        self.reset_seqs()
+        self.publish({"op": "clear_history"})
         print("SERVER: history cleared")
 
     def delete_room(self, room_name: str):
+        return self.shards.call(room_name, self._delete_room, room_name)
+
+    def _delete_room(self, room_name, publish=True):
         if room_name == "Phòng chung":
             return False
         if room_name not in self.rooms:
@@ -713,13 +1960,20 @@ class ChatServer:
             try:
                 self.send(s, {"type": "info", "message": f"Phòng {room_name} đã bị xóa, chuyển về Phòng chung"})
                 # move to common room
-                self.rooms["Phòng chung"]["members"].add(s)
                 if s in self.clients:
-                    self.clients[s]["room"] = "Phòng chung"
+                    self.send_to_lobby(s, room_name)
             except:
                 pass
         del self.rooms[room_name]
-        self.add_history("SERVER", f"Phòng {room_name} bị xóa bởi quản trị viên.", "Phòng chung")
+        self.shards.release(room_name)
+        self.rooms_changed()
+        self.history_store.delete_room(room_name)
+        with self._seq_lock:
+            self.room_seqs.pop(room_name, None)
+        if publish:
+            self.publish({"op": "delete_room", "room": room_name})
+            self.shards.submit("Phòng chung", self.add_history, "SERVER",
+                               f"Phòng {room_name} bị xóa bởi quản trị viên.", "Phòng chung")
         self.send_room_list()
         return True
 
@@ -729,8 +1983,442 @@ class ChatServer:
         return None
 
 
+# ===================== CONNECTION =====================
+def send_region(sock, region):
+    """Gửi FileRegion ra socket blocking; dùng os.sendfile khi không cần base64."""
+    if region.b64:
+        for block in region.iter_blocks():
+            sock.sendall(block)
+        return
+    with open(region.path, "rb") as f:
+        offset, remaining = region.offset, region.count
+        while remaining > 0:
+            sent = os.sendfile(sock.fileno(), f.fileno(), offset, remaining)
+            if sent == 0:
+                raise OSError("file ngắn hơn dự kiến")
+            offset += sent
+            remaining -= sent
+
+
+class ClientConnection:
+    """
+    Socket của một client ở mode="thread". Mọi gói gửi đi vào một hàng đợi
+    có giới hạn và được một thread writer riêng gửi bằng sendall, nên client
+    đọc chậm không chặn thread của người gửi hay các thành viên khác.
+    Một gói là bytes, hoặc tuple các phần (bytes / FileRegion) được gửi liền
+    nhau và không bao giờ bị bỏ một nửa.
+    """
+
+    def __init__(self, sock, max_queue=1000, policy="drop_oldest"):
+        self.sock = sock
+        self.protocol = NDJSON
+        self.features = frozenset()
+        self.session = None  # sha256 session token (auth_ok)
+        self.resume = None   # gói auth "resume", register_client dùng rồi bỏ
+        self.compression = None
+        self.deflater = None  # Deflater khi client chọn nén "deflate"
+        self.max_queue = max_queue
+        self.policy = policy
+        self.dropped = 0
+        self.closed = False
+        self._closing = False
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._writer = threading.Thread(target=self._run, daemon=True)
+        self._writer.start()
+
+    def recv(self, n):
+        return self.sock.recv(n)
+
+    def send_bytes(self, data, low_priority=False):
+        with self._cond:
+            if self.closed or self._closing:
+                raise OSError("connection closed")
+            # deflater chốt lúc xếp hàng: gói bị bỏ khỏi hàng đợi chưa đi
+            # qua compressobj nên luồng nén không hỏng
+            dropped = push_bounded(self._queue, (data, low_priority, self.deflater),
+                                   self.max_queue, self.policy)
+            if dropped is None:
+                overflow = True
+            else:
+                overflow = False
+                self.dropped += dropped
+                self._cond.notify()
+        if overflow:
+            self.abort()
+            raise ConnectionError("outbound queue overflow")
+
+    def queue_depth(self):
+        return len(self._queue)
+
+    def close(self):
+        """Đóng sau khi gửi hết các gói còn trong hàng đợi."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+
+    def abort(self):
+        """Đóng ngay, bỏ các gói chưa gửi."""
+        with self._cond:
+            self.closed = True
+            self._queue.clear()
+            self._cond.notify()
+        try:
+            # shutdown đánh thức sendall đang bị chặn ở thread writer
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closing and not self.closed:
+                    self._cond.wait()
+                if self.closed or not self._queue:
+                    break
+                data, _, deflater = self._queue.popleft()
+            try:
+                if deflater is not None and not isinstance(data, tuple):
+                    self.sock.sendall(deflater.packet(data))
+                elif isinstance(data, tuple):
+                    for part in data:
+                        if isinstance(part, FileRegion):
+                            if deflater is not None:
+                                for block in part.iter_blocks():
+                                    self.sock.sendall(deflater.compress(block))
+                            else:
+                                send_region(self.sock, part)
+                        else:
+                            self.sock.sendall(deflater.compress(part) if deflater else part)
+                    if deflater is not None:
+                        self.sock.sendall(deflater.flush())
+                else:
+                    self.sock.sendall(data)
+            except OSError:
+                break
+        self.abort()
+
+
+# ===================== ASYNCIO =====================
+class _AsyncClientConnection:
+    """
+    Bọc transport của asyncio để phần còn lại của server dùng giống
+    ClientConnection: send_bytes(), close(), queue_depth(). Khi buffer của
+    transport vượt ngưỡng (pause_writing) hoặc đang gửi file, gói mới vào
+    hàng đợi có giới hạn với cùng overflow policy. Gọi từ thread khác
+    (vd. GUI quản lý) thì chuyển về event loop qua call_soon_threadsafe.
+    """
+
+    def __init__(self, transport, loop, max_queue=1000, policy="drop_oldest"):
+        self.transport = transport
+        self.protocol = NDJSON
+        self.features = frozenset()
+        self.session = None
+        self.resume = None
+        self.compression = None
+        self.deflater = None
+        self.loop = loop
+        self.max_queue = max_queue
+        self.policy = policy
+        self.dropped = 0
+        self.closed = False
+        self.paused = False
+        self._busy = False      # đang gửi FileRegion, transport không được ghi chen
+        self._closing = False
+        self._queue = deque()
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self._loop_thread = threading.get_ident()
+
+    def send_bytes(self, data, low_priority=False):
+        if self.closed or self._closing:
+            raise OSError("connection closed")
+        if threading.get_ident() == self._loop_thread:
+            self._write(data, low_priority)
+        else:
+            if isinstance(data, bytearray):
+                data = bytes(data)
+            self.loop.call_soon_threadsafe(self._write, data, low_priority, False)
+
+    def _write(self, data, low_priority, raise_on_overflow=True):
+        if self.closed:
+            return
+        if not self.paused and not self._busy and not self._queue:
+            self._emit(data, self.deflater)
+            return
+        dropped = push_bounded(self._queue, (data, low_priority, self.deflater),
+                               self.max_queue, self.policy)
+        if dropped is None:
+            self.abort()
+            if raise_on_overflow:
+                raise ConnectionError("outbound queue overflow")
+            return
+        self.dropped += dropped
+
+    def _emit(self, data, deflater=None):
+        if not isinstance(data, tuple):
+            self.transport.write(deflater.packet(data) if deflater else data)
+            return
+        parts = list(data)
+        while parts and not isinstance(parts[0], FileRegion):
+            part = parts.pop(0)
+            self.transport.write(deflater.compress(part) if deflater else part)
+        if parts:
+            self._busy = True
+            self.loop.create_task(self._send_parts(parts, deflater))
+        elif deflater:
+            self.transport.write(deflater.flush())
+
+    async def _send_parts(self, parts, deflater=None):
+        try:
+            for part in parts:
+                if not isinstance(part, FileRegion):
+                    self.transport.write(deflater.compress(part) if deflater else part)
+                elif part.b64:
+                    for block in part.iter_blocks():
+                        await self._writable.wait()
+                        if self.closed:
+                            return
+                        self.transport.write(deflater.compress(block) if deflater else block)
+                else:
+                    await self._writable.wait()
+                    with open(part.path, "rb") as f:
+                        await self.loop.sendfile(self.transport, f, part.offset, part.count)
+            if deflater:
+                self.transport.write(deflater.flush())
+        except Exception:
+            self.abort()
+            return
+        finally:
+            self._busy = False
+        self._flush()
+
+    def _flush(self):
+        while self._queue and not self.paused and not self._busy and not self.closed:
+            data, _, deflater = self._queue.popleft()
+            self._emit(data, deflater)
+        if self._closing and not self._queue and not self._busy and not self.closed:
+            self.closed = True
+            self.transport.close()
+
+    def pause(self):
+        self.paused = True
+        self._writable.clear()
+
+    def resume(self):
+        self.paused = False
+        self._writable.set()
+        self._flush()
+
+    def queue_depth(self):
+        return len(self._queue)
+
+    def close(self):
+        if self.closed:
+            return
+        if threading.get_ident() == self._loop_thread:
+            self._close()
+        else:
+            self.loop.call_soon_threadsafe(self._close)
+
+    def _close(self):
+        # gói còn trong hàng đợi vẫn được ghi nốt trước khi đóng
+        self._closing = True
+        self.paused = False
+        self._flush()
+
+    def abort(self):
+        self.closed = True
+        self._queue.clear()
+        self._writable.set()
+        self.transport.abort()
+
+
+class _AsyncClientProtocol(asyncio.Protocol):
+    """Một kết nối: gói đầu tiên là auth (NDJSON), các gói sau vào process_packet."""
+
+    def __init__(self, server):
+        self.server = server
+        self.conn = None
+        self.transport = None
+        self.username = None
+        self.authing = False  # đang chờ KDF, gói sau nằm yên trong decoder
+        self.decoder = LineDecoder()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.conn = _AsyncClientConnection(
+            transport, asyncio.get_running_loop(),
+            self.server.outbound_queue, self.server.overflow_policy,
+        )
+
+    def pause_writing(self):
+        self.conn.pause()
+
+    def resume_writing(self):
+        self.conn.resume()
+
+    def data_received(self, data):
+        try:
+            self.decoder.feed(data)
+        except ProtocolError:
+            self.conn.abort()
+            return
+        while not self.conn.closed and not self.authing:
+            before = len(self.decoder.buffer)
+            try:
+                packet = self.decoder.next_packet()
+            except ProtocolError:
+                self.conn.abort()
+                return
+            if packet is None:
+                return
+
+            if self.username is None:
+                pending = self.server.begin_auth(self.conn, packet)
+                if pending is None:
+                    self.conn.close()
+                    return
+                kind, future = pending
+                if not future.done():
+                    # KDF chạy trong pool, không chặn event loop
+                    self.authing = True
+                    self.transport.pause_reading()
+                    loop = asyncio.get_running_loop()
+                    future.add_done_callback(lambda f: loop.call_soon_threadsafe(
+                        self.auth_done, packet, kind, f))
+                    return
+                if not self.finish_auth(packet, kind, future):
+                    return
+            else:
+                self.server.handle_packet(self.conn, packet, before - len(self.decoder.buffer))
+
+    def finish_auth(self, packet, kind, future):
+        username = self.server.finish_auth(self.conn, packet, kind, future)
+        if not username:
+            self.conn.close()
+            return False
+        try:
+            self.decoder = make_decoder(self.conn.protocol, self.decoder.buffer,
+                                        self.conn.compression)
+        except ProtocolError:
+            self.conn.abort()
+            return False
+        self.username = username
+        self.server.register_client(self.conn, username)
+        return True
+
+    def auth_done(self, packet, kind, future):
+        self.authing = False
+        if self.conn.closed:
+            return
+        if self.finish_auth(packet, kind, future):
+            self.transport.resume_reading()
+            # gói client gửi ngay sau auth đang chờ trong decoder
+            self.data_received(b"")
+
+    def connection_lost(self, exc):
+        self.conn.closed = True
+        if self.username is not None:
+            self.server.remove_client(self.conn)
+
+
 if __name__ == "__main__":
-    server = ChatServer()
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Chat server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument("--mode", choices=ChatServer.MODES, default="thread")
+    parser.add_argument("--backlog", type=int, default=20)
+    parser.add_argument("--history-fsync", choices=("batch", "interval", "never"),
+                        default="interval")
+    parser.add_argument("--history-flush-interval", type=float, default=0.05)
+    parser.add_argument("--history-backend", choices=HISTORY_BACKENDS, default="sqlite")
+    parser.add_argument("--history-retention", type=int, default=None,
+                        help="số tin giữ lại cho mỗi phòng (mặc định: sqlite giữ hết, jsonl 500)")
+    parser.add_argument("--room-retention", action="append", default=[], metavar="PHÒNG=N",
+                        help="số tin giữ lại cho một phòng, lặp lại cho nhiều phòng")
+    parser.add_argument("--outbound-queue", type=int, default=1000,
+                        help="số gói tối đa chờ gửi cho mỗi client")
+    parser.add_argument("--overflow-policy", choices=OVERFLOW_POLICIES,
+                        default="drop_oldest")
+    parser.add_argument("--max-upload-mb", type=float, default=DEFAULT_MAX_UPLOAD / (1024 * 1024))
+    parser.add_argument("--presence-interval", type=float, default=0.05,
+                        help="giây gom thay đổi online / phòng trước khi phát (0 = phát ngay)")
+    parser.add_argument("--room-shards", type=int, default=4,
+                        help="số thread worker chia nhau các phòng (mode thread; 0 = chạy ngay trên thread kết nối)")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="mở /metrics (Prometheus) và /metrics.json trên cổng này")
+    parser.add_argument("--metrics-host", default="127.0.0.1")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="số worker process chung cổng (SO_REUSEPORT, luôn headless); "
+                             "mỗi worker mở metrics ở --metrics-port + id worker")
+    parser.add_argument("--worker-id", type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument("--bus", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--replicate-port", type=int, default=None,
+                        help="mở cổng cho warm standby nhận stream thay đổi")
+    parser.add_argument("--replicate-host", default="127.0.0.1")
+    parser.add_argument("--standby-of", metavar="HOST:PORT", default=None,
+                        help="chạy làm standby của primary này, nhận cổng khi primary mất")
+    parser.add_argument("--failover-timeout", type=float, default=3.0,
+                        help="giây không nhận gì từ primary thì coi là mất")
+    parser.add_argument("--kdf-workers", type=int, default=None,
+                        help="số thread băm mật khẩu (mặc định số CPU)")
+    parser.add_argument("--session-ttl", type=float, default=SESSION_TTL,
+                        help="giây session token còn hiệu lực (0 = không cấp token)")
+    parser.add_argument("--deflate-level", type=int, default=DEFLATE_LEVEL,
+                        help="mức nén zlib cho client ndjson đề nghị deflate (0 = không nén)")
+    parser.add_argument("--headless", action="store_true",
+                        help="chạy không có giao diện quản lý (Tk)")
+    args = parser.parse_args()
+
+    if args.workers > 1 and not args.bus:
+        run_cluster(args.workers, sys.argv[1:])
+        sys.exit(0)
+    if args.bus and args.metrics_port:
+        args.metrics_port += args.worker_id
+
+    server = ChatServer(host=args.host, port=args.port,
+                        mode=args.mode, backlog=args.backlog,
+                        history_fsync=args.history_fsync,
+                        history_flush_interval=args.history_flush_interval,
+                        history_retention=args.history_retention,
+                        room_retention={
+                            r.rpartition("=")[0]: int(r.rpartition("=")[2])
+                            for r in args.room_retention
+                        },
+                        history_backend=args.history_backend,
+                        outbound_queue=args.outbound_queue,
+                        overflow_policy=args.overflow_policy,
+                        max_upload_size=int(args.max_upload_mb * 1024 * 1024),
+                        metrics_host=args.metrics_host,
+                        metrics_port=args.metrics_port,
+                        presence_interval=args.presence_interval,
+                        room_shards=args.room_shards,
+                        worker_id=args.worker_id,
+                        bus_path=args.bus,
+                        replicate_host=args.replicate_host,
+                        replicate_port=args.replicate_port,
+                        kdf_workers=args.kdf_workers,
+                        session_ttl=args.session_ttl,
+                        deflate_level=args.deflate_level)
+
+    if args.standby_of:
+        host, _, port = args.standby_of.rpartition(":")
+        StandbyClient(server, host, int(port), args.failover_timeout).run()
+
+    if args.headless:
+        try:
+            server.start()
+        except KeyboardInterrupt:
+            server.stop()
+        raise SystemExit(0)
 
     root = tk.Tk()
     root.title("Chat Server - Quản lý")
@@ -749,6 +2437,10 @@ if __name__ == "__main__":
     port_entry.insert(0, str(server.port))
     port_entry.pack(side=tk.LEFT, padx=(0, 6))
 
+    tk.Label(top, text="Mode:").pack(side=tk.LEFT)
+    mode_var = tk.StringVar(value=server.mode)
+    tk.OptionMenu(top, mode_var, *ChatServer.MODES).pack(side=tk.LEFT, padx=(0, 6))
+
     status_label = tk.Label(top, text="Stopped", fg="red")
     status_label.pack(side=tk.LEFT, padx=(6, 6))
 
@@ -775,8 +2467,9 @@ if __name__ == "__main__":
             return
         server.host = h
         server.port = p
+        server.mode = mode_var.get()
         server.start_in_thread()
-        status_label.config(text=f"Running: {server.host}:{server.port}", fg="green")
+        status_label.config(text=f"Running: {server.host}:{server.port} ({server.mode})", fg="green")
         log(f"Server starting on {server.host}:{server.port}")
 
     def stop_server():
@@ -812,7 +2505,7 @@ if __name__ == "__main__":
             cur_user_sel = None
             user_sel = users_list.curselection()
             if user_sel:
-                cur_user_sel = users_list.get(user_sel[0])
+                cur_user_sel = users_list.get(user_sel[0]).split(" (q=", 1)[0]
         except:
             cur_user_sel = None
 
@@ -826,15 +2519,16 @@ if __name__ == "__main__":
 
         # users
         users_list.delete(0, tk.END)
-        for info in server.clients.values():
-            users_list.insert(tk.END, info.get("username"))
+        for s, info in list(server.clients.items()):
+            # độ sâu hàng đợi gửi + số gói đã bỏ vì client đọc chậm
+            users_list.insert(tk.END, f"{info.get('username')} (q={s.queue_depth()}, drop={s.dropped})")
 
         # restore user selection if possible
         if cur_user_sel:
             try:
                 idx = None
                 for i in range(users_list.size()):
-                    if users_list.get(i) == cur_user_sel:
+                    if users_list.get(i).split(" (q=", 1)[0] == cur_user_sel:
                         idx = i
                         break
                 if idx is not None:
@@ -5,18 +5,41 @@ from datetime import datetime
 import base64
 import os
 import io
+import hashlib
+import queue
+import random
+import time
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog, filedialog, scrolledtext
 
 from PIL import Image, ImageTk
 from login_ui import LoginDialog
-
+from protocol import (COMPRESSIONS, FEATURES, NDJSON, PROTOCOLS, UPLOAD_CHUNK_SIZE,
+                      Deflater, LineDecoder, encode_packet, make_decoder)
+
+HISTORY_PAGE = 50  # số tin mỗi lần tải thêm lịch sử khi cuộn lên đầu
+RECONNECT_MIN = 0.5  # giây chờ trước lần kết nối lại đầu tiên, gấp đôi mỗi lần hỏng
+RECONNECT_MAX = 30.0
+UI_QUEUE_MAX = 10000  # sự kiện chờ thread Tk; đầy thì thread nhận chờ (TCP tự giảm tốc)
+UI_BATCH_MAX = 500    # sự kiện xử lý mỗi lần pump
+UI_PUMP_MS = 30       # chu kỳ pump khi hàng đợi rỗng
+TRANSCRIPT_MAX_LINES = 2000   # số dòng tối đa vẽ trong khung chat
+TRANSCRIPT_MODEL_MAX = 10000  # số entry tối đa giữ trong bộ nhớ, cũ hơn thì tải lại từ server
+TRANSCRIPT_PAGE = 100         # số entry vẽ lại mỗi lần cuộn tới mép phần đang vẽ
+THUMB_SIZE = (240, 240)             # kích thước tối đa ảnh hiện trong khung chat
+THUMB_CACHE_BYTES = 32 * 1024 * 1024  # tổng pixel (byte) ảnh thu nhỏ giữ trong cache
+IMAGE_WORKERS = 2                   # thread giải mã ảnh
 
 # ================== BACKEND CLIENT ==================
 class ChatClient:
     """
-    Client TCP nói chuyện với server bằng JSON (NDJSON).
+    Client TCP nói chuyện với server bằng JSON (NDJSON, có thể nén deflate),
+    hoặc frame nhị phân (frame1) nếu server hỗ trợ - thỏa thuận lúc auth.
     Không phụ thuộc Tkinter, chỉ gọi callback cho GUI.
     """
 
@@ -29,34 +52,91 @@ class ChatClient:
         self.connected = False
         self.receive_thread = None
 
+        # giao thức đề nghị lúc auth / giao thức server đã chọn
+        self.protocols = list(PROTOCOLS)
+        self.protocol = NDJSON
+        self.send_lock = threading.Lock()
+        # tính năng tùy chọn đề nghị lúc auth / server đã bật
+        self.features = list(FEATURES)
+        self.server_features = set()
+        # nén đề nghị lúc auth / server đã chọn (chỉ khi giao thức là ndjson)
+        self.compressions = list(COMPRESSIONS)
+        self.compression = None
+        self.deflater = None
+
+        # presence: danh sách online / phòng giữ ở client, cập nhật theo delta
+        self.presence_seq = None
+        self.online_users = {}  # username -> None, giữ thứ tự
+        self.rooms = {}         # tên phòng -> summary
+
+        # room directory: trang danh sách phòng đang xem (server gửi lại khi đổi)
+        self.room_query = {"prefix": "", "visibility": "all", "sort": "name",
+                           "offset": 0, "limit": 50}
+
         # callback dùng cho GUI
         self.message_callback = None
         self.user_list_callback = None
         self.room_list_callback = None
+        # delta presence cho GUI sửa danh sách tại chỗ; không đặt thì GUI
+        # nhận lại toàn bộ danh sách qua user_list_callback / room_list_callback
+        self.user_delta_callback = None
+        self.room_delta_callback = None
+        self.room_page_callback = None
         self.room_joined_callback = None
         self.image_callback = None
+        self.blob_callback = None
         self.chat_event_callback = None
         self.history_callback = None
+        # trang lịch sử cũ hơn (get_history có before_id) - GUI chèn lên đầu
+        self.older_history_callback = None
         self.receive_thread = None
 
+        # token server cấp sau khi đăng nhập, dùng để kết nối lại không cần mật khẩu
+        self.session_token = None
+        # resume: phòng đang ở, seq tin lớn nhất đã thấy theo phòng, server_id
+        # của server đã cấp seq presence
+        self.room = None
+        self.room_seqs = {}
+        self.server_id = None
+        self.closing = False  # close() chủ động - không tự kết nối lại
+        self.auth_refused = False  # server từ chối auth (khác với lỗi mạng)
+        # reconnect_callback(True) khi đã resume, (False) khi token bị từ chối
+        self.reconnect_callback = None
+        # tin đã lỡ khi mất kết nối: missed_history_callback(room, entries, complete)
+        self.missed_history_callback = None
+
         # lưu lỗi lần connect gần nhất
         self.last_error = ""
 
+        # upload theo chunk: upload_id -> job, còn giữ tới khi server xác nhận
+        self.pending_uploads = {}
+        self._upload_replies = {}  # upload_id -> queue.Queue các gói trả lời
+
     # ---------- tiện ích ----------
     def send_packet(self, data: dict) -> bool:
         if not self.connected or not self.client_socket:
             return False
         try:
-            payload = json.dumps(data) + "\n"
-            self.client_socket.sendall(payload.encode("utf-8"))
+            payload = encode_packet(data, self.protocol)
+            with self.send_lock:
+                if self.deflater:
+                    payload = self.deflater.packet(payload)
+                self.client_socket.sendall(payload)
             return True
         except Exception as e:
             print("send_packet error:", e)
             return False
 
     # ---------- kết nối / đăng nhập ----------
-    def connect(self, username: str, password: str, action: str, log_cb) -> bool:
+    def connect(self, username: str, password: str, action: str, log_cb, token=None) -> bool:
+        """
+        Đăng nhập / đăng ký. token: session token server cấp ở lần đăng nhập
+        trước (self.session_token) - server bỏ qua bước băm mật khẩu.
+        action="resume": kết nối lại phiên cũ bằng token, gửi kèm phòng, seq
+        tin cuối theo phòng và seq presence để server chỉ gửi phần đã lỡ.
+        """
         self.last_error = ""  # reset lỗi cũ
+        self.auth_refused = False
         try:
             self.username = username
             self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -67,34 +147,42 @@ class ChatClient:
                 "action": action,
                 "username": username,
                 "password": password,
+                "protocols": self.protocols,
+                "features": self.features,
+                "compression": self.compressions,
             }
-            payload = json.dumps(auth_packet) + "\n"
-            self.client_socket.sendall(payload.encode("utf-8"))
-
-            # đọc auth_ok
-            buffer = ""
-            while True:
-                chunk = self.client_socket.recv(4096).decode("utf-8")
+            if token:
+                auth_packet["token"] = token
+            if action == "resume":
+                auth_packet.update({
+                    "room": self.room,
+                    "rooms": dict(self.room_seqs),
+                    "presence_seq": self.presence_seq,
+                    "server_id": self.server_id,
+                })
+            else:
+                self.presence_seq = None
+            self.protocol = NDJSON
+            self.compression = None
+            self.deflater = None
+            self.client_socket.sendall(encode_packet(auth_packet))
+
+            # đọc auth_ok (luôn là một dòng JSON)
+            decoder = LineDecoder()
+            data = None
+            while data is None:
+                chunk = self.client_socket.recv(4096)
                 if not chunk:
                     self.last_error = "Mất kết nối khi chờ phản hồi đăng nhập."
                     log_cb("[LỖI] Mất kết nối khi chờ phản hồi đăng nhập.\n", "error")
                     return False
-                buffer += chunk
-                if "\n" in buffer:
-                    line, rest = buffer.split("\n", 1)
-                    line = line.strip()
-                    break
-
-            try:
-                data = json.loads(line)
-            except:
-                self.last_error = "Phản hồi đăng nhập không hợp lệ."
-                log_cb("[LỖI] Phản hồi đăng nhập không hợp lệ.\n", "error")
-                return False
+                decoder.feed(chunk)
+                data = decoder.next_packet()
 
             if data.get("type") == "error":
                 msg = data.get("message", "Đăng nhập / đăng ký thất bại.")
                 self.last_error = msg
+                self.auth_refused = True
                 log_cb(f"[LỖI] {msg}\n", "error")
                 return False
 
@@ -103,15 +191,34 @@ class ChatClient:
                 log_cb("[LỖI] Phản hồi đăng nhập không hợp lệ.\n", "error")
                 return False
 
+            # sau auth_ok mọi byte hai chiều là luồng deflate của kết nối này
+            # (đặt trước connected để send_packet không gửi gói chưa nén)
+            self.compression = data.get("compression")
+            if self.compression:
+                self.deflater = Deflater()
             self.connected = True
+            self.protocol = data.get("protocol", NDJSON)
+            self.server_features = set(data.get("features", []))
+            self.session_token = data.get("token")
+            if not data.get("resumed"):
+                self.presence_seq = None
+            self.server_id = data.get("server_id")
+            self.closing = False
 
             # bắt đầu luồng nhận
             self.receive_thread = threading.Thread(
                 target=self.receive_loop,
-                args=(rest,),
+                args=(make_decoder(self.protocol, decoder.buffer, self.compression),),
                 daemon=True,
             )
             self.receive_thread.start()
+
+            # server có room directory: lấy trang phòng thay cho room_list
+            if "directory" in self.server_features:
+                self.list_rooms()
+
+            # gửi tiếp các upload dở dang từ kết nối trước
+            self.resume_uploads()
             return True
 
         except Exception as e:
@@ -120,36 +227,79 @@ class ChatClient:
             return False
 
     # ---------- nhận dữ liệu ----------
-    def receive_loop(self, initial_buffer=""):
-        buffer = initial_buffer or ""
+    def receive_loop(self, decoder):
         while self.connected:
             try:
-                while "\n" in buffer:
-                    line, buffer = buffer.split("\n", 1)
-                    line = line.strip()
-                    if not line:
-                        continue
-                    try:
-                        data = json.loads(line)
-                    except:
-                        continue
+                data = decoder.next_packet()
+                while data is not None:
                     self.handle_packet(data)
+                    data = decoder.next_packet()
 
-                chunk = self.client_socket.recv(4096).decode("utf-8")
+                chunk = self.client_socket.recv(65536)
                 if not chunk:
                     if self.message_callback:
                         self.message_callback("[SYSTEM] Mất kết nối.\n", "error")
                     self.connected = False
                     break
-                buffer += chunk
+                decoder.feed(chunk)
 
             except:
                 self.connected = False
                 break
 
+        # đánh thức các upload đang chờ trả lời, chúng sẽ được gửi tiếp sau
+        for replies in list(self._upload_replies.values()):
+            replies.put(None)
+
+        if not self.closing and self.session_token:
+            threading.Thread(target=self.reconnect_loop, daemon=True).start()
+
+    def reconnect_loop(self):
+        """Kết nối lại bằng session token, chờ lùi dần (có jitter) giữa các lần thử."""
+        def log(txt, tag="system"):
+            if self.message_callback:
+                self.message_callback(txt, tag)
+
+        delay = RECONNECT_MIN
+        while not self.closing and not self.connected:
+            wait = delay * random.uniform(0.5, 1.5)
+            log(f"[SYSTEM] Kết nối lại sau {wait:.1f}s...\n")
+            time.sleep(wait)
+            if self.closing:
+                return
+            if self.connect(self.username, None, "resume", lambda *a: None,
+                            token=self.session_token):
+                log("[SYSTEM] Đã kết nối lại.\n")
+                if self.reconnect_callback:
+                    self.reconnect_callback(True)
+                return
+            if self.auth_refused:
+                # token hết hạn / server không nhận: phải đăng nhập lại
+                self.session_token = None
+                log(f"[SYSTEM] Không resume được: {self.last_error}\n", "error")
+                if self.reconnect_callback:
+                    self.reconnect_callback(False)
+                return
+            delay = min(delay * 2, RECONNECT_MAX)
+
+    def close(self):
+        """Ngắt kết nối chủ động (không tự kết nối lại)."""
+        self.closing = True
+        self.connected = False
+        try:
+            self.client_socket.close()
+        except:
+            pass
+
+    def note_seq(self, room, seq):
+        if room and isinstance(seq, int) and seq > self.room_seqs.get(room, 0):
+            self.room_seqs[room] = seq
+
     # ---------- xử lý packet ----------
     def handle_packet(self, data):
         msg_type = data.get("type")
+        if "seq" in data and msg_type in ("chat", "image"):
+            self.note_seq(data.get("room"), data["seq"])
 
         def log(txt, tag="system"):
             if self.message_callback:
@@ -172,7 +322,10 @@ class ChatClient:
                 line = f"[{ts}] ({room}) {sender}: {msg}\n"
                 tag = "other"
 
-            log(line, tag)
+            # id của entry history (nếu server gửi): GUI tải lại được tin này
+            # sau khi nó bị bỏ khỏi model khung chat
+            if self.message_callback:
+                self.message_callback(line, tag, data.get("id"))
 
         # PM
         elif msg_type == "private":
@@ -194,7 +347,29 @@ class ChatClient:
             if self.room_list_callback:
                 self.room_list_callback(data.get("rooms", []))
 
+        # PRESENCE: snapshot + delta theo seq
+        elif msg_type == "presence":
+            self.presence_seq = data.get("seq", 0)
+            self.online_users = dict.fromkeys(data.get("users", []))
+            if self.user_list_callback:
+                self.user_list_callback(list(self.online_users))
+            if "rooms" in data:
+                self.rooms = {r["name"]: r for r in data["rooms"]}
+                if self.room_list_callback:
+                    self.room_list_callback(list(self.rooms.values()))
+
+        elif msg_type == "presence_delta":
+            self.apply_presence_delta(data)
+
+        # TRANG DANH SÁCH PHÒNG (room directory)
+        elif msg_type == "room_page":
+            if self.room_page_callback:
+                self.room_page_callback(data)
+            elif self.room_list_callback:
+                self.room_list_callback(data.get("rooms", []))
+
         elif msg_type == "room_joined":
+            self.room = data.get("room")
             if self.room_joined_callback:
                 self.room_joined_callback(
                     data.get("room"),
@@ -203,10 +378,31 @@ class ChatClient:
                 )
 
         elif msg_type == "history":
-            if self.history_callback:
+            history = data.get("history", [])
+            for e in history:
+                self.note_seq(data.get("room"), e.get("seq"))
+            # lịch sử đẩy lúc join không có "more": coi như còn nếu chưa rỗng
+            more = data.get("more", bool(history))
+            if "after_seq" in data:
+                # resume: các tin đã lỡ, nối vào sau phần đang hiển thị
+                if self.missed_history_callback:
+                    self.missed_history_callback(
+                        data.get("room", "Phòng chung"),
+                        history,
+                        data.get("complete", True),
+                    )
+            elif data.get("before_id") is not None and self.older_history_callback:
+                self.older_history_callback(
+                    data.get("room", "Phòng chung"),
+                    history,
+                    data["before_id"],
+                    more,
+                )
+            elif self.history_callback:
                 self.history_callback(
                     data.get("room", "Phòng chung"),
-                    data.get("history", []),
+                    history,
+                    more,
                 )
 
         # ẢNH
@@ -214,6 +410,52 @@ class ChatClient:
             if self.image_callback:
                 self.image_callback(data)
 
+        # NỘI DUNG ẢNH (trả lời fetch_blob)
+        elif msg_type == "blob":
+            if self.blob_callback:
+                self.blob_callback(data.get("blob"), data.get("data"))
+
+        elif msg_type in ("upload_ready", "upload_done", "upload_error"):
+            replies = self._upload_replies.get(data.get("upload_id"))
+            if replies:
+                replies.put(data)
+
+    def apply_presence_delta(self, data):
+        seq = data.get("seq", 0)
+        if self.presence_seq is None or seq <= self.presence_seq:
+            return  # chưa có snapshot, hoặc delta đã nằm trong snapshot
+        if seq != self.presence_seq + 1:
+            # hụt delta (vd. hàng đợi gửi của server bị đầy): xin snapshot mới
+            self.presence_seq = None
+            self.send_packet({"type": "presence_sync"})
+            return
+        self.presence_seq = seq
+
+        joined = data.get("user_joined", [])
+        left = data.get("user_left", [])
+        for u in left:
+            self.online_users.pop(u, None)
+        for u in joined:
+            self.online_users[u] = None
+
+        updated = data.get("room_updated", [])
+        removed = data.get("room_removed", [])
+        for name in removed:
+            self.rooms.pop(name, None)
+        for r in updated:
+            self.rooms[r["name"]] = r
+
+        if joined or left:
+            if self.user_delta_callback:
+                self.user_delta_callback(joined, left)
+            elif self.user_list_callback:
+                self.user_list_callback(list(self.online_users))
+        if updated or removed:
+            if self.room_delta_callback:
+                self.room_delta_callback(updated, removed)
+            elif self.room_list_callback:
+                self.room_list_callback(list(self.rooms.values()))
+
     # ---------- Gửi ----------
     def send_chat(self, message: str, room: str = None):
         data = {"type": "chat", "message": message}
@@ -221,11 +463,134 @@ class ChatClient:
             data["room"] = room
         return self.send_packet(data)
 
+    # ---------- Upload theo chunk ----------
+    def upload_file(self, path, caption=""):
+        """
+        Gửi file theo từng chunk ở thread riêng, xen kẽ với tin nhắn thường.
+        Chỉ đọc từng chunk nên RAM không phụ thuộc kích thước file. Nếu mất
+        kết nối giữa chừng, job được giữ lại và connect() sẽ gửi tiếp.
+        """
+        upload_id = uuid.uuid4().hex
+        self.pending_uploads[upload_id] = {"path": path, "caption": caption, "running": False}
+        self._start_upload(upload_id)
+        return upload_id
+
+    def resume_uploads(self):
+        for upload_id in list(self.pending_uploads):
+            self._start_upload(upload_id)
+
+    def _start_upload(self, upload_id):
+        job = self.pending_uploads.get(upload_id)
+        if not job or job["running"]:
+            return
+        job["running"] = True
+        threading.Thread(target=self._upload_worker, args=(upload_id, job), daemon=True).start()
+
+    def _upload_request(self, upload_id, packet, stage, timeout=30):
+        """Gửi packet rồi chờ trả lời của server cho đúng bước (stage)."""
+        replies = self._upload_replies[upload_id]
+        if not self.send_packet(packet):
+            return None
+        while True:
+            try:
+                reply = replies.get(timeout=timeout)
+            except queue.Empty:
+                return None
+            if reply is None:
+                return None  # mất kết nối
+            # bỏ qua lỗi của các chunk gửi trước đó
+            if reply["type"] == "upload_error" and reply.get("stage") != stage:
+                continue
+            return reply
+
+    def _upload_worker(self, upload_id, job):
+        self._upload_replies[upload_id] = queue.Queue()
+        try:
+            path = job["path"]
+            if "sha256" not in job:
+                h = hashlib.sha256()
+                with open(path, "rb") as f:
+                    for block in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+                        h.update(block)
+                job["size"] = os.path.getsize(path)
+                job["sha256"] = h.hexdigest()
+            filename = os.path.basename(path)
+
+            reply = self._upload_request(upload_id, {
+                "type": "upload_init",
+                "upload_id": upload_id,
+                "filename": filename,
+                "size": job["size"],
+                "sha256": job["sha256"],
+            }, "upload_init")
+            if reply is None:
+                return  # mất kết nối, chờ resume
+            if reply["type"] == "upload_error":
+                raise IOError(reply.get("message"))
+            if reply["type"] == "upload_done":
+                # đã commit ở kết nối trước, chỉ là chưa nhận được xác nhận
+                self.pending_uploads.pop(upload_id, None)
+                return
+            offset = reply.get("offset", 0)
+
+            for _ in range(3):
+                with open(path, "rb") as f:
+                    f.seek(offset)
+                    while offset < job["size"]:
+                        chunk = f.read(UPLOAD_CHUNK_SIZE)
+                        if not chunk:
+                            raise IOError("File bị thay đổi khi đang gửi.")
+                        ok = self.send_packet({
+                            "type": "upload_chunk",
+                            "upload_id": upload_id,
+                            "offset": offset,
+                            "data": chunk,
+                            "crc32": zlib.crc32(chunk),
+                        })
+                        if not ok:
+                            return
+                        offset += len(chunk)
+
+                reply = self._upload_request(upload_id, {
+                    "type": "upload_commit",
+                    "upload_id": upload_id,
+                    "caption": job["caption"],
+                }, "upload_commit")
+                if reply is None:
+                    return
+                if reply["type"] == "upload_done":
+                    self.pending_uploads.pop(upload_id, None)
+                    return
+                # server báo thiếu / sai dữ liệu: gửi lại từ offset server giữ
+                offset = reply.get("offset", 0)
+
+            raise IOError(reply.get("message", "Upload thất bại."))
+
+        except Exception as e:
+            self.pending_uploads.pop(upload_id, None)
+            if self.message_callback:
+                self.message_callback(f"[LỖI] Gửi file thất bại: {e}\n", "error")
+        finally:
+            self._upload_replies.pop(upload_id, None)
+            job["running"] = False
+
+    def list_rooms(self, **query):
+        """Xem một trang phòng; server gửi lại trang này mỗi khi nó thay đổi."""
+        self.room_query.update(query)
+        return self.send_packet(dict(self.room_query, type="list_rooms"))
+
+    def fetch_blob(self, blob_id):
+        """Xin nội dung ảnh theo tham chiếu; kết quả về qua blob_callback."""
+        return self.send_packet({"type": "fetch_blob", "blob": blob_id})
+
     def send_private(self, target, message):
         return self.send_packet({"type": "private", "to": target, "message": message})
 
-    def request_history(self, room):
-        return self.send_packet({"type": "get_history", "room": room})
+    def request_history(self, room, before_id=None, limit=HISTORY_PAGE):
+        packet = {"type": "get_history", "room": room, "limit": limit}
+        if before_id is not None:
+            packet["before_id"] = before_id
+        return self.send_packet(packet)
 
     def create_room(self, name, password=""):
         return self.send_packet({
@@ -261,8 +626,97 @@ class ChatClient:
 
 
 # ================== GUI ==================
+class UIQueue:
+    """
+    Hàng đợi sự kiện từ các thread mạng sang thread Tk (Tk không cho gọi
+    widget từ thread khác). put() từ thread khác chờ khi đầy; put() từ
+    thread Tk (thread tạo hàng đợi) không bao giờ chờ vì chính thread đó
+    mới rút hàng đợi.
+    """
+
+    def __init__(self, max_size=UI_QUEUE_MAX):
+        self.max_size = max_size
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._tk_thread = threading.get_ident()
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        with self._cond:
+            if threading.get_ident() != self._tk_thread:
+                while len(self._items) >= self.max_size:
+                    self._cond.wait()
+            self._items.append(item)
+
+    def take(self, n):
+        with self._cond:
+            batch = [self._items.popleft() for _ in range(min(n, len(self._items)))]
+            self._cond.notify_all()
+        return batch
+
+
+class ThumbnailCache:
+    """
+    LRU ảnh thu nhỏ (PIL.Image) theo sha256 nội dung file ảnh, giới hạn theo
+    tổng số byte pixel. Dùng chung giữa thread giải mã và thread Tk.
+    """
+
+    def __init__(self, max_bytes=THUMB_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()  # digest -> (ảnh, số byte)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, digest):
+        with self._lock:
+            item = self._items.get(digest)
+            if item is None:
+                return None
+            self._items.move_to_end(digest)
+            return item[0]
+
+    def put(self, digest, img):
+        nbytes = img.width * img.height * len(img.getbands())
+        with self._lock:
+            old = self._items.pop(digest, None)
+            if old is not None:
+                self.size -= old[1]
+            self._items[digest] = (img, nbytes)
+            self.size += nbytes
+            # luôn giữ ảnh vừa thêm, kể cả khi riêng nó đã quá max_bytes
+            while self.size > self.max_bytes and len(self._items) > 1:
+                _, (_, n) = self._items.popitem(last=False)
+                self.size -= n
+
+
+def decode_thumbnail(raw, cache):
+    """
+    Giải mã + thu nhỏ ảnh (bytes hoặc base64) vào cache, trả về digest.
+    Chạy trên thread của pool: không chạm tới Tk.
+    """
+    if isinstance(raw, str):
+        raw = base64.b64decode(raw)
+    digest = hashlib.sha256(raw).hexdigest()
+    if cache.get(digest) is None:
+        img = Image.open(io.BytesIO(raw))
+        img.thumbnail(THUMB_SIZE)
+        img.load()
+        cache.put(digest, img)
+    return digest
+
+
 class ClientGUI:
-    def __init__(self):
+    """
+    max_lines: số dòng tối đa vẽ trong khung chat; phần cũ hơn bị cắt khỏi
+    widget (giữ trong model, vẽ lại khi cuộn lên).
+    """
+
+    def __init__(self, max_lines=TRANSCRIPT_MAX_LINES):
         self.root = tk.Tk()
         self.root.title("Cute Chat")
         self.root.geometry("1100x650")
@@ -274,9 +728,33 @@ class ClientGUI:
         self.current_room_creator = None
         self.current_is_admin = False
 
-        self._img_refs = []  # giữ ảnh tránh GC
+        self._blob_marks = {}  # blob id -> các (mark, tag link, entry) chờ chèn ảnh khi tải xong
+        self._blob_digests = {}  # blob id -> digest ảnh thu nhỏ trong _thumbs
+        self._link_seq = 0
+        # giải mã / thu nhỏ ảnh trên pool, thread Tk chỉ tạo PhotoImage
+        self._thumbs = ThumbnailCache()
+        self._image_pool = ThreadPoolExecutor(IMAGE_WORKERS, thread_name_prefix="image")
+        self._room_total = 0  # tổng số phòng khớp bộ lọc (room directory)
+        # cuộn ngược lịch sử: id tin cũ nhất đang hiện, server còn tin cũ hơn
+        # không, và có trang nào đang chờ (không gửi trùng)
+        self._oldest_id = None
+        self._history_more = False
+        self._history_loading = False
+
+        # callback của ChatClient chạy trên thread nhận: chỉ đưa sự kiện vào
+        # hàng đợi, pump_ui trên thread Tk xử lý theo lô
+        self._ui_queue = UIQueue()
+        self._scroll_end = False  # lô hiện tại có thêm tin cuối khung chat
+
+        # khung chat: model các entry, chỉ vẽ đoạn [_lo, _hi) (xem TRANSCRIPT)
+        self.max_lines = max_lines
+        self._transcript = []
+        self._lo = self._hi = 0
+        self._rendered_lines = 0
+        self._rematerialize_pending = False
 
         self.build_layout()
+        self.root.after(UI_PUMP_MS, self.pump_ui)
         self.do_login()
 
     # ---------- UI ----------
@@ -320,10 +798,25 @@ class ClientGUI:
                   bg="#9b59b6", fg="white").pack(fill="x", padx=12, pady=8)
 
         tk.Label(left, text="Phòng chat", bg="#f0f2f5").pack(anchor="w", padx=14)
+        self.room_search = tk.Entry(left)
+        self.room_search.pack(fill="x", padx=12, pady=(0, 4))
+        self.room_search.bind("<KeyRelease>", self.on_room_search)
         self.room_list = tk.Listbox(left, bg="white")
         self.room_list.pack(fill="x", padx=12)
         self.room_list.bind("<<ListboxSelect>>", self.on_room_click)
 
+        pager = tk.Frame(left, bg="#f0f2f5")
+        pager.pack(fill="x", padx=12)
+        tk.Button(pager, text="◀", command=lambda: self.page_rooms(-1)).pack(side="left")
+        tk.Button(pager, text="▶", command=lambda: self.page_rooms(1)).pack(side="left")
+        self.room_sort = tk.StringVar(value="name")
+        tk.Checkbutton(pager, text="Đông nhất", bg="#f0f2f5",
+                       variable=self.room_sort, onvalue="members", offvalue="name",
+                       command=lambda: self.client.list_rooms(sort=self.room_sort.get(), offset=0)
+                       ).pack(side="left", padx=4)
+        self.room_page_label = tk.Label(pager, text="", bg="#f0f2f5")
+        self.room_page_label.pack(side="right")
+
         tk.Label(left, text="Người online", bg="#f0f2f5").pack(anchor="w", padx=14, pady=(8, 2))
         self.user_list = tk.Listbox(left, bg="white")
         self.user_list.pack(fill="both", expand=True, padx=12)
@@ -356,6 +849,8 @@ class ClientGUI:
                                                    bg="#dfe3ee", font=("Segoe UI", 10))
         self.chat_text.grid(row=1, column=0, sticky="nsew", padx=8, pady=8)
         self.chat_text.config(state="disabled")
+        # cuộn tới đầu thì tải trang lịch sử cũ hơn
+        self.chat_text.config(yscrollcommand=self.on_chat_scroll)
 
         self.chat_text.tag_config("self",
             foreground="white",
@@ -436,16 +931,23 @@ class ClientGUI:
         self.client.host = host
         self.client.port = port
 
-        # đăng ký callback TRƯỚC connect
-        self.client.message_callback = self.display_message
-        self.client.user_list_callback = self.update_user_list
-        self.client.room_list_callback = self.update_room_list
-        self.client.room_joined_callback = self.on_room_joined
-        self.client.chat_event_callback = self.on_chat_event
-        self.client.history_callback = self.show_history
-        self.client.image_callback = self.show_image  # NEW
-
-        ok = self.client.connect(user, pw, action, self.display_message)
+        # đăng ký callback TRƯỚC connect (mọi callback đi qua hàng đợi UI)
+        self.client.message_callback = self.post_text
+        self.client.user_list_callback = self.ui_call(self.update_user_list, "users", full=True)
+        self.client.room_list_callback = self.ui_call(self.update_room_list, "rooms", full=True)
+        self.client.user_delta_callback = self.ui_call(self.apply_user_delta, "users")
+        self.client.room_delta_callback = self.ui_call(self.apply_room_delta, "rooms")
+        self.client.room_page_callback = self.ui_call(self.show_room_page, "rooms", full=True)
+        self.client.room_joined_callback = self.ui_call(self.on_room_joined)
+        self.client.chat_event_callback = self.ui_call(self.on_chat_event)
+        self.client.history_callback = self.ui_call(self.show_history)
+        self.client.older_history_callback = self.ui_call(self.prepend_history)
+        self.client.missed_history_callback = self.ui_call(self.append_history)
+        self.client.reconnect_callback = self.ui_call(self.on_reconnect)
+        self.client.image_callback = self.ui_call(self.show_image)  # NEW
+        self.client.blob_callback = self.ui_call(self.on_blob)
+
+        ok = self.client.connect(user, pw, action, self.post_text)
         if not ok:
             msg = self.client.last_error or "Sai thông tin hoặc không thỏa điều kiện.\nVui lòng đăng ký lại."
             messagebox.showerror("Lỗi đăng nhập / đăng ký", msg)
@@ -458,79 +960,487 @@ class ClientGUI:
         # cập nhật title cửa sổ cho dễ nhìn
         self.root.title(f"Cute Chat - {user}")
 
-    # ---------- CALLBACK ----------
-    def display_message(self, text, tag="other"):
+    # ---------- HÀNG ĐỢI UI ----------
+    def post_text(self, text, tag="other", msg_id=None):
+        """Thêm một dòng vào khung chat (gọi được từ mọi thread); msg_id: id history của tin chat."""
+        self._ui_queue.put(("text", None, None, (text, tag, msg_id)))
+
+    def ui_call(self, fn, key=None, full=False):
+        """
+        Callback gọi được từ mọi thread: fn(*args) chạy trên thread Tk.
+        key: danh sách fn sửa ("users" / "rooms"); full=True là bản đầy đủ,
+        thay cho mọi sự kiện cùng key đứng trước nó trong cùng một lô.
+        """
+        kind = "full" if full else "call"
+        return lambda *args: self._ui_queue.put((kind, key, fn, args))
+
+    def pump_ui(self):
+        batch = self._ui_queue.take(UI_BATCH_MAX)
+        if batch:
+            self.run_ui_batch(batch)
+        # còn việc thì chạy tiếp ngay sau khi Tk xử lý sự kiện của nó
+        self.root.after(1 if len(self._ui_queue) else UI_PUMP_MS, self.pump_ui)
+
+    def run_ui_batch(self, batch):
+        """
+        Một lô sự kiện: chat_text mở ghi một lần, các dòng chữ liền nhau
+        chèn bằng một lệnh insert, danh sách chỉ vẽ bản đầy đủ cuối cùng
+        (và các delta sau nó), cuộn xuống cuối một lần.
+        """
+        last_full = {key: i for i, (kind, key, _, _) in enumerate(batch) if kind == "full"}
+        texts = []  # entry "text" liền nhau chờ chèn
+        self._scroll_end = False
         self.chat_text.config(state="normal")
-        self.chat_text.insert("end", text, tag)
-        self.chat_text.config(state="disabled")
-        self.chat_text.see("end")
+        try:
+            for i, (kind, key, fn, args) in enumerate(batch):
+                if key is not None and i < last_full.get(key, -1):
+                    continue
+                if kind == "text":
+                    text, tag, msg_id = args
+                    texts.append(self._new_entry("text", text=text, tag=tag, id=msg_id))
+                    continue
+                if texts:
+                    self.append_entries(texts)
+                    texts = []
+                try:
+                    fn(*args)
+                except Exception as e:
+                    print("UI lỗi:", getattr(fn, "__name__", fn), e)
+            if texts:
+                self.append_entries(texts)
+            if self._scroll_end:
+                self.trim_transcript(from_top=True)
+            self.cap_transcript()
+        finally:
+            self.chat_text.config(state="disabled")
+        if self._scroll_end:
+            self.chat_text.see("end")
 
-    def show_history(self, room, entries):
+    # ---------- CALLBACK ----------
+    # (chạy trong run_ui_batch: chat_text đang mở ghi, cuộn qua _scroll_end)
+    def display_message(self, text, tag="other", *more):
+        """Thêm một hoặc nhiều cặp (text, tag) vào cuối khung chat."""
+        pairs = (text, tag) + more
+        self.append_entries([self._new_entry("text", text=pairs[i], tag=pairs[i + 1])
+                             for i in range(0, len(pairs), 2)])
+
+    def show_history(self, room, entries, more=False):
         self.current_room = room
         self.roomname_label.config(text=f"Phòng: {room}")
+        self._oldest_id = entries[0].get("id") if entries else None
+        self._history_more = more and self._oldest_id is not None
+        self._history_loading = False
+
+        self.reset_transcript([self._new_entry("history", room=room, data=e) for e in entries])
+        self._scroll_end = True
+
+    def prepend_history(self, room, entries, before_id, more):
+        """Chèn trang cũ hơn lên đầu, giữ nguyên phần đã hiển thị và vị trí cuộn."""
+        if room != self.current_room or before_id != self._oldest_id:
+            return  # trả lời muộn của phòng / lần tải trước
+        self._history_loading = False
+        self._history_more = more
+        if not entries:
+            self._history_more = False
+            return
+        self._oldest_id = entries[0].get("id")
+        if self._oldest_id is None:
+            self._history_more = False
+
+        page = [self._new_entry("history", room=room, data=e) for e in entries]
+        self._transcript[0:0] = page
+        self._hi += len(page)
+        if self._lo > 0:
+            # đầu khung chat đang bị cắt: trang mới chờ trong model
+            self._lo += len(page)
+            return
+        self.render_above(page)
 
-        self.chat_text.config(state="normal")
-        self.chat_text.delete("1.0", "end")
-
+    def append_history(self, room, entries, complete):
+        """Tin đã lỡ khi mất kết nối (resume): nối vào cuối, không vẽ lại phần cũ."""
+        if room != self.current_room:
+            return
+        new = []
+        if not complete:
+            new.append(self._new_entry(
+                "text", tag="server",
+                text="[...] Một số tin cũ hơn không được tải lại, cuộn lên để xem lịch sử.\n"))
+        new += [self._new_entry("history", room=room, data=e) for e in entries]
+        self.append_entries(new)
+
+    def on_reconnect(self, ok):
+        if not ok:
+            # session token không còn dùng được: đăng nhập lại từ đầu
+            self.root.after(0, self.do_login)
+
+    def insert_history_entry(self, index, room, e, entry=None):
+        """Chèn một entry lịch sử tại index; gọi khi chat_text đang mở ghi."""
+        ts = e.get("timestamp", "")[-8:]
+        u = e.get("username", "")
+        m = e.get("message", "")
         my_name = self.username_label.cget("text")
-        for e in entries:
-            ts = e.get("timestamp", "")[-8:]
-            u = e.get("username", "")
-            m = e.get("message", "")
 
-            if u == "SERVER":
-                tag = "server"
-                text = f"[{ts}] 🔔 ({room}) {m}\n"
-            elif u == my_name:
-                tag = "self"
-                text = f"[{ts}] ({room}) Bạn: {m}\n"
+        if u == "SERVER":
+            tag = "server"
+            text = f"[{ts}] 🔔 ({room}) {m}\n"
+        elif u == my_name:
+            tag = "self"
+            text = f"[{ts}] ({room}) Bạn: {m}\n"
+        else:
+            tag = "other"
+            text = f"[{ts}] ({room}) {u}: {m}\n"
+
+        self.chat_text.insert(index, text, tag)
+        if e.get("blob"):
+            self.insert_blob_link(e["blob"], index=index, entry=entry)
+
+    def on_chat_scroll(self, first, last):
+        self.chat_text.vbar.set(first, last)
+        if float(first) <= 0.0:
+            if self._lo > 0:
+                self.request_rematerialize("up")
             else:
-                tag = "other"
-                text = f"[{ts}] ({room}) {u}: {m}\n"
-
-            self.chat_text.insert("end", text, tag)
+                self.load_older_history()
+        elif float(last) >= 1.0 and self._hi < len(self._transcript):
+            self.request_rematerialize("down")
 
-        self.chat_text.config(state="disabled")
-        self.chat_text.see("end")
+    def load_older_history(self):
+        if self._history_loading or not self._history_more or self._oldest_id is None:
+            return
+        if self.client.request_history(self.current_room, before_id=self._oldest_id):
+            self._history_loading = True
+
+    # ---------- TRANSCRIPT ----------
+    # Model của khung chat: _transcript giữ các entry của phòng đang xem (cũ
+    # -> mới), chỉ đoạn [_lo, _hi) được vẽ trong chat_text và đoạn đó không
+    # quá max_lines dòng. Entry bị cắt khỏi khung chat trả lại Label / ảnh /
+    # mark / tag của nó; cuộn tới mép phần đang vẽ thì vẽ lại từ model.
+    @staticmethod
+    def _new_entry(kind, **fields):
+        """kind: "text" (text, tag, id), "history" (room, data), "image" (prefix, blob, size, digest, pending)."""
+        return dict(kind=kind, lines=0, rendered=False, **fields)
+
+    def _text_lines(self):
+        return int(self.chat_text.index("end-1c").split(".")[0])
+
+    def render_entries(self, entries, index="end"):
+        """Vẽ các entry liền nhau tại index; text liền nhau chèn bằng một lệnh insert."""
+        texts, group = [], []
+        for e in entries + [None]:
+            if e is not None and e["kind"] == "text":
+                texts += (e["text"], e["tag"])
+                group.append(e)
+                continue
+            if texts:
+                self.chat_text.insert(index, *texts)
+                for t in group:
+                    t["lines"] = t["text"].count("\n")
+                    t["rendered"] = True
+                texts, group = [], []
+            if e is None:
+                break
+            before = self._text_lines()
+            try:
+                self.render_entry(index, e)
+            except Exception as ex:
+                print("UI lỗi: vẽ entry", e["kind"], ex)
+            e["lines"] = self._text_lines() - before
+            e["rendered"] = True
+        self._rendered_lines += sum(e["lines"] for e in entries)
+
+    def render_entry(self, index, entry):
+        kind = entry["kind"]
+        if kind == "history":
+            self.insert_history_entry(index, entry["room"], entry["data"], entry)
+        elif kind == "image":
+            self.insert_image_entry(index, entry)
+        else:
+            self.chat_text.insert(index, entry["text"], entry["tag"])
+
+    def release_entry(self, entry):
+        """Entry vừa bị xóa khỏi chat_text: hủy Label ảnh, bỏ mark / tag của nó."""
+        for w in entry.pop("windows", ()):
+            w.destroy()
+        for m in entry.pop("marks", ()):
+            self.chat_text.mark_unset(m)
+        for t in entry.pop("tags", ()):
+            self.chat_text.tag_delete(t)
+        entry["rendered"] = False
+
+    def clear_rendered(self):
+        self.chat_text.delete("1.0", "end")
+        for e in self._transcript[self._lo:self._hi]:
+            self.release_entry(e)
+        self._rendered_lines = 0
+
+    def reset_transcript(self, entries):
+        """Thay toàn bộ khung chat (vào phòng / tải lại lịch sử)."""
+        self.clear_rendered()
+        self._transcript = entries
+        self._lo = self._hi = 0
+        self._blob_marks.clear()
+        self.render_entries(entries)
+        self._hi = len(entries)
+
+    def append_entries(self, entries):
+        if self._hi < len(self._transcript):
+            # đang xem phần cũ (cuối khung chat đã bị cắt): về lại phần mới nhất
+            self.clear_rendered()
+            self._lo = self._hi = max(0, len(self._transcript) - TRANSCRIPT_PAGE)
+            self.render_entries(self._transcript[self._lo:])
+            self._hi = len(self._transcript)
+        self._transcript.extend(entries)
+        self.render_entries(entries)
+        self._hi = len(self._transcript)
+        self._scroll_end = True
+
+    def render_above(self, entries):
+        """Vẽ entries lên đầu khung chat, giữ vị trí cuộn; cắt bớt phía dưới nếu quá dài."""
+        # dòng đang ở đầu khung nhìn; mark trôi theo khi chèn phía trước
+        self.chat_text.mark_set("transcript-view", "@0,0")
+        self.chat_text.mark_gravity("transcript-view", "left")
+        # mark gravity right ở 1.0: chèn liên tiếp vào mark giữ đúng thứ tự
+        self.chat_text.mark_set("transcript-top", "1.0")
+        self.chat_text.mark_gravity("transcript-top", "right")
+        self.render_entries(entries, "transcript-top")
+        self.chat_text.mark_unset("transcript-top")
+        self.trim_transcript(from_top=False)
+        self.chat_text.yview("transcript-view")
+        self.chat_text.mark_unset("transcript-view")
+
+    def trim_transcript(self, from_top=True):
+        """Xóa entry ở đầu (hoặc cuối) khung chat tới khi còn <= max_lines dòng."""
+        excess = self._rendered_lines - self.max_lines
+        n = lines = 0
+        if from_top:
+            while lines < excess and self._lo + n < self._hi - 1:
+                lines += self._transcript[self._lo + n]["lines"]
+                n += 1
+            if not n:
+                return
+            self.chat_text.delete("1.0", f"{lines + 1}.0")
+            released = self._transcript[self._lo:self._lo + n]
+            self._lo += n
+        else:
+            while lines < excess and self._hi - n - 1 > self._lo:
+                n += 1
+                lines += self._transcript[self._hi - n]["lines"]
+            if not n:
+                return
+            self.chat_text.delete(f"{self._rendered_lines - lines + 1}.0", "end")
+            released = self._transcript[self._hi - n:self._hi]
+            self._hi -= n
+        for e in released:
+            self.release_entry(e)
+        self._rendered_lines -= lines
+
+    def cap_transcript(self):
+        """Bỏ entry cũ nhất (chưa vẽ) khi model quá TRANSCRIPT_MODEL_MAX; tải lại từ server khi cần."""
+        drop = min(len(self._transcript) - TRANSCRIPT_MODEL_MAX, self._lo)
+        if drop <= 0:
+            return
+        dropped = [i for i in map(self._entry_id, self._transcript[:drop]) if i is not None]
+        del self._transcript[:drop]
+        self._lo -= drop
+        self._hi -= drop
+        if not dropped:
+            return
+        # trang server tiếp theo: cũ hơn entry cũ nhất còn giữ có id (history
+        # hoặc tin chat mới), hoặc (không còn entry nào có id) tới hết các tin vừa bỏ
+        self._oldest_id = next((i for i in map(self._entry_id, self._transcript) if i is not None),
+                               max(dropped) + 1)
+        self._history_more = True
+
+    @staticmethod
+    def _entry_id(entry):
+        """id history của entry: entry lịch sử, hoặc tin chat server gửi kèm id."""
+        if entry["kind"] == "history":
+            return entry["data"].get("id")
+        return entry.get("id")
+
+    def request_rematerialize(self, direction):
+        # yscrollcommand chạy giữa lúc Tk vẽ lại: sửa chat_text ở lô UI sau
+        if not self._rematerialize_pending:
+            self._rematerialize_pending = True
+            self._ui_queue.put(("call", None, self.rematerialize, (direction,)))
+
+    def rematerialize(self, direction):
+        """Vẽ lại TRANSCRIPT_PAGE entry đã bị cắt phía trên ("up") / dưới ("down")."""
+        self._rematerialize_pending = False
+        if direction == "up":
+            n = min(TRANSCRIPT_PAGE, self._lo)
+            if n:
+                self._lo -= n
+                self.render_above(self._transcript[self._lo:self._lo + n])
+            return
+        n = min(TRANSCRIPT_PAGE, len(self._transcript) - self._hi)
+        if not n:
+            return
+        self.chat_text.mark_set("transcript-view", "@0,0")
+        self.chat_text.mark_gravity("transcript-view", "left")
+        self.render_entries(self._transcript[self._hi:self._hi + n])
+        self._hi += n
+        self.trim_transcript(from_top=True)
+        self.chat_text.yview("transcript-view")
+        self.chat_text.mark_unset("transcript-view")
 
     # ========== HIỂN THỊ ẢNH ==========
+    # Ảnh được giải mã + thu nhỏ trên _image_pool (decode_thumbnail), kết quả
+    # nằm trong _thumbs theo sha256 nội dung; thread Tk chỉ tạo PhotoImage từ
+    # ảnh đã thu nhỏ. Trong lúc chờ, entry hiện một dòng giữ chỗ.
     def show_image(self, data):
-        try:
-            b64 = data.get("data")
-            filename = data.get("filename", "")
-            sender = data.get("sender", "")
-            room = data.get("room", "")
-            ts = data.get("timestamp", "")
-
-            raw = base64.b64decode(b64)
-            img = Image.open(io.BytesIO(raw))
-            img.thumbnail((240, 240))
-            tk_img = ImageTk.PhotoImage(img)
-            self._img_refs.append(tk_img)
+        raw = data.get("data")
+        filename = data.get("filename", "")
+        sender = data.get("sender", "")
+        room = data.get("room", "")
+        ts = data.get("timestamp", "")
+
+        # prefix text dùng tag riêng để không phá layout bubble
+        if sender == self.username_label.cget("text"):
+            prefix = f"[{ts}] ({room}) Bạn gửi ảnh: {filename}"
+        else:
+            prefix = f"[{ts}] ({room}) {sender} gửi ảnh: {filename}"
 
-            self.chat_text.config(state="normal")
+        if raw is None:
+            # server chỉ gửi tham chiếu, bấm vào mới tải nội dung
+            self.append_entries([self._new_entry(
+                "image", prefix=prefix, blob=data.get("blob"), size=data.get("size"))])
+            return
 
-            # prefix text dùng tag riêng để không phá layout bubble
-            if sender == self.username_label.cget("text"):
-                prefix = f"[{ts}] ({room}) Bạn gửi ảnh: {filename}"
-            else:
-                prefix = f"[{ts}] ({room}) {sender} gửi ảnh: {filename}"
+        entry = self._new_entry("image", prefix=prefix, pending=True)
+        self.append_entries([entry])
+        self.decode_image(raw, self.on_image_decoded, entry)
 
-            self.chat_text.insert("end", prefix + "\n", "img_text")
+    def decode_image(self, raw, done, *args):
+        """Giải mã raw trên pool; xong thì done(*args, digest, lỗi) chạy trên thread Tk."""
+        callback = self.ui_call(done)
 
-            # ---------- FIX QUAN TRỌNG ----------
-            # TÁCH ẢNH RA KHỎI CƠ CHẾ WRAP / JUSTIFY CỦA TAG TRƯỚC ĐÓ
-            self.chat_text.insert("end", "\n", "img_text")
-            self.chat_text.window_create("end",
-                                        window=tk.Label(self.chat_text, image=tk_img, bg="#ffffff"))
-            self.chat_text.insert("end", "\n\n", "img_text")
-            # -------------------------------------
+        def finished(future):
+            try:
+                callback(*args, future.result(), None)
+            except Exception as e:
+                callback(*args, None, e)
+
+        self._image_pool.submit(decode_thumbnail, raw, self._thumbs).add_done_callback(finished)
+
+    def thumbnail_photo(self, digest):
+        """PhotoImage của ảnh thu nhỏ trong cache, None nếu không có / đã bị đẩy ra."""
+        thumb = self._thumbs.get(digest) if digest else None
+        return ImageTk.PhotoImage(thumb) if thumb is not None else None
+
+    def on_image_decoded(self, entry, digest, error):
+        entry["pending"] = False
+        entry["digest"] = digest
+        if error is not None:
+            entry["error"] = str(error)
+        slot = entry.pop("slot", None)
+        ranges = self.chat_text.tag_ranges(slot) if entry["rendered"] and slot else ()
+        if not ranges:
+            return  # entry chưa vẽ / đã bị cắt: lần vẽ sau lấy thẳng từ cache
+        at_end = self.chat_text.yview()[1] >= 1.0
+        start = self.chat_text.index(ranges[0])
+        self.chat_text.delete(ranges[0], ranges[1])
+        photo = self.thumbnail_photo(digest)
+        if photo is None:
+            self.chat_text.insert(start, f"[Lỗi hiển thị ảnh] {entry.get('error', '')}", "error")
+        else:
+            self.embed_image(start, entry, photo)
+        # ảnh cao hơn dòng giữ chỗ: vẫn ở cuối khung chat nếu trước đó đang ở cuối
+        self._scroll_end = self._scroll_end or at_end
+
+    def insert_image_entry(self, index, entry):
+        self.chat_text.insert(index, entry["prefix"] + "\n", "img_text")
+        photo = self.thumbnail_photo(entry.get("digest"))
+        if photo is None and entry.get("blob"):
+            self.insert_blob_link(entry["blob"], entry.get("size"), index, entry)
+            return
+        # ---------- FIX QUAN TRỌNG ----------
+        # TÁCH ẢNH RA KHỎI CƠ CHẾ WRAP / JUSTIFY CỦA TAG TRƯỚC ĐÓ
+        self.chat_text.insert(index, "\n", "img_text")
+        if photo is not None:
+            self.embed_image(index, entry, photo)
+        elif entry.get("pending"):
+            # giữ chỗ cùng số dòng với ảnh, on_image_decoded thay bằng ảnh
+            self._link_seq += 1
+            slot = entry["slot"] = f"image-{self._link_seq}"
+            entry.setdefault("tags", []).append(slot)
+            self.chat_text.insert(index, "(đang xử lý ảnh...)", ("img_text", slot))
+        elif entry.get("error"):
+            self.chat_text.insert(index, f"[Lỗi hiển thị ảnh] {entry['error']}", "error")
+        else:
+            # ảnh gửi kèm nội dung đã bị đẩy khỏi cache
+            self.chat_text.insert(index, "(ảnh đã được giải phóng)", "img_text")
+        self.chat_text.insert(index, "\n\n", "img_text")
+        # -------------------------------------
+
+    def embed_image(self, index, entry, photo):
+        label = tk.Label(self.chat_text, image=photo, bg="#ffffff")
+        label.image = photo  # giữ ảnh tránh GC, hết khi Label bị hủy
+        self.chat_text.window_create(index, window=label)
+        entry.setdefault("windows", []).append(label)
+
+    def insert_blob_link(self, blob_id, size=None, index="end", entry=None):
+        """
+        Chèn link "[Xem ảnh]" tại index (mặc định cuối khung chat), hoặc ảnh
+        luôn nếu blob đã tải và còn trong cache; gọi khi chat_text đang mở ghi.
+        """
+        if not blob_id:
+            return
+        photo = self.thumbnail_photo(self._blob_digests.get(blob_id))
+        if photo is not None:
+            self.embed_image(index, entry, photo)
+            self.chat_text.insert(index, "\n\n", "img_text")
+            return
+        label = "[Xem ảnh]" if not size else f"[Xem ảnh - {size / 1024:.0f} KB]"
+        self._link_seq += 1
+        link_tag = f"blob-{self._link_seq}"
+        mark = f"mark-{link_tag}"
+        self.chat_text.insert(index, label, ("img_text", link_tag))
+        self.chat_text.mark_set(mark, f"{link_tag}.last")
+        self.chat_text.mark_gravity(mark, "left")
+        self.chat_text.insert(index, "\n\n", "img_text")
+        self.chat_text.tag_config(link_tag, foreground="#1877f2", underline=True)
+        self.chat_text.tag_bind(link_tag, "<Button-1>",
+                                lambda e, b=blob_id, m=mark, t=link_tag, o=entry:
+                                self.request_blob(b, m, t, o))
+        if entry is not None:
+            entry.setdefault("marks", []).append(mark)
+            entry.setdefault("tags", []).append(link_tag)
+
+    def request_blob(self, blob_id, mark, link_tag, entry=None):
+        pending = self._blob_marks.setdefault(blob_id, [])
+        if all(m != mark for m, _, _ in pending):
+            pending.append((mark, link_tag, entry))
+        if len(pending) > 1:
+            return
+        digest = self._blob_digests.get(blob_id)
+        if digest and self._thumbs.get(digest) is not None:
+            # đã tải trước đó (link vẽ trước khi ảnh vào cache): khỏi tải lại
+            self.ui_call(self.on_blob_decoded)(blob_id, digest, None)
+        else:
+            self.client.fetch_blob(blob_id)
 
-            self.chat_text.config(state="disabled")
-            self.chat_text.see("end")
+    def on_blob(self, blob_id, raw):
+        self.decode_image(raw, self.on_blob_decoded, blob_id)
 
-        except Exception as e:
-            self.display_message(f"[Lỗi hiển thị ảnh] {e}\n", "error")
+    def on_blob_decoded(self, blob_id, digest, error):
+        pending = self._blob_marks.pop(blob_id, [])
+        photo = self.thumbnail_photo(digest)
+        if photo is None:
+            self.display_message(f"[Lỗi hiển thị ảnh] {error or 'ảnh đã bị giải phóng'}\n", "error")
+            return
+        self._blob_digests[blob_id] = digest
+        for mark, link_tag, entry in pending:
+            if entry is None or mark not in entry.get("marks", ()):
+                # link đã bị cắt khỏi khung chat (có thể đã vẽ lại với mark /
+                # tag mới): ảnh đã vào cache, bấm link mới sẽ hiện ngay
+                continue
+            ranges = self.chat_text.tag_ranges(link_tag)
+            if ranges:
+                self.chat_text.delete(ranges[0], ranges[1])
+            self.embed_image(mark, entry, photo)
+            self.chat_text.mark_unset(mark)
+            entry["marks"].remove(mark)
 
     # ---------- UPDATE UI ----------
     def update_user_list(self, users):
@@ -546,6 +1456,69 @@ class ClientGUI:
             label = ("🔒 " if is_private else "") + name
             self.room_list.insert("end", label)
 
+    def show_room_page(self, page):
+        """Cập nhật listbox theo trang mới, chỉ sửa những dòng khác đi."""
+        labels = [("🔒 " if r["is_private"] else "") + r["name"] for r in page.get("rooms", [])]
+        current = list(self.room_list.get(0, "end"))
+        for i, label in enumerate(labels):
+            if i >= len(current):
+                self.room_list.insert("end", label)
+            elif current[i] != label:
+                self.room_list.delete(i)
+                self.room_list.insert(i, label)
+        if len(current) > len(labels):
+            self.room_list.delete(len(labels), "end")
+
+        total = page.get("total", 0)
+        offset = page.get("offset", 0)
+        if total:
+            self.room_page_label.config(text=f"{offset + 1}-{offset + len(labels)}/{total}")
+        else:
+            self.room_page_label.config(text="0/0")
+        self._room_total = total
+
+    def on_room_search(self, event=None):
+        prefix = self.room_search.get().strip()
+        if prefix != self.client.room_query["prefix"]:
+            self.client.list_rooms(prefix=prefix, offset=0)
+
+    def page_rooms(self, step):
+        q = self.client.room_query
+        offset = q["offset"] + step * q["limit"]
+        if offset < 0 or offset >= max(self._room_total, 1):
+            return
+        self.client.list_rooms(offset=offset)
+
+    def apply_user_delta(self, joined, left):
+        items = list(self.user_list.get(0, "end"))
+        for u in left:
+            if u in items:
+                idx = items.index(u)
+                self.user_list.delete(idx)
+                del items[idx]
+        for u in joined:
+            if u not in items:
+                self.user_list.insert("end", u)
+                items.append(u)
+
+    def apply_room_delta(self, updated, removed):
+        names = [raw.replace("🔒 ", "") for raw in self.room_list.get(0, "end")]
+        for name in removed:
+            if name in names:
+                idx = names.index(name)
+                self.room_list.delete(idx)
+                del names[idx]
+        for r in updated:
+            label = ("🔒 " if r["is_private"] else "") + r["name"]
+            if r["name"] in names:
+                idx = names.index(r["name"])
+                if self.room_list.get(idx) != label:
+                    self.room_list.delete(idx)
+                    self.room_list.insert(idx, label)
+            else:
+                self.room_list.insert("end", label)
+                names.append(r["name"])
+
     def on_room_joined(self, room, creator, is_admin):
         self.current_room = room
         self.current_room_creator = creator
@@ -611,18 +1584,8 @@ class ClientGUI:
         )
         if not path:
             return
-        try:
-            with open(path, "rb") as f:
-                b64 = base64.b64encode(f.read()).decode("utf-8")
-            filename = os.path.basename(path)
-            self.client.send_packet({
-                "type": "image",
-                "filename": filename,
-                "data": b64,
-                "caption": "",
-            })
-        except Exception as e:
-            messagebox.showerror("Lỗi gửi ảnh", str(e))
+        # gửi theo chunk ở thread riêng, không chặn giao diện
+        self.client.upload_file(path)
 
     # ---------- QUẢN LÝ PHÒNG ----------
     def create_room_dialog(self):
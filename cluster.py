@@ -0,0 +1,191 @@
+"""
+Chạy nhiều worker ChatServer (mỗi worker một process) chung một cổng nhờ
+SO_REUSEPORT. Các worker nối với nhau qua một broker nhỏ trên Unix domain
+socket: worker publish thay đổi của mình (tin phòng, PM, presence, phòng,
+tài khoản, history) dạng NDJSON, broker chuyển nguyên dòng tới mọi worker
+khác (không parse, trừ dòng hello đầu tiên để biết id worker).
+
+    python chat_server.py --headless --workers 4
+
+Process chính chạy broker và giữ các worker; Ctrl+C dừng tất cả.
+"""
+import asyncio
+import os
+import queue
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from protocol import LineDecoder, ProtocolError, encode_packet
+
+
+# ===================== BROKER =====================
+class Broker:
+    """Relay dòng NDJSON giữa các worker; báo {"op": "gone"} khi một worker mất."""
+
+    def __init__(self, path):
+        self.path = path
+        self.writers = {}  # writer -> id worker
+
+    async def serve(self):
+        return await asyncio.start_unix_server(self._handle, path=self.path, limit=2 ** 24)
+
+    def _relay(self, source, line):
+        for w in list(self.writers):
+            if w is not source:
+                w.write(line)
+
+    async def _handle(self, reader, writer):
+        worker = None
+        self.writers[writer] = None
+        try:
+            first = await reader.readline()
+            if not first:
+                return
+            try:
+                decoder = LineDecoder()
+                decoder.feed(first)
+                worker = decoder.next_packet().get("w")
+            except (ProtocolError, AttributeError):
+                pass
+            self.writers[writer] = worker
+            self._relay(writer, first)
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self._relay(writer, line)
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            pass  # broker dừng: asyncio.run hủy các handler còn chờ đọc
+        finally:
+            self.writers.pop(writer, None)
+            writer.close()
+            if worker is not None:
+                self._relay(None, encode_packet({"op": "gone", "w": worker}))
+
+
+# ===================== WORKER SIDE =====================
+class BusClient:
+    """
+    Kết nối của một worker tới broker. publish() không chặn (đưa vào hàng
+    đợi, một thread gom và ghi); một thread khác đọc và gọi on_message(msg)
+    cho từng gói nhận được.
+    """
+
+    def __init__(self, path, worker_id, on_message):
+        self.path = path
+        self.worker_id = worker_id
+        self.on_message = on_message
+        self.sock = None
+        self._queue = queue.Queue()
+
+    def start(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.connect(self.path)
+                break
+            except OSError:
+                self.sock.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        self.publish({"op": "hello", "w": self.worker_id})
+        threading.Thread(target=self._write_loop, daemon=True, name="bus-writer").start()
+        threading.Thread(target=self._read_loop, daemon=True, name="bus-reader").start()
+        return self
+
+    def publish(self, msg):
+        self._queue.put(encode_packet(msg))
+
+    def _write_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.sock.sendall(b"".join(batch))
+            except OSError:
+                return
+
+    def _read_loop(self):
+        decoder = LineDecoder()
+        while True:
+            try:
+                chunk = self.sock.recv(65536)
+            except OSError:
+                chunk = b""
+            if not chunk:
+                # mất broker thì worker không còn đúng với cụm nữa
+                print("CLUSTER: mất kết nối tới broker, dừng worker")
+                os._exit(1)
+            decoder.feed(chunk)
+            while True:
+                try:
+                    msg = decoder.next_packet()
+                except ProtocolError:
+                    decoder = LineDecoder()
+                    break
+                if msg is None:
+                    break
+                try:
+                    self.on_message(msg)
+                except Exception as e:
+                    print("CLUSTER: lỗi xử lý", msg.get("op"), e)
+
+
+# ===================== MASTER =====================
+def worker_command(worker_args, worker_id, bus_path):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "chat_server.py")
+    return [sys.executable, script, *worker_args, "--headless",
+            "--worker-id", str(worker_id), "--bus", bus_path]
+
+
+def run_cluster(workers, worker_args):
+    """Bật broker rồi N worker (cùng tham số dòng lệnh); chờ tới khi bị dừng."""
+    tmpdir = tempfile.mkdtemp(prefix="chatbus-")
+    path = os.path.join(tmpdir, "bus.sock")
+    procs = []
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        server = await Broker(path).serve()
+        for i in range(workers):
+            procs.append(subprocess.Popen(worker_command(worker_args, i, path)))
+        print(f"CLUSTER: {workers} worker, broker {path}")
+        # chạy tới khi bị dừng hoặc có worker thoát
+        while all(p.poll() is None for p in procs):
+            try:
+                await asyncio.wait_for(stop.wait(), 0.5)
+                break
+            except asyncio.TimeoutError:
+                pass
+        server.close()
+
+    try:
+        asyncio.run(main())
+    finally:
+        for p in procs:
+            if p.poll() is None:
+                p.terminate()
+        for p in procs:
+            try:
+                p.wait(5)
+            except subprocess.TimeoutExpired:
+                p.kill()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        print("CLUSTER: stopped")
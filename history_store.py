@@ -0,0 +1,626 @@
+import atexit
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import deque
+
+DEFAULT_ROOM = "Phòng chung"
+
+FSYNC_POLICIES = ("batch", "interval", "never")
+
+_CLEAR = object()
+_STOP = object()
+
+
+def load_legacy_history(path):
+    """Đọc file chat_history.json kiểu cũ (một mảng JSON)."""
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            hist = json.load(f)
+    except:
+        return []
+
+    for e in hist:
+        if isinstance(e, dict) and "room" not in e:
+            e["room"] = DEFAULT_ROOM
+
+    return [e for e in hist if isinstance(e, dict)]
+
+
+class HistoryJournal:
+    """
+    Lịch sử chat dạng JSONL chỉ ghi nối đuôi.
+
+    Trong bộ nhớ mỗi phòng có một deque(maxlen=retention) riêng nên lấy N tin
+    gần nhất của một phòng là O(N), không phụ thuộc tổng lịch sử, và phòng
+    đông không đẩy lịch sử của phòng vắng ra ngoài. retention là dict
+    {tên phòng: số tin}, phòng không có trong dict dùng default_retention.
+    Đổi tên / xóa phòng được ghi vào journal dạng {"op": ...}.
+    Mỗi entry có "id" tăng dần (cursor cho page()).
+
+    append() chỉ đẩy entry vào hàng đợi; một thread ghi riêng gom các entry
+    đến trong khoảng flush_interval rồi ghi một lần (group commit).
+    fsync:
+        "batch"    - fsync sau mỗi lần ghi batch
+        "interval" - fsync tối đa mỗi fsync_interval giây
+        "never"    - để hệ điều hành tự flush
+    Khi file dài hơn compact_ratio lần tổng số entry giữ trong bộ nhớ, thread
+    ghi viết lại file chỉ với các entry còn giữ (compaction).
+
+    persist=False: chỉ đọc file lúc khởi động rồi giữ trong bộ nhớ, không ghi
+    (worker phụ trong cụm nhiều process; worker chính là nơi duy nhất ghi).
+    """
+
+    def __init__(self, path="chat_history.jsonl", legacy_path="chat_history.json",
+                 default_retention=500, retention=None,
+                 flush_interval=0.05, fsync="interval",
+                 fsync_interval=1.0, compact_interval=60.0, compact_ratio=2,
+                 metrics=None, persist=True):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync không hợp lệ: {fsync}")
+        self.path = path
+        self.legacy_path = legacy_path
+        self.default_retention = default_retention
+        self.retention = dict(retention or {})
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.compact_interval = compact_interval
+        self.compact_ratio = compact_ratio
+        self.metrics = metrics
+        self.persist = persist
+
+        self.rooms = {}  # room -> deque các entry gần nhất
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._lines = 0
+        self._next_id = 1
+        self._closed = False
+
+        if not persist:
+            self._closed = True
+            self._load()
+            return
+
+        self._migrate_legacy()
+        self._load()
+        self._file = open(self.path, "a", encoding="utf-8")
+
+        self._writer = threading.Thread(target=self._run, daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    # ------------------ API ------------------
+    def append(self, entry: dict):
+        with self._lock:
+            self._assign_id(entry)
+            self._room(entry["room"]).append(entry)
+            if self.persist:
+                self._queue.put(entry)
+
+    def recent(self, room, limit=50):
+        """limit entry mới nhất của phòng, cũ -> mới."""
+        dq = self.rooms.get(room)
+        if not dq:
+            return []
+        with self._lock:
+            n = len(dq)
+            return [dq[i] for i in range(max(0, n - limit), n)]
+
+    def page(self, room, before_id=None, limit=50):
+        """limit entry cũ hơn before_id (None = mới nhất), cũ -> mới."""
+        if before_id is None:
+            return self.recent(room, limit)
+        dq = self.rooms.get(room)
+        if not dq:
+            return []
+        with self._lock:
+            older = [e for e in dq if e["id"] < before_id]
+        return older[-limit:]
+
+    def entries(self):
+        """Mọi entry đang giữ trong bộ nhớ (theo từng phòng, cũ -> mới)."""
+        with self._lock:
+            return self._snapshot()
+
+    def rename_room(self, room, new_name):
+        with self._lock:
+            self._apply_op({"op": "rename_room", "room": room, "new_name": new_name})
+            if self.persist:
+                self._queue.put({"op": "rename_room", "room": room, "new_name": new_name})
+
+    def delete_room(self, room):
+        with self._lock:
+            self._apply_op({"op": "delete_room", "room": room})
+            if self.persist:
+                self._queue.put({"op": "delete_room", "room": room})
+
+    def set_retention(self, room, limit):
+        with self._lock:
+            self.retention[room] = limit
+            if room in self.rooms:
+                self.rooms[room] = deque(self.rooms[room], maxlen=limit)
+
+    def clear(self):
+        with self._lock:
+            self.rooms.clear()
+            if self.persist:
+                self._queue.put(_CLEAR)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._writer.join()
+
+    # ------------------ ROOM INDEX ------------------
+    def _assign_id(self, entry):
+        if entry.get("id") is None:
+            entry["id"] = self._next_id
+        self._next_id = max(self._next_id, entry["id"] + 1)
+
+    def _room(self, room):
+        dq = self.rooms.get(room)
+        if dq is None:
+            dq = deque(maxlen=self.retention.get(room, self.default_retention))
+            self.rooms[room] = dq
+        return dq
+
+    def _apply_op(self, op):
+        room = op.get("room")
+        if op["op"] == "rename_room":
+            new_name = op["new_name"]
+            if room in self.retention:
+                self.retention[new_name] = self.retention.pop(room)
+            old = self.rooms.pop(room, None)
+            if old is not None:
+                dq = self._room(new_name)
+                for e in old:
+                    dq.append({**e, "room": new_name})
+        elif op["op"] == "delete_room":
+            self.rooms.pop(room, None)
+
+    def _snapshot(self):
+        return [e for dq in self.rooms.values() for e in dq]
+
+    # ------------------ LOAD / MIGRATE ------------------
+    def _migrate_legacy(self):
+        if os.path.exists(self.path) or not self.legacy_path:
+            return
+        if not os.path.exists(self.legacy_path):
+            return
+        hist = load_legacy_history(self.legacy_path)
+        self._rewrite(hist)
+        os.replace(self.legacy_path, self.legacy_path + ".migrated")
+        print(f"HISTORY: migrated {len(hist)} entries -> {self.path}")
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                self._lines += 1
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    e = json.loads(line)
+                except:
+                    # dòng cuối có thể bị cắt dở khi crash
+                    continue
+                if "op" in e:
+                    self._apply_op(e)
+                    continue
+                e.setdefault("room", DEFAULT_ROOM)
+                self._assign_id(e)
+                self._room(e["room"]).append(e)
+
+    def _rewrite(self, entries):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for e in entries:
+                f.write(json.dumps(e, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self._lines = len(entries)
+
+    # ------------------ WRITER THREAD ------------------
+    def _run(self):
+        last_sync = time.monotonic()
+        last_compact = time.monotonic()
+        dirty = False
+        stop = False
+
+        while not stop:
+            try:
+                item = self._queue.get(timeout=self.fsync_interval)
+                batch = [item]
+            except queue.Empty:
+                batch = []
+
+            # gom thêm các entry đến trong flush_interval
+            deadline = time.monotonic() + self.flush_interval
+            while batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                t0 = time.perf_counter()
+                for item in batch:
+                    if item is _STOP:
+                        stop = True
+                    elif item is _CLEAR:
+                        self._file.truncate(0)
+                        self._lines = 0
+                    else:
+                        self._file.write(json.dumps(item, ensure_ascii=False) + "\n")
+                        self._lines += 1
+                if batch:
+                    self._file.flush()
+                    dirty = True
+
+                now = time.monotonic()
+                if dirty and (stop or self.fsync == "batch" or
+                              (self.fsync == "interval" and now - last_sync >= self.fsync_interval)):
+                    os.fsync(self._file.fileno())
+                    last_sync = now
+                    dirty = False
+                    if self.metrics:
+                        self.metrics.inc("chat_history_fsync_total")
+
+                if batch and self.metrics:
+                    self.metrics.observe("chat_history_write_seconds", time.perf_counter() - t0)
+                    self.metrics.inc("chat_history_records_total", len(batch))
+
+                if not stop and now - last_compact >= self.compact_interval:
+                    last_compact = now
+                    retained = sum(len(dq) for dq in list(self.rooms.values()))
+                    if self._lines > max(retained, 1) * self.compact_ratio:
+                        stop = self._compact() or stop
+            except Exception as e:
+                print("HISTORY write error:", e)
+
+        self._file.close()
+
+    def _compact(self):
+        # snapshot + bỏ hàng đợi trong cùng một lock: mọi entry đang chờ
+        # đã có sẵn trong snapshot nên không bị ghi trùng
+        stop = False
+        with self._lock:
+            snapshot = self._snapshot()
+            while True:
+                try:
+                    if self._queue.get_nowait() is _STOP:
+                        stop = True
+                except queue.Empty:
+                    break
+        self._file.close()
+        self._rewrite(snapshot)
+        self._file = open(self.path, "a", encoding="utf-8")
+        return stop
+
+
+# ===================== SQLITE =====================
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id   INTEGER PRIMARY KEY,
+    room TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_room_id ON messages (room, id);
+CREATE TABLE IF NOT EXISTS retention (
+    room         TEXT PRIMARY KEY,
+    max_messages INTEGER NOT NULL
+);
+"""
+
+# fsync của journal -> PRAGMA synchronous (WAL)
+_SYNCHRONOUS = {"batch": "FULL", "interval": "NORMAL", "never": "OFF"}
+
+
+class SQLiteHistory:
+    """
+    Lịch sử chat trong SQLite (WAL), cùng API với HistoryJournal.
+
+    Bảng messages(id, room, data) có index (room, id); id tăng dần theo thứ
+    tự ghi nên cũng là thứ tự thời gian. N tin mới nhất hoặc trang trước
+    một id của một phòng là một lần quét index, không phụ thuộc tổng số tin
+    đã lưu.
+
+    append() gán id ngay rồi đẩy vào hàng đợi; thread ghi gom các entry đến
+    trong flush_interval và ghi trong một transaction. Entry chưa ghi xong
+    vẫn đọc được (giữ trong _pending tới khi commit).
+
+    retention: {phòng: số tin}, phòng khác dùng default_retention; None =
+    giữ hết. Chính sách lưu trong bảng retention nên set_retention() còn
+    sau khi khởi động lại; thread ghi xóa tin vượt giới hạn mỗi
+    prune_interval giây.
+
+    Lần đầu chạy, history cũ (chat_history.jsonl / chat_history.json) được
+    chép vào DB rồi đổi tên thành *.migrated.
+
+    persist=False: chỉ đọc (worker phụ trong cụm nhiều process; worker chính
+    ghi vào cùng file DB).
+    """
+
+    def __init__(self, path="chat_history.db", journal_path="chat_history.jsonl",
+                 legacy_path="chat_history.json", default_retention=None,
+                 retention=None, flush_interval=0.05, fsync="interval",
+                 prune_interval=5.0, metrics=None, persist=True):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync không hợp lệ: {fsync}")
+        self.path = path
+        self.default_retention = default_retention
+        self.retention = {}
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.prune_interval = prune_interval
+        self.metrics = metrics
+        self.persist = persist
+
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._pending = {}  # id -> entry chưa commit
+        self._local = threading.local()  # kết nối đọc riêng cho mỗi thread
+        self._next_id = 1
+        self._closed = not persist
+        if not persist:
+            return
+
+        db = sqlite3.connect(self.path)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(_SCHEMA)
+        if db.execute("SELECT 1 FROM messages LIMIT 1").fetchone() is None:
+            self._migrate(db, journal_path, legacy_path)
+        self._next_id = (db.execute("SELECT MAX(id) FROM messages").fetchone()[0] or 0) + 1
+        self.retention = dict(db.execute("SELECT room, max_messages FROM retention"))
+        db.close()
+
+        self._writer = threading.Thread(target=self._run, daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+        for room, limit in (retention or {}).items():
+            self.set_retention(room, limit)
+
+    # ------------------ API ------------------
+    def append(self, entry: dict):
+        if not self.persist:
+            return
+        with self._lock:
+            if entry.get("id") is None:
+                entry["id"] = self._next_id
+            self._next_id = max(self._next_id, entry["id"] + 1)
+            self._pending[entry["id"]] = entry
+            self._queue.put(("add", entry))
+
+    def recent(self, room, limit=50):
+        """limit entry mới nhất của phòng, cũ -> mới."""
+        return self.page(room, None, limit)
+
+    def page(self, room, before_id=None, limit=50):
+        """limit entry cũ hơn before_id (None = mới nhất), cũ -> mới."""
+        with self._lock:
+            pending = [e for e in self._pending.values()
+                       if e["room"] == room and (before_id is None or e["id"] < before_id)]
+        try:
+            if before_id is None:
+                rows = self._db().execute(
+                    "SELECT id, data FROM messages WHERE room = ? ORDER BY id DESC LIMIT ?",
+                    (room, limit)).fetchall()
+            else:
+                rows = self._db().execute(
+                    "SELECT id, data FROM messages WHERE room = ? AND id < ? "
+                    "ORDER BY id DESC LIMIT ?", (room, before_id, limit)).fetchall()
+        except sqlite3.Error:
+            rows = []
+        found = {}
+        for msg_id, data in rows:
+            e = json.loads(data)
+            e["id"] = msg_id
+            e["room"] = room
+            found[msg_id] = e
+        for e in pending:
+            found[e["id"]] = e
+        return [found[k] for k in sorted(found)[-limit:]]
+
+    def entries(self):
+        """Duyệt mọi entry đang lưu theo thứ tự id (snapshot cho standby)."""
+        with self._lock:
+            pending = dict(self._pending)
+        # kết nối riêng (snapshot chạy trên thread replication), đóng cả khi
+        # standby ngắt giữa chừng và generator bị bỏ dở
+        db = sqlite3.connect(self.path)
+        try:
+            try:
+                cur = db.execute("SELECT id, room, data FROM messages ORDER BY id")
+            except sqlite3.Error:
+                cur = ()
+            for msg_id, room, data in cur:
+                pending.pop(msg_id, None)
+                e = json.loads(data)
+                e["id"] = msg_id
+                e["room"] = room
+                yield e
+        finally:
+            db.close()
+        yield from pending.values()
+
+    def rename_room(self, room, new_name):
+        if not self.persist:
+            return
+        with self._lock:
+            for e in self._pending.values():
+                if e["room"] == room:
+                    e["room"] = new_name
+            if room in self.retention:
+                self.retention[new_name] = self.retention.pop(room)
+            self._queue.put(("rename", room, new_name))
+
+    def delete_room(self, room):
+        if not self.persist:
+            return
+        with self._lock:
+            self._pending = {k: e for k, e in self._pending.items() if e["room"] != room}
+            self.retention.pop(room, None)
+            self._queue.put(("delete", room))
+
+    def set_retention(self, room, limit):
+        """Giới hạn số tin giữ lại của phòng (None = theo default_retention)."""
+        if not self.persist:
+            return
+        with self._lock:
+            if limit is None:
+                self.retention.pop(room, None)
+            else:
+                self.retention[room] = limit
+            self._queue.put(("retention", room, limit))
+
+    def clear(self):
+        if not self.persist:
+            return
+        with self._lock:
+            self._pending.clear()
+            self._queue.put(("clear",))
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(("stop",))
+        self._writer.join()
+
+    # ------------------ INTERNAL ------------------
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=5)
+        return db
+
+    def _migrate(self, db, journal_path, legacy_path):
+        entries, source = [], None
+        if journal_path and os.path.exists(journal_path):
+            old = HistoryJournal(journal_path, None, default_retention=None, persist=False)
+            entries, source = old.entries(), journal_path
+        elif legacy_path and os.path.exists(legacy_path):
+            entries, source = load_legacy_history(legacy_path), legacy_path
+        if source is None:
+            return
+        entries.sort(key=lambda e: e.get("id") or 0)
+        with db:
+            db.executemany("INSERT INTO messages (room, data) VALUES (?, ?)",
+                           [(e.get("room", DEFAULT_ROOM), json.dumps(e, ensure_ascii=False))
+                            for e in entries])
+        os.replace(source, source + ".migrated")
+        print(f"HISTORY: migrated {len(entries)} entries {source} -> {self.path}")
+
+    def _limit(self, room):
+        return self.retention.get(room, self.default_retention)
+
+    def _prune(self, db, rooms):
+        for room in rooms:
+            limit = self._limit(room)
+            if limit is None:
+                continue
+            db.execute(
+                "DELETE FROM messages WHERE room = ? AND id <= ("
+                "SELECT id FROM messages WHERE room = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                (room, room, limit))
+
+    def _write(self, db, batch, dirty):
+        rows = []
+
+        def flush_rows():
+            if rows:
+                db.executemany("INSERT OR REPLACE INTO messages (id, room, data) VALUES (?, ?, ?)",
+                               rows)
+                rows.clear()
+
+        stop = False
+        with db:
+            for item in batch:
+                kind = item[0]
+                if kind == "add":
+                    e = item[1]
+                    rows.append((e["id"], e["room"], json.dumps(e, ensure_ascii=False)))
+                    dirty.add(e["room"])
+                    continue
+                flush_rows()
+                if kind == "rename":
+                    db.execute("UPDATE messages SET room = ? WHERE room = ?", (item[2], item[1]))
+                    db.execute("UPDATE OR REPLACE retention SET room = ? WHERE room = ?",
+                               (item[2], item[1]))
+                elif kind == "delete":
+                    db.execute("DELETE FROM messages WHERE room = ?", (item[1],))
+                    db.execute("DELETE FROM retention WHERE room = ?", (item[1],))
+                elif kind == "retention":
+                    if item[2] is None:
+                        db.execute("DELETE FROM retention WHERE room = ?", (item[1],))
+                    else:
+                        db.execute("INSERT OR REPLACE INTO retention VALUES (?, ?)",
+                                   (item[1], item[2]))
+                    dirty.add(item[1])
+                elif kind == "clear":
+                    db.execute("DELETE FROM messages")
+                elif kind == "stop":
+                    stop = True
+            flush_rows()
+        return stop
+
+    # ------------------ WRITER THREAD ------------------
+    def _run(self):
+        db = sqlite3.connect(self.path)
+        db.execute(f"PRAGMA synchronous={_SYNCHRONOUS[self.fsync]}")
+        last_prune = time.monotonic()
+        dirty = set()  # phòng có tin mới từ lần prune trước
+        stop = False
+
+        while not stop:
+            try:
+                batch = [self._queue.get(timeout=self.prune_interval)]
+            except queue.Empty:
+                batch = []
+
+            # gom thêm các entry đến trong flush_interval
+            deadline = time.monotonic() + self.flush_interval
+            while batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                t0 = time.perf_counter()
+                stop = self._write(db, batch, dirty)
+                added = [item[1]["id"] for item in batch if item[0] == "add"]
+                with self._lock:
+                    for msg_id in added:
+                        self._pending.pop(msg_id, None)
+                if added and self.metrics:
+                    self.metrics.observe("chat_history_write_seconds", time.perf_counter() - t0)
+                    self.metrics.inc("chat_history_records_total", len(added))
+
+                now = time.monotonic()
+                if dirty and (stop or now - last_prune >= self.prune_interval):
+                    last_prune = now
+                    with db:
+                        self._prune(db, dirty)
+                    dirty = set()
+            except Exception as e:
+                print("HISTORY write error:", e)
+
+        db.close()
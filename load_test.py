@@ -0,0 +1,352 @@
+"""
+Load test cho chat server: N bot nói giao thức thật, chạy trong một process
+asyncio (không dùng Tk / ChatClient), trên một máy Linux.
+
+    python load_test.py --bots 2000 --rooms 20 --duration 30
+    python load_test.py --bots 500 --mix chat=60,private=20,join_room=10,create_room=2,image=8
+    python load_test.py --connect 127.0.0.1:5555 --action register --bots 100
+    python load_test.py --bots 500 --protocol ndjson --compression deflate
+
+Mặc định bật server headless trong thư mục tạm (seed sẵn tài khoản bot);
+--connect dùng server đang chạy. Bot chia đều vào --rooms phòng rồi gửi
+traffic theo --mix (trọng số từng loại gói), mỗi bot trung bình --rate gói
+mỗi giây (khoảng cách theo phân phối mũ).
+
+Mỗi gói mang thời điểm gửi, bot nhận đo độ trễ từ lúc gửi tới lúc nhận
+(chat: mọi thành viên phòng; private: người nhận và người gửi; image: tin
+thông báo "[ảnh] ..." trong phòng). Kết quả: thời gian kết nối hết N bot,
+throughput gửi / nhận, p50/p95/p99 độ trễ, RSS và số thread của server.
+
+--compression deflate: bot ndjson đề nghị nén (protocol.py); in thêm số
+byte trước / sau nén mỗi chiều và CPU nén mỗi gói - phía server đọc từ
+/metrics.json (chỉ khi tự bật server), phía bot đo tại chỗ.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+import time
+import urllib.request
+
+from bench import (BOT_PASSWORD, free_port, percentile, proc_stats,
+                   raise_nofile, seed_users, spawn_server)
+from protocol import (DEFLATE, FRAMED, NDJSON, Deflater, LineDecoder, ProtocolError,
+                      encode_packet, make_decoder)
+
+PACKET_TYPES = ("chat", "private", "join_room", "create_room", "image", "list_rooms")
+DEFAULT_MIX = "chat=80,private=10,join_room=5,create_room=1,image=4,list_rooms=2"
+
+_STAMP = re.compile(r"lt (\d+\.\d+)")
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in PACKET_TYPES:
+            raise argparse.ArgumentTypeError(f"loại gói không hỗ trợ: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+class Stats:
+    def __init__(self):
+        self.sent = {t: 0 for t in PACKET_TYPES}
+        self.latencies = []
+        self.received = 0
+        self.errors = 0
+        self.disconnects = 0
+        self.measuring = False
+        self.wire_in = 0   # byte bot nhận trên dây
+        self.raw_in = 0    # ... sau khi giải nén
+
+
+# ===================== BOT =====================
+class Bot:
+    def __init__(self, name, protocol, stats, compression=None):
+        self.name = name
+        self.offer = protocol
+        self.protocol = NDJSON
+        self.compression = compression
+        self.deflater = None
+        self.stats = stats
+        self.reader = None
+        self.writer = None
+        self.decoder = None
+        self.rooms_created = 0
+
+    async def connect(self, host, port, action):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        auth = {"type": "auth", "action": action, "username": self.name,
+                "password": BOT_PASSWORD, "protocols": [self.offer],
+                "features": ["blob", "presence", "directory"]}
+        if self.compression:
+            auth["compression"] = [self.compression]
+        self.writer.write(encode_packet(auth))
+        decoder = LineDecoder()
+        reply = None
+        while reply is None:
+            chunk = await self.reader.read(65536)
+            if not chunk:
+                raise ConnectionError("mất kết nối khi auth")
+            decoder.feed(chunk)
+            reply = decoder.next_packet()
+        if reply.get("type") != "auth_ok":
+            raise RuntimeError(f"auth thất bại ({self.name}): {reply.get('message')}")
+        self.protocol = reply.get("protocol", NDJSON)
+        self.compression = reply.get("compression")
+        if self.compression:
+            self.deflater = Deflater()
+        self.decoder = make_decoder(self.protocol, decoder.buffer, self.compression)
+
+    def send(self, data):
+        payload = encode_packet(data, self.protocol)
+        self.writer.write(self.deflater.packet(payload) if self.deflater else payload)
+
+    async def read_loop(self):
+        try:
+            while True:
+                chunk = await self.reader.read(65536)
+                if not chunk:
+                    break
+                raw = getattr(self.decoder, "raw_bytes", 0)
+                self.decoder.feed(chunk)
+                self.stats.wire_in += len(chunk)
+                self.stats.raw_in += getattr(self.decoder, "raw_bytes", raw + len(chunk)) - raw
+                while True:
+                    p = self.decoder.next_packet()
+                    if p is None:
+                        break
+                    self.on_packet(p)
+        except (ConnectionError, ProtocolError):
+            pass
+        except asyncio.CancelledError:
+            return
+        self.stats.disconnects += 1
+
+    def on_packet(self, p):
+        now = time.perf_counter()
+        if not self.stats.measuring:
+            return
+        self.stats.received += 1
+        msg_type = p.get("type")
+        if msg_type == "error":
+            self.stats.errors += 1
+        elif msg_type in ("chat", "private"):
+            m = _STAMP.search(p.get("message", ""))
+            if m:
+                self.stats.latencies.append(now - float(m.group(1)))
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+    # ------------------ TRAFFIC ------------------
+    def act(self, kind, names, rooms, image):
+        stamp = f"lt {time.perf_counter():.6f}"
+        if kind == "chat":
+            self.send({"type": "chat", "message": f"{stamp} {self.name}"})
+        elif kind == "private":
+            self.send({"type": "private", "to": random.choice(names),
+                       "message": f"{stamp} {self.name}"})
+        elif kind == "join_room":
+            self.send({"type": "join_room", "room": random.choice(rooms)})
+        elif kind == "create_room":
+            self.rooms_created += 1
+            self.send({"type": "create_room", "room": f"lt-{self.name}-{self.rooms_created}"})
+        elif kind == "image":
+            self.send({"type": "image", "filename": f"{stamp}.png", "data": image})
+        elif kind == "list_rooms":
+            self.send({"type": "list_rooms", "prefix": "lt-", "sort": "members",
+                       "offset": random.randrange(0, 100, 20), "limit": 20})
+        self.stats.sent[kind] += 1
+
+    async def traffic(self, mix, rate, until, names, rooms, image):
+        kinds = list(mix)
+        weights = [mix[k] for k in kinds]
+        while True:
+            delay = random.expovariate(rate)
+            left = until - time.perf_counter()
+            if delay >= left:
+                await asyncio.sleep(max(left, 0))
+                return
+            await asyncio.sleep(delay)
+            self.act(random.choices(kinds, weights)[0], names, rooms, image)
+
+
+# ===================== RUN =====================
+async def sample_rss(pid, peak):
+    while True:
+        rss, threads = proc_stats(pid)
+        peak["rss"] = max(peak["rss"], rss)
+        peak["threads"] = max(peak["threads"], threads)
+        await asyncio.sleep(0.5)
+
+
+def fetch_metrics(port):
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics.json", timeout=5) as r:
+            return json.load(r)
+    except OSError:
+        return None
+
+
+def compression_report(stats, bots, metrics):
+    """Byte trước / sau nén và CPU nén mỗi gói, hai chiều."""
+    def line(direction, raw, wire, seconds, packets):
+        if not raw:
+            return
+        print(f"deflate {direction}: {raw / 1e6:.2f}MB -> {wire / 1e6:.2f}MB "
+              f"(tiết kiệm {(1 - wire / raw) * 100:.1f}%), "
+              f"{seconds / max(packets, 1) * 1e6:.1f}µs CPU nén/gói ({packets} gói)")
+
+    print(f"bot nhận: {stats.wire_in / 1e6:.2f}MB trên dây, "
+          f"{stats.raw_in / 1e6:.2f}MB sau giải nén")
+    if metrics:
+        counters = metrics["counters"]
+        hist = (metrics["histograms"].get("chat_deflate_seconds") or [{}])[0]
+        raw = sum(r["value"] for r in counters.get("chat_deflate_raw_bytes_total", []))
+        wire = sum(r["value"] for r in counters.get("chat_deflate_wire_bytes_total", []))
+        line("server -> bot", raw, wire, hist.get("sum", 0.0), hist.get("count", 0))
+    deflaters = [b.deflater for b in bots if b.deflater]
+    line("bot -> server", sum(d.raw_bytes for d in deflaters),
+         sum(d.wire_bytes for d in deflaters), sum(d.seconds for d in deflaters),
+         sum(d.packets for d in deflaters))
+
+
+async def run(args, host, port, pid, metrics_port=None):
+    stats = Stats()
+    names = [f"{args.prefix}{i}" for i in range(args.bots)]
+    rooms = [f"lt-room-{i}" for i in range(args.rooms)] or ["Phòng chung"]
+    protocols = [NDJSON, FRAMED] if args.protocol == "mixed" else [args.protocol]
+    compression = None if args.compression == "none" else args.compression
+    bots = [Bot(n, protocols[i % len(protocols)], stats, compression)
+            for i, n in enumerate(names)]
+    peak = {"rss": 0, "threads": 0}
+    sampler = asyncio.create_task(sample_rss(pid, peak)) if pid else None
+
+    # connect storm
+    sem = asyncio.Semaphore(args.concurrency)
+    failed = []
+
+    async def connect(bot):
+        async with sem:
+            try:
+                await bot.connect(host, port, args.action)
+            except Exception as e:
+                failed.append((bot.name, e))
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(connect(b) for b in bots))
+    connect_time = time.perf_counter() - t0
+    bots = [b for b in bots if b.decoder is not None]
+    readers = [asyncio.create_task(b.read_loop()) for b in bots]
+    print(f"connect: {len(bots)}/{args.bots} bot trong {connect_time:.2f}s "
+          f"({len(bots) / max(connect_time, 1e-9):.0f} kết nối/s), lỗi={len(failed)}")
+    for name, e in failed[:5]:
+        print(f"  {name}: {e}")
+    if not bots:
+        return
+
+    # chia bot vào các phòng
+    for i, b in enumerate(bots):
+        b.send({"type": "join_room", "room": rooms[i % len(rooms)]})
+    await asyncio.sleep(args.settle)
+
+    # traffic
+    image = os.urandom(args.image_size)
+    live = [b.name for b in bots]
+    stats.measuring = True
+    t1 = time.perf_counter()
+    until = t1 + args.duration
+    await asyncio.gather(*(b.traffic(args.mix, args.rate, until, live, rooms, image)
+                           for b in bots))
+    await asyncio.sleep(args.drain)
+    elapsed = time.perf_counter() - t1
+    stats.measuring = False
+
+    if sampler:
+        sampler.cancel()
+        rss, threads = proc_stats(pid)
+        peak["rss"] = max(peak["rss"], rss)
+        peak["threads"] = max(peak["threads"], threads)
+    for t in readers:
+        t.cancel()
+    for b in bots:
+        b.close()
+    metrics = fetch_metrics(metrics_port) if metrics_port else None
+
+    sent = sum(stats.sent.values())
+    ms = [x * 1000 for x in stats.latencies]
+    mix = " ".join(f"{k}={v}" for k, v in stats.sent.items() if v)
+    print(f"traffic: {args.duration:.0f}s, gửi {sent} gói ({sent / args.duration:.0f}/s) [{mix}]")
+    print(f"nhận: {stats.received} gói ({stats.received / elapsed:.0f}/s), "
+          f"đo độ trễ {len(ms)} lần giao, lỗi={stats.errors}, mất kết nối={stats.disconnects}")
+    print(f"độ trễ: p50={percentile(ms, 50):.2f}ms p95={percentile(ms, 95):.2f}ms "
+          f"p99={percentile(ms, 99):.2f}ms max={max(ms, default=0):.2f}ms")
+    if pid:
+        print(f"server: rss={peak['rss'] / 1024:.1f}MB (đỉnh) threads={peak['threads']}")
+    if compression:
+        compression_report(stats, bots, metrics)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test chat server bằng bot")
+    parser.add_argument("--bots", type=int, default=1000)
+    parser.add_argument("--rooms", type=int, default=10,
+                        help="số phòng chia bot vào (0 = chỉ Phòng chung)")
+    parser.add_argument("--duration", type=float, default=20, help="giây gửi traffic")
+    parser.add_argument("--rate", type=float, default=0.5, help="gói / giây / bot")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    parser.add_argument("--image-size", type=int, default=50_000)
+    parser.add_argument("--protocol", choices=(NDJSON, FRAMED, "mixed"), default="mixed")
+    parser.add_argument("--compression", choices=(DEFLATE, "none"), default="none",
+                        help="bot ndjson đề nghị nén luồng (frame1 không nén)")
+    parser.add_argument("--concurrency", type=int, default=200,
+                        help="số kết nối mở đồng thời lúc connect storm")
+    parser.add_argument("--settle", type=float, default=2.0,
+                        help="giây chờ sau khi chia phòng trước khi đo")
+    parser.add_argument("--drain", type=float, default=2.0,
+                        help="giây chờ nhận nốt sau khi ngừng gửi")
+    parser.add_argument("--prefix", default="bot")
+    parser.add_argument("--action", choices=("login", "register"), default="login")
+    parser.add_argument("--connect", metavar="HOST:PORT",
+                        help="dùng server đang chạy thay vì tự bật")
+    parser.add_argument("--pid", type=int, help="pid server (--connect) để đo RSS")
+    parser.add_argument("--mode", choices=("thread", "asyncio"), default="asyncio")
+    parser.add_argument("--server-args", default="",
+                        help="tham số thêm cho chat_server.py, vd. \"--overflow-policy disconnect\"")
+    args = parser.parse_args()
+
+    limit = raise_nofile()
+    if args.bots * 2 + 100 > limit:
+        print(f"cảnh báo: RLIMIT_NOFILE={limit} có thể không đủ cho {args.bots} bot")
+
+    if args.connect:
+        host, _, port = args.connect.rpartition(":")
+        asyncio.run(run(args, host, int(port), args.pid))
+        return
+
+    workdir = tempfile.mkdtemp(prefix="chatload-")
+    if args.action == "login":
+        seed_users(workdir, [f"{args.prefix}{i}" for i in range(args.bots)])
+    port = free_port()
+    metrics_port = free_port()
+    proc = spawn_server(workdir, port, ["--mode", args.mode, "--backlog", "1024",
+                                        "--metrics-port", str(metrics_port),
+                                        *args.server_args.split()])
+    try:
+        asyncio.run(run(args, "127.0.0.1", port, proc.pid, metrics_port))
+    finally:
+        proc.kill()
+        proc.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""
+Metrics của chat server: counter, gauge, histogram có nhãn, xuất ra dạng
+Prometheus text (GET /metrics) và JSON (GET /metrics.json) qua một HTTP
+server nhỏ chạy ở thread riêng.
+
+    m = Metrics()
+    m.inc("chat_packets_in_total", type="chat")
+    m.observe("chat_handler_seconds", 0.0012, type="chat")
+    m.gauge("chat_connections", lambda: len(server.clients))
+    MetricsHTTPServer(m, "127.0.0.1", 9100).start()
+"""
+import bisect
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# giây: 50µs .. 10s
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# số người nhận của một broadcast
+FANOUT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # ô cuối là +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Registry dùng chung cho mọi thread. Tên metric theo quy ước Prometheus;
+    nhãn truyền bằng keyword (type="chat").
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}    # name -> {labels: value}
+        self._histograms = {}  # name -> {labels: _Histogram}
+        self._buckets = {}     # name -> buckets
+        self._gauges = {}      # name -> callable
+        self._help = {}
+
+    def describe(self, name, text, buckets=None):
+        self._help[name] = text
+        if buckets is not None:
+            self._buckets[name] = tuple(buckets)
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            h = series.get(key)
+            if h is None:
+                h = series[key] = _Histogram(self._buckets.get(name, LATENCY_BUCKETS))
+            h.observe(value)
+
+    def gauge(self, name, fn, text=""):
+        """Gauge đọc giá trị lúc xuất (fn trả về số)."""
+        self._gauges[name] = fn
+        if text:
+            self._help[name] = text
+
+    # ------------------ XUẤT ------------------
+    def _read_gauges(self):
+        values = {}
+        for name, fn in list(self._gauges.items()):
+            try:
+                values[name] = fn()
+            except Exception:
+                continue
+        return values
+
+    def snapshot(self):
+        with self._lock:
+            counters = {n: {k: v for k, v in s.items()} for n, s in self._counters.items()}
+            hists = {
+                n: {k: (h.buckets, list(h.counts), h.sum, h.count) for k, h in s.items()}
+                for n, s in self._histograms.items()
+            }
+        out = {"counters": {}, "gauges": self._read_gauges(), "histograms": {}}
+        for name, series in counters.items():
+            out["counters"][name] = [{"labels": dict(k), "value": v} for k, v in series.items()]
+        for name, series in hists.items():
+            rows = []
+            for k, (buckets, counts, total, count) in series.items():
+                rows.append({
+                    "labels": dict(k),
+                    "buckets": {str(b): c for b, c in zip(buckets + ("+Inf",), counts)},
+                    "sum": total,
+                    "count": count,
+                })
+            out["histograms"][name] = rows
+        return out
+
+    def prometheus(self):
+        snap = self.snapshot()
+        lines = []
+
+        def head(name, kind):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for name, rows in sorted(snap["counters"].items()):
+            head(name, "counter")
+            for row in rows:
+                lines.append(f"{name}{_labels(row['labels'])} {row['value']}")
+        for name, value in sorted(snap["gauges"].items()):
+            head(name, "gauge")
+            lines.append(f"{name} {value}")
+        for name, rows in sorted(snap["histograms"].items()):
+            head(name, "histogram")
+            for row in rows:
+                cumulative = 0
+                for le, c in row["buckets"].items():
+                    cumulative += c
+                    lines.append(f"{name}_bucket{_labels(row['labels'], le=le)} {cumulative}")
+                lines.append(f"{name}_sum{_labels(row['labels'])} {row['sum']}")
+                lines.append(f"{name}_count{_labels(row['labels'])} {row['count']}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ""
+    body = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels.items()
+    )
+    return "{" + body + "}"
+
+
+# ===================== HTTP =====================
+class MetricsHTTPServer:
+    """GET /metrics (Prometheus text) và /metrics.json, chạy ở thread daemon."""
+
+    def __init__(self, metrics, host="127.0.0.1", port=9100):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.httpd = None
+
+    def start(self):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?", 1)[0]
+                if path == "/metrics":
+                    body = metrics.prometheus().encode("utf-8")
+                    ctype = "text/plain; version=0.0.4; charset=utf-8"
+                elif path == "/metrics.json":
+                    body = json.dumps(metrics.snapshot(), ensure_ascii=False).encode("utf-8")
+                    ctype = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
@@ -0,0 +1,188 @@
+"""
+Băm / kiểm tra mật khẩu và phiên đăng nhập.
+
+Mật khẩu lưu dạng "scrypt$n$r$p$salt$hash" (base64, salt ngẫu nhiên mỗi
+tài khoản). Mã băm sha256 không salt của bản cũ vẫn đăng nhập được và được
+băm lại bằng scrypt ngay lần đăng nhập đúng đầu tiên.
+
+scrypt cố ý chậm (~vài chục ms, 16MB RAM mỗi lần) nên chạy trong KDFPool:
+số thread cố định (hashlib nhả GIL khi tính nên các thread chạy song song
+thật), hàng đợi có giới hạn để một đợt đăng nhập dồn dập không giữ hết RAM.
+
+Đăng nhập đúng thì server cấp session token ngẫu nhiên; kết nối lại bằng
+token không phải chạy KDF. Server chỉ giữ sha256 của token.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_SIZE = 16
+SESSION_TTL = 7 * 24 * 3600  # giây
+
+
+def legacy_hash(password):
+    """Mã băm của bản cũ (sha256 không salt), chỉ còn dùng để nhận diện / nâng cấp."""
+    return hashlib.sha256(password.encode("utf-8")).hexdigest()
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * r * n + 1024 * 1024)
+
+
+def hash_password(password, salt=None):
+    salt = salt or os.urandom(SALT_SIZE)
+    digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return "scrypt${}${}${}${}${}".format(
+        SCRYPT_N, SCRYPT_R, SCRYPT_P,
+        base64.b64encode(salt).decode("ascii"),
+        base64.b64encode(digest).decode("ascii"),
+    )
+
+
+def verify_password(password, stored):
+    """
+    (đúng mật khẩu?, mã băm mới hoặc None). Mã băm mới có khi stored là
+    sha256 kiểu cũ hoặc scrypt với tham số cũ - người gọi lưu lại thay stored.
+    """
+    if not isinstance(stored, str):
+        return False, None
+    if not stored.startswith("scrypt$"):
+        ok = hmac.compare_digest(legacy_hash(password), stored)
+        return ok, hash_password(password) if ok else None
+    try:
+        _, n, r, p, salt, digest = stored.split("$")
+        n, r, p = int(n), int(r), int(p)
+        salt = base64.b64decode(salt)
+        digest = base64.b64decode(digest)
+    except ValueError:
+        return False, None
+    ok = hmac.compare_digest(_scrypt(password, salt, n, r, p), digest)
+    if ok and (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P):
+        return True, hash_password(password)
+    return ok, None
+
+
+# ===================== POOL =====================
+class KDFPool:
+    """
+    Chạy hash_password / verify_password trên `workers` thread. submit()
+    trả về concurrent.futures.Future, hoặc None khi đã có max_pending việc
+    đang chờ (server quá tải, người gọi từ chối đăng nhập).
+    """
+
+    def __init__(self, workers=None, max_pending=256, metrics=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.metrics = metrics
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="kdf")
+        self._lock = threading.Lock()
+        self.pending = 0
+
+    def submit(self, fn, *args):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                return None
+            self.pending += 1
+        future = self._executor.submit(self._timed, fn, *args)
+        future.add_done_callback(self._done)
+        return future
+
+    def _timed(self, fn, *args):
+        t0 = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            if self.metrics:
+                self.metrics.observe("chat_kdf_seconds", time.perf_counter() - t0)
+
+    def _done(self, future):
+        with self._lock:
+            self.pending -= 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+# ===================== SESSION =====================
+class SessionTokens:
+    """
+    token (chỉ giữ sha256) -> (username, hết hạn lúc nào (epoch time),
+    phòng cuối cùng phiên đã vào - để resume vào lại cả phòng riêng tư).
+    """
+
+    def __init__(self, ttl=SESSION_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._tokens = {}
+        self._issued = 0
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def issue(self, username):
+        """Cấp token mới; trả về (token, digest, expires) để publish cho worker khác."""
+        token = secrets.token_urlsafe(32)
+        digest = self.digest(token)
+        expires = time.time() + self.ttl
+        self.add(digest, username, expires)
+        return token, digest, expires
+
+    def add(self, digest, username, expires, room=None):
+        with self._lock:
+            self._tokens[digest] = (username, expires, room)
+            self._issued += 1
+            if self._issued % 1000 == 0:
+                self._prune()
+
+    def check(self, token, username):
+        if not isinstance(token, str):
+            return False
+        digest = self.digest(token)
+        with self._lock:
+            item = self._tokens.get(digest)
+            if item is None:
+                return False
+            if item[1] < time.time():
+                del self._tokens[digest]
+                return False
+            return item[0] == username
+
+    def set_room(self, digest, room):
+        """Ghi phòng phiên vừa vào; trả về bản ghi mới (để publish) hoặc None."""
+        with self._lock:
+            item = self._tokens.get(digest)
+            if item is None or item[2] == room:
+                return None
+            item = self._tokens[digest] = (item[0], item[1], room)
+            return item
+
+    def room_of(self, digest):
+        with self._lock:
+            item = self._tokens.get(digest)
+            return item[2] if item else None
+
+    def export(self):
+        with self._lock:
+            self._prune()
+            return {d: list(v) for d, v in self._tokens.items()}
+
+    def load(self, tokens):
+        with self._lock:
+            self._tokens = {d: (v[0], v[1], v[2] if len(v) > 2 else None)
+                            for d, v in tokens.items()}
+            self._prune()
+
+    def _prune(self):
+        now = time.time()
+        for d in [d for d, item in self._tokens.items() if item[1] < now]:
+            del self._tokens[d]
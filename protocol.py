@@ -0,0 +1,299 @@
+"""
+Mã hóa / giải mã gói tin giữa client và server.
+
+Hai phiên bản giao thức, thỏa thuận trong gói auth:
+    "ndjson" - mỗi gói là một dòng JSON (mặc định, client cũ)
+    "frame1" - mỗi gói là một frame:
+                   4 byte độ dài header | 4 byte độ dài body (big-endian)
+                   header JSON (utf-8) | body nhị phân
+
+Client gửi auth (luôn là một dòng JSON) kèm "protocols": [...] theo thứ tự
+ưu tiên; server chọn giao thức đầu tiên nó hỗ trợ và báo lại trong auth_ok
+(cũng là một dòng JSON). Mọi gói sau auth_ok dùng giao thức đã chọn.
+
+File đính kèm (ảnh) nằm ở khóa "data" dưới dạng bytes. Với frame1, bytes
+đi nguyên trong body; với ndjson, bytes được base64 thành chuỗi.
+
+Tương tự, client gửi "features": [...] để bật các tính năng tùy chọn;
+auth_ok trả về danh sách server chấp nhận:
+    "blob" - ảnh chỉ được gửi dạng tham chiếu {"blob": sha256}, client tự
+             lấy nội dung bằng fetch_blob khi cần xem
+    "presence" - thay cho user_list / room_list đầy đủ: một snapshot
+             "presence" rồi các "presence_delta" có seq tăng dần
+    "directory" - không nhận danh sách phòng tự động; client xem từng
+             trang bằng list_rooms và nhận room_page khi trang đó đổi
+
+Nén: client gửi "compression": ["deflate"]; nếu giao thức đã chọn là ndjson
+server trả "compression": "deflate" trong auth_ok. Mọi byte sau auth_ok (cả
+hai chiều) là một luồng raw deflate (RFC 1951) dùng chung từ điển cho cả
+kết nối; mỗi gói kết thúc bằng Z_SYNC_FLUSH nên bên nhận giải được trọn gói
+ngay khi nhận, không phải chờ gói sau. frame1 không nén (body là ảnh đã nén).
+"""
+import base64
+import json
+import struct
+import time
+import zlib
+
+NDJSON = "ndjson"
+FRAMED = "frame1"
+PROTOCOLS = (FRAMED, NDJSON)  # thứ tự ưu tiên của server
+
+FEATURES = ("blob", "presence", "directory")
+
+DEFLATE = "deflate"
+COMPRESSIONS = (DEFLATE,)
+DEFLATE_LEVEL = 6
+# cửa sổ 2^15: mỗi kết nối tốn ~256KB cho bên nén, ~40KB cho bên giải nén
+DEFLATE_WBITS = 15
+INFLATE_CHUNK = 256 * 1024  # giải nén từng phần, giới hạn RAM khi gặp "zip bomb"
+
+ATTACHMENT_KEY = "data"
+
+UPLOAD_CHUNK_SIZE = 64 * 1024  # kích thước chunk khi upload file
+
+_FRAME_HEAD = struct.Struct(">II")
+MAX_HEADER_SIZE = 1024 * 1024
+MAX_BODY_SIZE = 32 * 1024 * 1024
+MAX_LINE_SIZE = MAX_BODY_SIZE * 4 // 3 + MAX_HEADER_SIZE
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def choose_protocol(offered):
+    """Giao thức server dùng cho danh sách client đề nghị (None = client cũ)."""
+    for proto in offered or ():
+        if proto in PROTOCOLS:
+            return proto
+    return NDJSON
+
+
+def choose_features(offered):
+    return [f for f in offered or () if f in FEATURES]
+
+
+def choose_compression(offered, proto):
+    """Cách nén cho kết nối (None = không nén); chỉ nén ndjson."""
+    if proto != NDJSON:
+        return None
+    for name in offered or ():
+        if name in COMPRESSIONS:
+            return name
+    return None
+
+
+def attachment_parts(data: dict, size, proto=NDJSON):
+    """
+    (prefix, suffix) bao quanh nội dung file khi gửi file theo luồng:
+    frame1 -> header frame, body là bytes thô (size byte);
+    ndjson -> '{..., "data": "' + base64 + '"}\n'.
+    """
+    header = json.dumps(data).encode("utf-8")
+    if proto == FRAMED:
+        return _FRAME_HEAD.pack(len(header), size) + header, b""
+    return header[:-1] + b', "' + ATTACHMENT_KEY.encode() + b'": "', b'"}\n'
+
+
+def encode_packet(data: dict, proto=NDJSON) -> bytes:
+    body = data.get(ATTACHMENT_KEY)
+    has_body = isinstance(body, (bytes, bytearray, memoryview))
+
+    if proto == FRAMED:
+        if has_body:
+            data = {k: v for k, v in data.items() if k != ATTACHMENT_KEY}
+        else:
+            body = b""
+        header = json.dumps(data).encode("utf-8")
+        return b"".join((_FRAME_HEAD.pack(len(header), len(body)), header, body))
+
+    if has_body:
+        data = dict(data)
+        data[ATTACHMENT_KEY] = base64.b64encode(body).decode("ascii")
+    return (json.dumps(data) + "\n").encode("utf-8")
+
+
+class EncodedPacket:
+    """
+    Gói gửi cho nhiều client: mỗi giao thức chỉ encode một lần, mọi người
+    nhận dùng chung một memoryview trên cùng bytes (không copy).
+    """
+
+    __slots__ = ("data", "_views")
+
+    def __init__(self, data: dict):
+        self.data = data
+        self._views = {}
+
+    def get(self, proto=NDJSON):
+        view = self._views.get(proto)
+        if view is None:
+            view = self._views[proto] = memoryview(encode_packet(self.data, proto))
+        return view
+
+
+class LineDecoder:
+    """Tách luồng byte thành các gói NDJSON. Dòng JSON lỗi bị bỏ qua."""
+
+    protocol = NDJSON
+
+    def __init__(self, initial=b"", max_line=MAX_LINE_SIZE):
+        self.buffer = bytearray(initial)
+        self.max_line = max_line
+        self._scan = 0  # vị trí đã tìm "\n" tới, tránh quét lại dòng dài
+
+    def feed(self, data):
+        self.buffer += data
+
+    def next_packet(self):
+        while True:
+            idx = self.buffer.find(b"\n", self._scan)
+            if idx < 0:
+                self._scan = len(self.buffer)
+                if self._scan > self.max_line:
+                    raise ProtocolError(f"dòng quá dài: {self._scan} byte")
+                return None
+            line = bytes(self.buffer[:idx]).strip()
+            del self.buffer[:idx + 1]
+            self._scan = 0
+            if not line:
+                continue
+            try:
+                return json.loads(line.decode("utf-8"))
+            except ValueError:
+                continue
+
+
+class FrameDecoder:
+    """Tách luồng byte thành các frame; body (nếu có) nằm ở khóa "data"."""
+
+    protocol = FRAMED
+
+    def __init__(self, initial=b""):
+        self.buffer = bytearray(initial)
+
+    def feed(self, data):
+        self.buffer += data
+
+    def next_packet(self):
+        if len(self.buffer) < _FRAME_HEAD.size:
+            return None
+        hlen, blen = _FRAME_HEAD.unpack_from(self.buffer)
+        if hlen > MAX_HEADER_SIZE or blen > MAX_BODY_SIZE:
+            raise ProtocolError(f"frame quá lớn: header={hlen} body={blen}")
+        end = _FRAME_HEAD.size + hlen + blen
+        if len(self.buffer) < end:
+            return None
+        try:
+            data = json.loads(bytes(self.buffer[_FRAME_HEAD.size:_FRAME_HEAD.size + hlen]))
+        except ValueError:
+            raise ProtocolError("header frame không hợp lệ")
+        if not isinstance(data, dict):
+            raise ProtocolError("header frame không hợp lệ")
+        if blen:
+            data[ATTACHMENT_KEY] = bytes(self.buffer[_FRAME_HEAD.size + hlen:end])
+        del self.buffer[:end]
+        return data
+
+
+class Deflater:
+    """
+    Chiều gửi của một kết nối "deflate": một compressobj cho cả đời kết nối,
+    các gói sau dùng lại từ điển của gói trước. Gói lớn (file base64 gửi
+    theo khối) thì compress() từng khối rồi flush() một lần ở cuối gói.
+
+    Không thread-safe: chỉ thread writer / event loop của kết nối gọi, đúng
+    thứ tự gửi. metrics (nếu có): byte trước / sau nén và CPU mỗi gói;
+    raw_bytes / wire_bytes / seconds / packets: tổng của kết nối.
+    """
+
+    def __init__(self, level=DEFLATE_LEVEL, metrics=None):
+        self._z = zlib.compressobj(level, zlib.DEFLATED, -DEFLATE_WBITS)
+        self.metrics = metrics
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.seconds = 0.0
+        self.packets = 0
+        self._packet = [0, 0, 0.0]  # raw, wire, giây của gói đang nén
+
+    def compress(self, data):
+        t0 = time.perf_counter()
+        out = self._z.compress(data)
+        self._account(len(data), len(out), time.perf_counter() - t0)
+        return out
+
+    def flush(self):
+        """Kết thúc gói: Z_SYNC_FLUSH, trả về phần nén còn lại."""
+        t0 = time.perf_counter()
+        out = self._z.flush(zlib.Z_SYNC_FLUSH)
+        self._account(0, len(out), time.perf_counter() - t0)
+        raw, wire, seconds = self._packet
+        self._packet = [0, 0, 0.0]
+        self.packets += 1
+        if self.metrics:
+            self.metrics.inc("chat_deflate_raw_bytes_total", raw)
+            self.metrics.inc("chat_deflate_wire_bytes_total", wire)
+            self.metrics.observe("chat_deflate_seconds", seconds)
+        return out
+
+    def packet(self, data):
+        """Nén trọn một gói."""
+        return self.compress(data) + self.flush()
+
+    def _account(self, raw, wire, seconds):
+        self.raw_bytes += raw
+        self.wire_bytes += wire
+        self.seconds += seconds
+        self._packet[0] += raw
+        self._packet[1] += wire
+        self._packet[2] += seconds
+
+
+class InflateDecoder:
+    """
+    Chiều nhận của kết nối "deflate": giải nén rồi đưa vào decoder bên trong
+    (LineDecoder). buffer / next_packet như decoder bên trong.
+    wire_bytes / raw_bytes: byte nhận được / sau khi giải nén.
+    """
+
+    def __init__(self, inner, initial=b""):
+        self.inner = inner
+        self.protocol = inner.protocol
+        self.wire_bytes = 0
+        self.raw_bytes = 0
+        self._z = zlib.decompressobj(-DEFLATE_WBITS)
+        self.feed(initial)
+
+    @property
+    def buffer(self):
+        return self.inner.buffer
+
+    def feed(self, data):
+        if not data:
+            return
+        self.wire_bytes += len(data)
+        limit = getattr(self.inner, "max_line", MAX_LINE_SIZE) + INFLATE_CHUNK
+        try:
+            out = self._z.decompress(data, INFLATE_CHUNK)
+            while True:
+                self.raw_bytes += len(out)
+                self.inner.feed(out)
+                if len(self.inner.buffer) > limit:
+                    raise ProtocolError("dữ liệu giải nén quá lớn")
+                if not self._z.unconsumed_tail:
+                    break
+                out = self._z.decompress(self._z.unconsumed_tail, INFLATE_CHUNK)
+        except zlib.error as e:
+            raise ProtocolError(f"luồng deflate lỗi: {e}")
+
+    def next_packet(self):
+        return self.inner.next_packet()
+
+
+def make_decoder(proto, initial=b"", compression=None):
+    if proto == FRAMED:
+        return FrameDecoder(initial)
+    if compression == DEFLATE:
+        return InflateDecoder(LineDecoder(), initial)
+    return LineDecoder(initial)
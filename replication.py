@@ -0,0 +1,178 @@
+"""
+Warm standby cho chat server.
+
+Primary (--replicate-port) mở một cổng TCP riêng cho standby: khi standby
+nối vào, gửi snapshot (phòng, tài khoản, session token, history đang giữ)
+rồi stream mọi thay đổi registry phòng / tài khoản / token / history dạng
+NDJSON, cùng định dạng với bus giữa các worker (cluster.py). Lúc rảnh gửi
+ping mỗi giây.
+
+Standby (--standby-of HOST:PORT) áp dụng stream vào ChatServer của mình
+(history ghi vào file trong thư mục làm việc của standby) và chưa mở cổng
+client. Mất primary (đóng kết nối hoặc quá failover_timeout không nhận gì)
+mà cổng client đã trống thì standby nhận cổng và chạy như server bình
+thường; cổng còn bị giữ (primary chỉ mất kết nối replication) thì nối lại.
+
+    python chat_server.py --headless --replicate-port 6000
+    python chat_server.py --headless --standby-of 127.0.0.1:6000   # thư mục khác
+"""
+import queue
+import socket
+import threading
+import time
+
+from protocol import LineDecoder, ProtocolError, encode_packet
+
+# op của bus được gửi sang standby (tin phòng, PM, presence thì không cần)
+REPLICATED_OPS = {
+    "room_meta", "rename_room", "delete_room", "history", "user",
+    "clear_history", "reset", "session",
+}
+SNAPSHOT_CHUNK = 1000  # số tài khoản / entry history mỗi gói snapshot_users / snapshot_history
+PING_INTERVAL = 1.0
+
+
+# ===================== PRIMARY =====================
+class ReplicationServer:
+    def __init__(self, server, host="127.0.0.1", port=6000):
+        self.server = server
+        self.host = host
+        self.port = port
+        self.sock = None
+        self._lock = threading.Lock()
+        self._standbys = []  # queue.Queue mỗi standby đang nối
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(4)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self._accept_loop, daemon=True, name="replication").start()
+        print(f"REPLICATION: chờ standby ở {self.host}:{self.port}")
+        return self
+
+    def stop(self):
+        try:
+            self.sock.close()
+        except:
+            pass
+        with self._lock:
+            for q in self._standbys:
+                q.put(None)
+            self._standbys = []
+
+    def publish(self, msg):
+        if msg.get("op") not in REPLICATED_OPS:
+            return
+        with self._lock:
+            if not self._standbys:
+                return
+            line = encode_packet(msg)
+            for q in self._standbys:
+                q.put(line)
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn, addr), daemon=True).start()
+
+    def _serve(self, conn, addr):
+        q = queue.Queue()
+        # đăng ký trước rồi mới chụp snapshot: thay đổi xảy ra giữa hai bước
+        # có thể tới standby hai lần nhưng không bị mất
+        with self._lock:
+            self._standbys.append(q)
+        try:
+            for msg in self.server.replication_snapshot():
+                conn.sendall(encode_packet(msg))
+            print(f"REPLICATION: standby {addr[0]}:{addr[1]} đã nối")
+            while True:
+                try:
+                    item = q.get(timeout=PING_INTERVAL)
+                except queue.Empty:
+                    item = encode_packet({"op": "ping", "t": time.time()})
+                if item is None:
+                    break
+                batch = [item]
+                while True:
+                    try:
+                        item = q.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        break
+                    batch.append(item)
+                conn.sendall(b"".join(batch))
+                if item is None:
+                    break
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                if q in self._standbys:
+                    self._standbys.remove(q)
+            conn.close()
+            print(f"REPLICATION: standby {addr[0]}:{addr[1]} ngắt")
+
+
+# ===================== STANDBY =====================
+class StandbyClient:
+    def __init__(self, server, host, port, failover_timeout=3.0):
+        self.server = server
+        self.host = host
+        self.port = port
+        self.failover_timeout = failover_timeout
+
+    def run(self):
+        """Đồng bộ từ primary; trả về khi standby nên nhận cổng client."""
+        print(f"STANDBY: theo dõi primary {self.host}:{self.port}")
+        while True:
+            synced = self._follow()
+            if self._port_free():
+                print("STANDBY: mất primary, nhận cổng client"
+                      + ("" if synced else " (chưa từng đồng bộ)"))
+                return
+            time.sleep(0.2)
+
+    def _follow(self):
+        """Nhận stream tới khi mất kết nối / quá hạn; True nếu đã nhận snapshot."""
+        synced = False
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout=self.failover_timeout)
+        except OSError:
+            return False
+        sock.settimeout(self.failover_timeout)
+        decoder = LineDecoder()
+        try:
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                decoder.feed(chunk)
+                while True:
+                    msg = decoder.next_packet()
+                    if msg is None:
+                        break
+                    if msg.get("op") == "snapshot":
+                        synced = True
+                    self.server.apply_replication(msg)
+        except (OSError, ProtocolError):
+            pass
+        finally:
+            sock.close()
+        return synced
+
+    def _port_free(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            s.bind((self.server.host, self.server.port))
+            return True
+        except OSError:
+            return False
+        finally:
+            s.close()
@@ -0,0 +1,170 @@
+import queue
+import threading
+import traceback
+import zlib
+
+
+class RoomShards:
+    """
+    Chia phòng vào n shard theo crc32(tên phòng). Mỗi shard là một thread
+    worker với hàng đợi riêng (mailbox): mọi thao tác của một phòng (join,
+    tin nhắn, ghi history) chạy tuần tự đúng thứ tự gửi vào, các phòng ở
+    shard khác chạy song song, không cần lock chung.
+
+    n=0: chạy ngay trên thread gọi (mode asyncio - mọi thứ đã tuần tự trên
+    event loop).
+
+    Phòng đổi tên vẫn ở shard cũ (pin): việc đã xếp hàng theo tên cũ và việc
+    mới theo tên mới nằm chung một mailbox nên giữ đúng thứ tự. Tên mới được
+    giữ chỗ dưới lock (rename trả False nếu tên đã bị giữ) vì hai phòng ở hai
+    shard khác nhau có thể cùng đổi sang một tên.
+    """
+
+    def __init__(self, n=4):
+        self.n = n
+        self._queues = [queue.Queue() for _ in range(n)]
+        self._local = threading.local()  # shard của thread hiện tại
+        self._pinned = {}  # tên phòng sau khi đổi tên -> shard của tên cũ
+        self._reserved = set()  # tên đang được giữ bởi phòng đã đổi tên
+        self._rename_lock = threading.Lock()
+        for i, q in enumerate(self._queues):
+            threading.Thread(target=self._run, args=(i, q), daemon=True,
+                             name=f"room-shard-{i}").start()
+
+    def shard_of(self, room):
+        if not self.n:
+            return None
+        shard = self._pinned.get(room)
+        if shard is None:
+            shard = zlib.crc32(str(room).encode("utf-8")) % self.n
+        return shard
+
+    def current(self):
+        """Shard của thread đang chạy, None nếu không phải thread worker."""
+        return getattr(self._local, "shard", None)
+
+    def rename(self, room, new_name):
+        """
+        Giữ chỗ new_name cho room và ghim nó vào shard của room; gọi trong
+        shard đó trước khi phòng mang tên mới. Trả False (không đổi gì) nếu
+        new_name đang được giữ bởi một lần đổi tên khác.
+        """
+        with self._rename_lock:
+            if new_name in self._reserved:
+                return False
+            self._reserved.discard(room)
+            self._reserved.add(new_name)
+            if self.n:
+                self._pinned[new_name] = self.shard_of(room)
+        return True
+
+    def release(self, name):
+        """Bỏ giữ chỗ tên (phòng đã bị xóa)."""
+        with self._rename_lock:
+            self._reserved.discard(name)
+
+    def submit(self, room, fn, *args):
+        """Xếp fn(*args) vào mailbox của phòng, không chờ."""
+        if not self.n:
+            fn(*args)
+            return
+        self._queues[self.shard_of(room)].put((fn, args, None))
+
+    def call(self, room, fn, *args):
+        """
+        Chạy fn(*args) trong shard của phòng và chờ kết quả. Gọi từ chính
+        worker của shard đó thì chạy luôn tại chỗ. Gọi từ worker của shard
+        khác là lỗi (RuntimeError): chờ shard khác có thể deadlock (hai shard
+        chờ nhau), việc không cần kết quả thì dùng submit.
+        """
+        if not self.n:
+            return fn(*args)
+        shard = self.shard_of(room)
+        current = self.current()
+        if current == shard:
+            return fn(*args)
+        if current is not None:
+            raise RuntimeError(f"call phòng {room!r} (shard {shard}) từ shard {current}; dùng submit")
+        done = {"event": threading.Event()}
+        self._queues[shard].put((fn, args, done))
+        done["event"].wait()
+        if "error" in done:
+            raise done["error"]
+        return done.get("result")
+
+    def backlog(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def close(self):
+        """Dừng các thread worker sau khi làm hết việc đã xếp hàng."""
+        for q in self._queues:
+            q.put(None)
+
+    def _run(self, index, q):
+        self._local.shard = index
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            fn, args, done = item
+            try:
+                result = fn(*args)
+                if done is not None:
+                    done["result"] = result
+            except Exception as e:
+                if done is not None:
+                    done["error"] = e
+                else:
+                    traceback.print_exc()
+            finally:
+                if done is not None:
+                    done["event"].set()
+
+
+class RoomRegistry:
+    """
+    Registry phòng chia theo shard: mỗi phòng nằm trong dict của shard sở
+    hữu nó (RoomShards.shard_of) và chỉ thread của shard đó được thêm / xóa
+    phòng; ghi từ shard khác là lỗi (RuntimeError). Thread không phải worker
+    (khởi động, standby) vẫn ghi được. Tra cứu / duyệt đọc được từ mọi thread.
+    """
+
+    def __init__(self, shards):
+        self.shards = shards
+        self._parts = [{} for _ in range(max(shards.n, 1))]
+
+    def _part(self, name, write=False):
+        shard = self.shards.shard_of(name)
+        if write:
+            current = self.shards.current()
+            if current is not None and current != shard:
+                raise RuntimeError(f"phòng {name!r} thuộc shard {shard}, ghi từ shard {current}")
+        return self._parts[shard or 0]
+
+    def __contains__(self, name):
+        return name in self._part(name)
+
+    def __getitem__(self, name):
+        return self._part(name)[name]
+
+    def get(self, name, default=None):
+        return self._part(name).get(name, default)
+
+    def __setitem__(self, name, room):
+        self._part(name, write=True)[name] = room
+
+    def pop(self, name, *default):
+        return self._part(name, write=True).pop(name, *default)
+
+    def __delitem__(self, name):
+        del self._part(name, write=True)[name]
+
+    def __len__(self):
+        return sum(len(p) for p in self._parts)
+
+    def __iter__(self):
+        for p in self._parts:
+            yield from list(p)
+
+    def items(self):
+        return [item for p in self._parts for item in list(p.items())]
@@ -0,0 +1,250 @@
+"""
+Widget Tk giả cho test ClientGUI không cần màn hình: FakeText giữ nội dung
+từng ký tự kèm tag, mark (có gravity) và window nhúng, đủ để kiểm tra phần
+đếm dòng / cắt / vẽ lại của khung chat.
+"""
+import sys
+import types
+
+try:
+    import PIL  # noqa: F401
+except ImportError:
+    # client_app import PIL ở đầu module; test nào cần ảnh tự thay
+    # client_app.Image / ImageTk bằng bản giả
+    _pil = types.ModuleType("PIL")
+    _pil.Image = types.SimpleNamespace(open=None)
+    _pil.ImageTk = types.SimpleNamespace(PhotoImage=None)
+    sys.modules["PIL"] = _pil
+
+import client_app  # noqa: E402
+from client_app import ClientGUI, ThumbnailCache, UIQueue  # noqa: E402
+
+
+class FakeWidget:
+    """Label nhúng trong khung chat; đếm số lần bị hủy."""
+
+    def __init__(self, *args, **kwargs):
+        self.kwargs = kwargs
+        self.alive = True
+
+    def destroy(self):
+        self.alive = False
+
+
+class FakeText:
+    def __init__(self):
+        self.chars = []   # [ký tự, set(tag), window hoặc None]
+        self.marks = {}   # tên -> [vị trí, gravity]
+        self.tags = set()
+        self.state = "normal"
+        self.inserts = 0
+
+    # ---------- index ----------
+    def _pos(self, index):
+        if isinstance(index, int):
+            return index
+        if index in ("end", "end-1c"):
+            return len(self.chars)
+        if index == "@0,0":
+            return 0
+        if index.endswith(".first") or index.endswith(".last"):
+            tag, _, which = index.rpartition(".")
+            found = [i for i, c in enumerate(self.chars) if tag in c[1]]
+            return found[0] if which == "first" else found[-1] + 1
+        if index in self.marks:
+            return self.marks[index][0]
+        line, col = (int(x) for x in index.split("."))
+        pos = 0
+        for _ in range(line - 1):
+            nl = next((i for i in range(pos, len(self.chars)) if self.chars[i][0] == "\n"), None)
+            if nl is None:
+                return len(self.chars)
+            pos = nl + 1
+        return min(pos + col, len(self.chars))
+
+    def index(self, index):
+        pos = self._pos(index)
+        line = 1 + sum(1 for c in self.chars[:pos] if c[0] == "\n")
+        last_nl = max((i for i in range(pos) if self.chars[i][0] == "\n"), default=-1)
+        return f"{line}.{pos - last_nl - 1}"
+
+    # ---------- sửa nội dung ----------
+    def _insert_at(self, pos, items):
+        self.chars[pos:pos] = items
+        for m in self.marks.values():
+            if m[0] > pos or (m[0] == pos and m[1] == "right"):
+                m[0] += len(items)
+
+    def insert(self, index, *args):
+        assert self.state == "normal", "chat_text đang bị khóa ghi"
+        self.inserts += 1
+        items = []
+        for i in range(0, len(args), 2):
+            tags = args[i + 1] if i + 1 < len(args) else ()
+            tags = {tags} if isinstance(tags, str) else set(tags)
+            items += [[ch, tags, None] for ch in args[i]]
+        self._insert_at(self._pos(index), items)
+
+    def window_create(self, index, window=None):
+        assert self.state == "normal", "chat_text đang bị khóa ghi"
+        self._insert_at(self._pos(index), [["\x00", set(), window]])
+
+    def delete(self, first, last=None):
+        assert self.state == "normal", "chat_text đang bị khóa ghi"
+        a = self._pos(first)
+        b = self._pos(last) if last is not None else a + 1
+        if b <= a:
+            return
+        del self.chars[a:b]
+        for m in self.marks.values():
+            if m[0] >= b:
+                m[0] -= b - a
+            elif m[0] > a:
+                m[0] = a
+
+    # ---------- mark / tag / view ----------
+    def mark_set(self, name, index):
+        gravity = self.marks.get(name, [0, "right"])[1]
+        self.marks[name] = [self._pos(index), gravity]
+
+    def mark_gravity(self, name, gravity):
+        self.marks[name][1] = gravity
+
+    def mark_unset(self, *names):
+        for n in names:
+            self.marks.pop(n, None)
+
+    def tag_config(self, tag, **kwargs):
+        self.tags.add(tag)
+
+    def tag_bind(self, tag, event, fn):
+        self.tags.add(tag)
+
+    def tag_delete(self, *tags):
+        for t in tags:
+            self.tags.discard(t)
+
+    def tag_ranges(self, tag):
+        found = [i for i, c in enumerate(self.chars) if tag in c[1]]
+        return (found[0], found[-1] + 1) if found else ()
+
+    def yview(self, *args):
+        return (0.0, 1.0)
+
+    def see(self, index):
+        pass
+
+    def config(self, **kwargs):
+        self.state = kwargs.get("state", self.state)
+
+    # ---------- cho test ----------
+    def text(self):
+        return "".join(c[0] for c in self.chars)
+
+    def lines(self):
+        return self.text().count("\n")
+
+    def windows(self):
+        return [c[2] for c in self.chars if c[2] is not None]
+
+
+class FakeListbox:
+    def __init__(self):
+        self.items = []
+
+    def delete(self, first, last=None):
+        if last == "end":
+            del self.items[first:]
+        else:
+            del self.items[first]
+
+    def insert(self, index, item):
+        if index == "end":
+            self.items.append(item)
+        else:
+            self.items.insert(index, item)
+
+    def get(self, first, last=None):
+        return tuple(self.items)
+
+
+class FakeLabel:
+    def __init__(self, text=""):
+        self.text = text
+
+    def cget(self, key):
+        return self.text
+
+    def config(self, **kwargs):
+        self.text = kwargs.get("text", self.text)
+
+
+class FakeRoot:
+    def __init__(self):
+        self.scheduled = []
+
+    def after(self, ms, fn):
+        self.scheduled.append(ms)
+
+
+class FakeClient:
+    def __init__(self):
+        self.history_requests = []
+        self.blob_requests = []
+
+    def request_history(self, room, before_id=None):
+        self.history_requests.append((room, before_id))
+        return True
+
+    def fetch_blob(self, blob_id):
+        self.blob_requests.append(blob_id)
+
+
+def make_gui(max_lines=200, ui_queue_max=client_app.UI_QUEUE_MAX, image_workers=2):
+    """ClientGUI với widget giả, trạng thái như sau __init__ (không mở cửa sổ / đăng nhập)."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    g = object.__new__(ClientGUI)
+    g.root = FakeRoot()
+    g.chat_text = FakeText()
+    g.chat_text.vbar = types.SimpleNamespace(set=lambda first, last: None)
+    g.user_list = FakeListbox()
+    g.room_list = FakeListbox()
+    g.username_label = FakeLabel("me")
+    g.roomname_label = FakeLabel("")
+    g.client = FakeClient()
+    g.current_room = "Phòng chung"
+    g.current_room_creator = None
+    g.current_is_admin = False
+    g._room_total = 0
+    g._blob_marks = {}
+    g._blob_digests = {}
+    g._link_seq = 0
+    g._thumbs = ThumbnailCache()
+    g._image_pool = ThreadPoolExecutor(image_workers, thread_name_prefix="image")
+    g._oldest_id = None
+    g._history_more = False
+    g._history_loading = False
+    g._ui_queue = UIQueue(ui_queue_max)
+    g._scroll_end = False
+    g.max_lines = max_lines
+    g._transcript = []
+    g._lo = g._hi = 0
+    g._rendered_lines = 0
+    g._rematerialize_pending = False
+    g.chat_text.config(state="disabled")
+    return g
+
+
+def drain(g):
+    """Chạy hết hàng đợi UI như pump_ui trên thread Tk."""
+    while len(g._ui_queue):
+        g.run_ui_batch(g._ui_queue.take(client_app.UI_BATCH_MAX))
+
+
+def check_rendered(g):
+    """Số dòng trong chat_text khớp sổ sách; chỉ đoạn [_lo, _hi) được vẽ."""
+    assert g.chat_text.lines() == g._rendered_lines
+    assert sum(e["lines"] for e in g._transcript[g._lo:g._hi]) == g._rendered_lines
+    assert all(e["rendered"] for e in g._transcript[g._lo:g._hi])
+    assert not any(e["rendered"] for e in g._transcript[:g._lo] + g._transcript[g._hi:])
@@ -0,0 +1,70 @@
+import socket
+import threading
+import time
+
+import pytest
+
+import chat_server
+from test_room_shards import names_on_different_shards
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def shard_threads():
+    return {t for t in threading.enumerate() if t.name.startswith("room-shard-")}
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    before = shard_threads()
+    srv = chat_server.ChatServer(host="127.0.0.1", port=free_port(), room_shards=4)
+    srv.own_threads = shard_threads() - before
+    yield srv
+    srv.stop()
+
+
+def wait_running(srv):
+    deadline = time.time() + 5
+    while not srv.running:
+        assert time.time() < deadline, "server không chạy"
+        time.sleep(0.01)
+
+
+def test_mode_changed_after_init_rebuilds_shards(server):
+    assert server.shards.n == 4 and len(server.own_threads) == 4
+    # GUI đổi mode sau khi đã tạo server
+    server.mode = "asyncio"
+    server.start_in_thread()
+    wait_running(server)
+    assert server.shards.n == 0
+    assert "Phòng chung" in server.rooms
+    deadline = time.time() + 5
+    while any(t.is_alive() for t in server.own_threads):
+        assert time.time() < deadline, "thread shard cũ chưa dừng"
+        time.sleep(0.01)
+
+
+def test_concurrent_renames_to_same_name(server):
+    a, b = names_on_different_shards(server.shards)
+    for name in (a, b):
+        server.shards.call(name, server._put_room, name, chat_server.new_room("u"))
+    results = {}
+    go = threading.Event()
+
+    def rename(name):
+        go.wait()
+        results[name] = server.rename_room(name, "same", publish=False)
+
+    for name in (a, b):
+        server.shards.submit(name, rename, name)
+    go.set()
+    server.shards.call(a, lambda: None)
+    server.shards.call(b, lambda: None)
+    assert sorted(results.values()) == [False, True]
+    loser = a if not results[a] else b
+    assert loser in server.rooms and "same" in server.rooms
@@ -0,0 +1,213 @@
+import base64
+import threading
+import time
+import types
+
+import pytest
+
+from fake_tk import FakeWidget, check_rendered, drain, make_gui
+
+import client_app
+from client_app import ThumbnailCache
+
+
+class FakeImage:
+    def __init__(self, raw, size=(240, 240)):
+        self.raw = raw
+        self.width, self.height = size
+
+    def thumbnail(self, size):
+        self.width, self.height = min(self.width, size[0]), min(self.height, size[1])
+
+    def load(self):
+        pass
+
+    def getbands(self):
+        return ("R", "G", "B")
+
+
+@pytest.fixture
+def fake_pil(monkeypatch):
+    """Image.open / PhotoImage giả; ghi lại thread giải mã từng ảnh."""
+    decoded = []
+
+    def open_image(f):
+        raw = f.read()
+        if raw == b"broken":
+            raise OSError("cannot identify image file")
+        decoded.append((raw, threading.current_thread().name))
+        time.sleep(0.05)
+        return FakeImage(raw, (1000, 800))
+
+    monkeypatch.setattr(client_app, "Image", types.SimpleNamespace(open=open_image))
+    monkeypatch.setattr(client_app, "ImageTk", types.SimpleNamespace(
+        PhotoImage=lambda img: ("photo", img.raw)))
+    monkeypatch.setattr(client_app.tk, "Label", FakeWidget)
+    return decoded
+
+
+def wait_until(g, cond, timeout=5):
+    deadline = time.time() + timeout
+    while not cond():
+        assert time.time() < deadline, "hết giờ chờ thread giải mã"
+        drain(g)
+        time.sleep(0.01)
+    drain(g)
+
+
+def image(data, name="a.png"):
+    return {"data": data, "sender": "u", "room": "R", "filename": name}
+
+
+def show(g, *packets):
+    g.run_ui_batch([("call", None, g.show_image, (p,)) for p in packets])
+
+
+def live_windows(g):
+    return [w for w in g.chat_text.windows() if w.alive]
+
+
+# ------------------ cache ------------------
+def test_cache_evicts_least_recently_used_by_bytes():
+    one = 240 * 240 * 3
+    cache = ThumbnailCache(max_bytes=3 * one)
+    for d in "abc":
+        cache.put(d, FakeImage(d))
+    assert cache.get("a") is not None  # a thành mới dùng nhất
+    cache.put("d", FakeImage("d"))
+    assert cache.get("b") is None
+    assert [d for d in "acd" if cache.get(d) is not None] == ["a", "c", "d"]
+    assert cache.size == 3 * one
+
+
+def test_cache_keeps_newest_item_even_if_oversized():
+    cache = ThumbnailCache(max_bytes=100)
+    cache.put("a", FakeImage("a"))
+    cache.put("b", FakeImage("b"))
+    assert len(cache) == 1 and cache.get("b") is not None
+    cache.put("b", FakeImage("b", (10, 10)))
+    assert cache.size == 300
+
+
+# ------------------ giải mã ------------------
+def test_decode_runs_off_tk_thread_behind_placeholder(fake_pil):
+    g = make_gui()
+    show(g, image(base64.b64encode(b"A").decode()), image(b"broken", "bad.png"))
+    # thread Tk chỉ chèn dòng giữ chỗ, chưa giải mã
+    assert "(đang xử lý ảnh...)" in g.chat_text.text()
+    assert not live_windows(g)
+    check_rendered(g)
+    lines = g._rendered_lines
+
+    wait_until(g, lambda: not any(e.get("pending") for e in g._transcript))
+    assert [name.startswith("image") for _, name in fake_pil] == [True]
+    assert len(live_windows(g)) == 1
+    assert "[Lỗi hiển thị ảnh] cannot identify image file" in g.chat_text.text()
+    assert "(đang xử lý ảnh...)" not in g.chat_text.text()
+    # ảnh thay dòng giữ chỗ mà không đổi số dòng đã đếm
+    check_rendered(g)
+    assert g._rendered_lines == lines
+
+
+def test_resent_image_is_decoded_once(fake_pil):
+    g = make_gui()
+    show(g, image(b"A"))
+    wait_until(g, lambda: not g._transcript[-1].get("pending"))
+    show(g, image(base64.b64encode(b"A").decode(), "again.png"))
+    wait_until(g, lambda: not g._transcript[-1].get("pending"))
+    assert len(fake_pil) == 1
+    assert len(live_windows(g)) == 2
+
+
+def test_trimmed_image_is_rerendered_from_cache(fake_pil):
+    g = make_gui(max_lines=60)
+    show(g, image(b"A"))
+    wait_until(g, lambda: not g._transcript[0].get("pending"))
+    label = live_windows(g)[0]
+    for i in range(100):
+        g.post_text(f"line {i}\n")
+    drain(g)
+    assert g._lo > 0 and not label.alive  # bị cắt: Label bị hủy
+    while g._lo:
+        g.on_chat_scroll("0.0", "0.2")
+        drain(g)
+    check_rendered(g)
+    assert len(live_windows(g)) == 1 and len(fake_pil) == 1
+
+    # bị đẩy khỏi cache thì vẽ lại thành dòng báo đã giải phóng
+    g._thumbs = ThumbnailCache()
+    for i in range(100):
+        g.post_text(f"more {i}\n")
+    drain(g)
+    while g._lo:
+        g.on_chat_scroll("0.0", "0.2")
+        drain(g)
+    check_rendered(g)
+    assert "(ảnh đã được giải phóng)" in g.chat_text.text()
+
+
+# ------------------ blob ------------------
+def test_blob_link_fetch_decode_and_cached_reuse(fake_pil):
+    g = make_gui()
+    show(g, {"blob": "B1", "size": 4096, "sender": "u", "room": "R", "filename": "b"})
+    entry = g._transcript[-1]
+    assert "[Xem ảnh - 4 KB]" in g.chat_text.text()
+    g.request_blob("B1", entry["marks"][0], entry["tags"][0], entry)
+    assert g.client.blob_requests == ["B1"]
+
+    g.run_ui_batch([("call", None, g.on_blob, ("B1", b"B"))])
+    wait_until(g, lambda: entry.get("windows"))
+    assert "[Xem ảnh" not in g.chat_text.text()
+    assert not entry["marks"]
+    check_rendered(g)
+
+    # cùng blob gửi lại: vẽ thẳng ảnh từ cache, không tải / giải mã lại
+    show(g, {"blob": "B1", "size": 4096, "sender": "u", "room": "R", "filename": "b2"})
+    assert len(live_windows(g)) == 2
+    assert g.client.blob_requests == ["B1"] and len(fake_pil) == 1
+
+
+def test_late_blob_for_trimmed_link_is_ignored(fake_pil):
+    g = make_gui(max_lines=60)
+    show(g, {"blob": "B2", "sender": "u", "room": "R", "filename": "b"})
+    entry = g._transcript[-1]
+    g.request_blob("B2", entry["marks"][0], entry["tags"][0], entry)
+    for i in range(100):
+        g.post_text(f"line {i}\n")
+    drain(g)
+    assert not entry["rendered"]
+    g.run_ui_batch([("call", None, g.on_blob, ("B2", b"B"))])
+    wait_until(g, lambda: "B2" in g._blob_digests)
+    assert not entry.get("windows") and not live_windows(g)
+    check_rendered(g)
+
+
+def test_blob_decoded_after_link_was_rerendered(fake_pil, capsys):
+    g = make_gui(max_lines=60)
+    show(g, {"blob": "B3", "sender": "u", "room": "R", "filename": "b"})
+    entry = g._transcript[-1]
+    old_mark = entry["marks"][0]
+    g.request_blob("B3", old_mark, entry["tags"][0], entry)
+    for i in range(100):
+        g.post_text(f"line {i}\n")
+    drain(g)
+    assert not entry["rendered"]
+    # cuộn lên trước khi blob về: link được vẽ lại với mark / tag mới
+    while g._lo:
+        g.on_chat_scroll("0.0", "0.2")
+        drain(g)
+    assert entry["rendered"] and entry["marks"] and old_mark not in entry["marks"]
+
+    g.run_ui_batch([("call", None, g.on_blob, ("B3", b"B"))])
+    wait_until(g, lambda: "B3" in g._blob_digests)
+    # mark cũ không còn: bỏ qua, không lỗi (run_ui_batch nuốt lỗi cùng cả lô)
+    assert "UI lỗi" not in capsys.readouterr().out
+    assert not entry.get("windows") and "[Xem ảnh]" in g.chat_text.text()
+    check_rendered(g)
+
+    # bấm link mới: ảnh lấy từ cache, không tải / giải mã lại
+    g.request_blob("B3", entry["marks"][0], entry["tags"][0], entry)
+    drain(g)
+    assert entry.get("windows") and not entry["marks"]
+    assert g.client.blob_requests == ["B3"] and len(fake_pil) == 1
+    check_rendered(g)
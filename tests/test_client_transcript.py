@@ -0,0 +1,142 @@
+from fake_tk import check_rendered, drain, make_gui
+
+import client_app
+
+
+def history(ids, blob_every=10):
+    return [{"id": i, "username": "u" if i % 3 else "me", "message": f"h{i}",
+             "timestamp": "2026-01-01 10:00:00",
+             **({"blob": f"b{i}"} if i % blob_every == 0 else {})} for i in ids]
+
+
+def scroll(g, first, last, times=1):
+    for _ in range(times):
+        g.on_chat_scroll(first, last)
+        drain(g)
+
+
+def test_history_with_blob_links_counts_lines():
+    g = make_gui()
+    g.run_ui_batch([("call", None, g.show_history, ("R", history(range(100, 150)), True))])
+    check_rendered(g)
+    assert (g._lo, g._hi) == (0, 50)
+    # 5 entry có link "[Xem ảnh]": mỗi link một mark + một tag
+    assert len(g.chat_text.marks) == 5 and len(g.chat_text.tags) == 5
+
+
+def test_live_traffic_keeps_window_under_max_lines_and_releases_links():
+    g = make_gui(max_lines=200)
+    g.run_ui_batch([("call", None, g.show_history, ("R", history(range(100, 150)), True))])
+    for i in range(3000):
+        g.post_text(f"[t] u: m{i}\n", "other")
+    drain(g)
+    check_rendered(g)
+    assert g._rendered_lines <= 200
+    assert g._hi == len(g._transcript) == 3050
+    assert g.chat_text.text().endswith("m2999\n")
+    # entry đầu khung chat là entry đầu tiên còn được vẽ
+    assert g.chat_text.text().startswith(g._transcript[g._lo]["text"])
+    # link của history đã bị cắt: không còn mark / tag nào trong widget
+    assert not g.chat_text.marks and not g.chat_text.tags
+
+
+def test_scroll_up_rematerializes_then_new_message_jumps_to_tail():
+    g = make_gui(max_lines=200)
+    for i in range(1000):
+        g.post_text(f"m{i}\n")
+    drain(g)
+    lo = g._lo
+    scroll(g, "0.0", "0.2", times=3)
+    check_rendered(g)
+    assert g._lo == lo - 3 * client_app.TRANSCRIPT_PAGE
+    assert g._hi < len(g._transcript)  # cuối khung chat bị cắt để giữ max_lines
+    assert g.chat_text.text().startswith(f"m{g._lo}\n")
+
+    g.run_ui_batch([("text", None, None, ("tail\n", "other", None))])
+    check_rendered(g)
+    assert g._hi == len(g._transcript)
+    assert g.chat_text.text().endswith("m999\ntail\n")
+
+
+def test_scroll_down_returns_to_tail():
+    g = make_gui(max_lines=200)
+    for i in range(1000):
+        g.post_text(f"m{i}\n")
+    drain(g)
+    scroll(g, "0.0", "0.2", times=5)
+    for _ in range(20):
+        if g._hi == len(g._transcript):
+            break
+        scroll(g, "0.9", "1.0")
+        check_rendered(g)
+    assert g._hi == len(g._transcript)
+    assert g.chat_text.text().endswith("m999\n")
+
+
+def test_top_of_model_pages_from_server():
+    g = make_gui(max_lines=200)
+    g.run_ui_batch([("call", None, g.show_history, ("R", history(range(100, 150)), True))])
+    for i in range(500):
+        g.post_text(f"m{i}\n")
+    drain(g)
+    for _ in range(20):
+        if g._lo == 0:
+            break
+        scroll(g, "0.0", "0.2")
+    assert g._lo == 0 and not g.client.history_requests
+    scroll(g, "0.0", "0.2")
+    assert g.client.history_requests == [("R", 100)]
+
+    older = history(range(50, 100), blob_every=1000)
+    g.run_ui_batch([("call", None, g.prepend_history, ("R", older, 100, True))])
+    check_rendered(g)
+    assert g._oldest_id == 50 and g._lo == 0
+    assert g.chat_text.text().startswith("[10:00:00] (R) u: h50\n")
+
+
+def test_model_cap_drops_oldest_and_reenables_server_paging(monkeypatch):
+    monkeypatch.setattr(client_app, "TRANSCRIPT_MODEL_MAX", 1000)
+    g = make_gui(max_lines=200)
+    g.run_ui_batch([("call", None, g.show_history, ("R", history(range(100, 150)), False))])
+    assert not g._history_more
+    for _ in range(3):
+        g.run_ui_batch([("text", None, None, ("x\n", "other", None))] * 500)
+    check_rendered(g)
+    assert len(g._transcript) == 1000
+    assert all(e["kind"] == "text" for e in g._transcript)
+    # tin history đầu tiên đã bị bỏ khỏi model: cuộn lên lại tải từ server
+    assert g._oldest_id == 150 and g._history_more
+    scroll(g, "0.0", "0.2", times=20)
+    assert g.client.history_requests == [("R", 150)]
+
+
+def test_model_cap_dropping_live_messages_reloads_them_on_scroll_up(monkeypatch):
+    monkeypatch.setattr(client_app, "TRANSCRIPT_MODEL_MAX", 1000)
+    g = make_gui(max_lines=200)
+    g.run_ui_batch([("call", None, g.show_history, ("R", history(range(100, 150)), False))])
+    # tin chat mới đi qua ChatClient: server gửi kèm id history
+    chat = client_app.ChatClient()
+    chat.username = "me"
+    chat.message_callback = g.post_text
+    for i in range(150, 1650):
+        chat.handle_packet({"type": "chat", "sender": "u", "room": "R", "message": f"h{i}",
+                            "timestamp": "10:00:00", "seq": i, "id": i})
+        if i % 500 == 149:
+            drain(g)
+    drain(g)
+    check_rendered(g)
+    assert len(g._transcript) == 1000
+    assert g._entry_id(g._transcript[0]) == 650
+    # h150..h649 đã bị bỏ khỏi model: trang server tiếp theo bắt đầu từ đó
+    assert g._oldest_id == 650 and g._history_more
+    scroll(g, "0.0", "0.2", times=20)
+    assert g._lo == 0
+    assert g.client.history_requests == [("R", 650)]
+
+    g.run_ui_batch([("call", None, g.prepend_history, ("R", history(range(600, 650)), 650, True))])
+    check_rendered(g)
+    text = g.chat_text.text()
+    assert text.startswith("[10:00:00] (R) Bạn: h600\n")
+    # trang tải lại nối liền phần còn giữ, không hụt tin nào
+    assert "(R) u: h649\n[10:00:00] (R) u: h650\n" in text
+    assert g._oldest_id == 600
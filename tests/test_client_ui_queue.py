@@ -0,0 +1,72 @@
+import threading
+import time
+
+from fake_tk import drain, make_gui
+
+from client_app import UIQueue
+
+
+def test_text_lines_merge_and_last_full_refresh_wins():
+    g = make_gui()
+    update_users = g.ui_call(g.update_user_list, "users", full=True)
+    user_delta = g.ui_call(g.apply_user_delta, "users")
+
+    def network():
+        for i in range(30):
+            g.post_text(f"line {i}\n", "other")
+            if i % 6 == 0:
+                update_users([f"u{i}", "x"])
+        user_delta(["late"], ["x"])
+        g.post_text("end\n", "self")
+
+    t = threading.Thread(target=network)
+    t.start()
+    t.join()
+    g.pump_ui()
+
+    assert len(g._ui_queue) == 0
+    # bản đầy đủ bị thay thế bị bỏ qua nên không tách dòng chữ: chỉ còn 3
+    # đoạn (trước u24, giữa u24 và delta, sau delta), mỗi đoạn một insert
+    assert g.chat_text.inserts == 3
+    assert g.chat_text.lines() == 31
+    assert g.chat_text.text().endswith("line 29\nend\n")
+    # chỉ bản đầy đủ cuối cùng (u24) được vẽ, rồi delta sau nó
+    assert g.user_list.items == ["u24", "late"]
+    assert g.chat_text.state == "disabled"
+
+
+def test_pump_runs_at_most_one_batch():
+    g = make_gui()
+    for i in range(1200):
+        g.post_text(f"{i}\n")
+    g.pump_ui()
+    assert len(g._ui_queue) == 700
+    assert g.root.scheduled[-1] == 1  # còn việc: chạy lại ngay
+    drain(g)
+    g.pump_ui()
+    assert g.root.scheduled[-1] > 1
+
+
+def test_producer_blocks_when_full_but_tk_thread_never_does():
+    q = UIQueue(max_size=50)
+    done = threading.Event()
+
+    def flood():
+        for i in range(200):
+            q.put(i)
+        done.set()
+
+    threading.Thread(target=flood, daemon=True).start()
+    time.sleep(0.2)
+    assert len(q) == 50 and not done.is_set()
+
+    got = []
+    deadline = time.time() + 5
+    while (not done.is_set() or len(q)) and time.time() < deadline:
+        got += q.take(10)
+    assert got == list(range(200))
+
+    # thread tạo hàng đợi (thread Tk) không chờ kể cả khi đã đầy
+    for i in range(80):
+        q.put(i)
+    assert len(q) == 80
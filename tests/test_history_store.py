@@ -0,0 +1,28 @@
+import os
+import time
+
+from history_store import SQLiteHistory
+
+
+def open_fds():
+    return len(os.listdir("/proc/self/fd"))
+
+
+def test_entries_closes_its_connection(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    store = SQLiteHistory(flush_interval=0.01)
+    try:
+        for i in range(10):
+            store.append({"room": "r", "username": "u", "message": str(i)})
+        time.sleep(0.2)
+        assert [e["message"] for e in store.entries()] == [str(i) for i in range(10)]
+        before = open_fds()
+        for _ in range(50):
+            list(store.entries())
+            # standby ngắt giữa snapshot: generator bị đóng giữa chừng
+            partial = store.entries()
+            next(partial)
+            partial.close()
+        assert open_fds() == before
+    finally:
+        store.close()
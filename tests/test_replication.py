@@ -0,0 +1,97 @@
+"""
+Hai process: cụm 2 worker có cổng replication và một standby. Sau khi
+cụm chết và standby nhận cổng, id của từng tin (cursor before_id của
+get_history) phải giống hệt trước failover, kể cả tin do worker phụ nhận.
+"""
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import bench
+
+BOTS = [f"bot{i}" for i in range(8)]
+
+
+def spawn(workdir, args):
+    return subprocess.Popen(
+        [sys.executable, os.path.join(bench.HERE, "chat_server.py"), "--headless",
+         "--host", "127.0.0.1", *args],
+        cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        start_new_session=True)
+
+
+def wait_port(port, timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise AssertionError(f"cổng {port} không mở")
+
+
+async def history_ids(port, before_id=None):
+    """{tin: id} của trang get_history Phòng chung."""
+    reader, writer = await bench.open_bot(port, BOTS[0])
+    req = {"type": "get_history", "room": "Phòng chung", "limit": 200}
+    if before_id is not None:
+        req["before_id"] = before_id
+    writer.write((json.dumps(req) + "\n").encode("utf-8"))
+    while True:
+        p = json.loads(await asyncio.wait_for(reader.readline(), 5))
+        if p.get("type") == "history" and "before_id" in p:
+            writer.close()
+            return {e["message"]: e["id"] for e in p["history"] if e["username"] != "SERVER"}
+
+
+async def chat_from_every_bot(port):
+    bots = [await bench.open_bot(port, name) for name in BOTS]
+    for i, (_, writer) in enumerate(bots):
+        for j in range(5):
+            writer.write((json.dumps({"type": "chat", "message": f"m{i}-{j}"}) + "\n").encode())
+        await writer.drain()
+    await asyncio.sleep(1.0)  # group commit + stream sang standby
+    for _, writer in bots:
+        writer.close()
+
+
+def test_history_ids_survive_cluster_failover(tmp_path):
+    primary_dir, standby_dir = tmp_path / "primary", tmp_path / "standby"
+    primary_dir.mkdir()
+    standby_dir.mkdir()
+    bench.seed_users(str(primary_dir), BOTS)
+    port, rport = bench.free_port(), bench.free_port()
+
+    cluster = spawn(primary_dir, ["--port", str(port), "--workers", "2",
+                                  "--replicate-port", str(rport)])
+    standby = None
+    try:
+        wait_port(port)
+        wait_port(rport)
+        standby = spawn(standby_dir, ["--port", str(port), "--standby-of", f"127.0.0.1:{rport}"])
+        time.sleep(1.0)  # standby nhận snapshot
+
+        asyncio.run(chat_from_every_bot(port))
+        before = asyncio.run(history_ids(port))
+        assert len(before) == 5 * len(BOTS)
+        cursor = sorted(before.values())[len(before) // 2]
+        older = asyncio.run(history_ids(port, cursor))
+
+        os.killpg(cluster.pid, signal.SIGKILL)
+        cluster.wait()
+        time.sleep(0.5)
+        wait_port(port)
+
+        assert asyncio.run(history_ids(port)) == before
+        assert asyncio.run(history_ids(port, cursor)) == older
+    finally:
+        for proc in (cluster, standby):
+            if proc is not None and proc.poll() is None:
+                os.killpg(proc.pid, signal.SIGKILL)
+                proc.wait()
@@ -0,0 +1,78 @@
+import pytest
+
+from room_shards import RoomRegistry, RoomShards
+
+
+def names_on_different_shards(shards):
+    first = "room-0"
+    for i in range(1, 100):
+        name = f"room-{i}"
+        if shards.shard_of(name) != shards.shard_of(first):
+            return first, name
+    raise AssertionError("mọi tên rơi vào một shard")
+
+
+def test_registry_splits_rooms_by_shard():
+    shards = RoomShards(4)
+    rooms = RoomRegistry(shards)
+    for i in range(20):
+        rooms[f"room-{i}"] = {"i": i}
+    assert len(rooms) == 20
+    assert sorted(rooms) == sorted(f"room-{i}" for i in range(20))
+    assert sum(1 for p in rooms._parts if p) > 1
+    for i, part in enumerate(rooms._parts):
+        assert all(shards.shard_of(name) == i for name in part)
+    assert rooms.get("room-3") == {"i": 3}
+    assert rooms.pop("room-3") == {"i": 3}
+    assert "room-3" not in rooms
+
+
+def test_registry_rejects_write_from_other_shard():
+    shards = RoomShards(4)
+    rooms = RoomRegistry(shards)
+    a, b = names_on_different_shards(shards)
+    shards.call(a, rooms.__setitem__, a, {})
+    with pytest.raises(RuntimeError):
+        shards.call(a, rooms.__setitem__, b, {})
+    assert a in rooms and b not in rooms
+
+
+def test_renamed_room_stays_on_its_shard_in_order():
+    shards = RoomShards(4)
+    old, new = names_on_different_shards(shards)
+    seen = []
+    for i in range(50):
+        shards.submit(old, seen.append, i)
+    # client chỉ biết tên mới sau khi đổi tên xong trong shard của phòng
+    shards.call(old, shards.rename, old, new)
+    for i in range(50, 100):
+        shards.submit(new, seen.append, i)
+    shards.call(new, lambda: None)
+    assert shards.shard_of(new) == shards.shard_of(old)
+    assert seen == list(range(100))
+
+
+def test_call_inline_only_on_own_shard():
+    shards = RoomShards(4)
+    a, b = names_on_different_shards(shards)
+    assert shards.call(a, lambda: shards.call(a, shards.current)) == shards.shard_of(a)
+    with pytest.raises(RuntimeError):
+        shards.call(a, shards.call, b, shards.current)
+    assert shards.call(b, shards.current) == shards.shard_of(b)
+
+
+def test_rename_reserves_new_name_once():
+    shards = RoomShards(4)
+    a, b = names_on_different_shards(shards)
+    assert shards.call(a, shards.rename, a, "same")
+    assert not shards.call(b, shards.rename, b, "same")
+    assert shards.shard_of("same") == shards.shard_of(a)
+    shards.release("same")
+    assert shards.call(b, shards.rename, b, "same")
+
+
+def test_inline_when_unsharded():
+    shards = RoomShards(0)
+    rooms = RoomRegistry(shards)
+    shards.submit("x", rooms.__setitem__, "x", 1)
+    assert rooms["x"] == 1 and shards.shard_of("x") is None
@@ -0,0 +1,24 @@
+from user_store import UserStore
+
+
+def test_two_workers_cannot_register_same_name(tmp_path):
+    path = str(tmp_path / "users.db")
+    primary = UserStore(path, None, persist=True)
+    secondary = UserStore(path, None, persist=False)
+    try:
+        assert secondary.add("bob", {"password": "a", "avatar": None})
+        # primary chưa nhận op "user" qua bus, cache của nó chưa có bob
+        assert "bob" not in primary
+        assert not primary.add("bob", {"password": "b", "avatar": None})
+        assert "bob" not in primary
+
+        assert primary.add("carol", {"password": "c", "avatar": None})
+        assert not secondary.add("carol", {"password": "d", "avatar": None})
+
+        reopened = UserStore(path, None, persist=True)
+        assert reopened.get("bob")["password"] == "a"
+        assert reopened.get("carol")["password"] == "c"
+        reopened.close()
+    finally:
+        primary.close()
+        secondary.close()
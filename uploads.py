@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import re
+import time
+import zlib
+
+from protocol import UPLOAD_CHUNK_SIZE as CHUNK_SIZE
+
+MAX_CHUNK_SIZE = 256 * 1024     # server từ chối chunk lớn hơn
+DEFAULT_MAX_UPLOAD = 20 * 1024 * 1024
+
+_UPLOAD_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+class UploadError(Exception):
+    """offset là số byte server đang giữ để client gửi tiếp từ đó."""
+
+    def __init__(self, message, offset=0):
+        super().__init__(message)
+        self.message = message
+        self.offset = offset
+
+
+def file_digest(path, block=CHUNK_SIZE):
+    """sha256 của file, đọc từng khối để không nạp cả file vào RAM."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            b = f.read(block)
+            if not b:
+                break
+            h.update(b)
+    return h.hexdigest()
+
+
+class UploadManager:
+    """
+    Nhận file theo từng chunk: init -> chunk... -> commit.
+
+    Mỗi upload được ghi thẳng xuống đĩa (<dir>/<hash user>_<id>.part) kèm file
+    .meta, nên RAM server không phụ thuộc kích thước file, và client có thể
+    gửi tiếp sau khi kết nối lại (kể cả khi server khởi động lại): init với
+    cùng upload_id sẽ trả về offset đã nhận.
+    """
+
+    def __init__(self, directory="uploads", max_size=DEFAULT_MAX_UPLOAD,
+                 stale_after=24 * 3600):
+        self.directory = directory
+        self.max_size = max_size
+        self.stale_after = stale_after
+        os.makedirs(directory, exist_ok=True)
+        self.cleanup()
+
+    def _paths(self, username, upload_id):
+        if not isinstance(upload_id, str) or not _UPLOAD_ID.match(upload_id):
+            raise UploadError("upload_id không hợp lệ.")
+        base = os.path.join(self.directory, f"{hashlib.sha1(username.encode()).hexdigest()[:16]}_{upload_id}")
+        return base + ".part", base + ".meta"
+
+    def _load_meta(self, meta_path):
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    # ------------------ API ------------------
+    def init(self, username, upload_id, filename, size, sha256):
+        """
+        Trả về offset client cần gửi tiếp (0 nếu upload mới), hoặc None nếu
+        upload này đã commit xong (client không nhận được upload_done).
+        """
+        part, meta_path = self._paths(username, upload_id)
+        if not isinstance(size, int) or size <= 0:
+            raise UploadError("Kích thước file không hợp lệ.")
+        if size > self.max_size:
+            raise UploadError(f"File quá lớn (tối đa {self.max_size // (1024 * 1024)} MB).")
+        if not isinstance(sha256, str) or len(sha256) != 64:
+            raise UploadError("Checksum không hợp lệ.")
+
+        meta = self._load_meta(meta_path)
+        if meta and meta["size"] == size and meta["sha256"] == sha256:
+            if meta.get("done"):
+                return None
+            if os.path.exists(part):
+                return os.path.getsize(part)
+
+        meta = {
+            "filename": os.path.basename(str(filename or "file")),
+            "size": size,
+            "sha256": sha256,
+            "created": time.time(),
+        }
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        open(part, "wb").close()
+        return 0
+
+    def chunk(self, username, upload_id, offset, data, crc):
+        """Ghi một chunk; trả về offset mới."""
+        part, meta_path = self._paths(username, upload_id)
+        meta = self._load_meta(meta_path)
+        if not meta or not os.path.exists(part):
+            raise UploadError("Upload không tồn tại.")
+        current = os.path.getsize(part)
+        if offset != current:
+            raise UploadError("Sai offset.", current)
+        if len(data) > MAX_CHUNK_SIZE:
+            raise UploadError("Chunk quá lớn.", current)
+        if current + len(data) > meta["size"]:
+            raise UploadError("Vượt quá kích thước đã khai báo.", current)
+        if zlib.crc32(data) != crc:
+            raise UploadError("Sai checksum chunk.", current)
+        with open(part, "ab") as f:
+            f.write(data)
+        return current + len(data)
+
+    def commit(self, username, upload_id):
+        """
+        Kiểm tra kích thước + sha256; trả về (meta, đường dẫn file .part).
+        Đường dẫn là None nếu upload đã commit trước đó (commit gửi lại sau
+        khi mất kết nối). Người gọi xử lý xong thì gọi finish().
+        """
+        part, meta_path = self._paths(username, upload_id)
+        meta = self._load_meta(meta_path)
+        if meta and meta.get("done"):
+            return meta, None
+        if not meta or not os.path.exists(part):
+            raise UploadError("Upload không tồn tại.")
+        current = os.path.getsize(part)
+        if current != meta["size"]:
+            raise UploadError("Upload chưa đủ dữ liệu.", current)
+        if file_digest(part) != meta["sha256"]:
+            open(part, "wb").close()
+            raise UploadError("Sai checksum file, cần gửi lại.", 0)
+        return meta, part
+
+    def finish(self, username, upload_id):
+        """Xóa dữ liệu, chỉ giữ .meta đánh dấu đã xong để commit/init lặp lại không đăng ảnh hai lần."""
+        part, meta_path = self._paths(username, upload_id)
+        meta = self._load_meta(meta_path) or {}
+        meta["done"] = True
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        try:
+            os.remove(part)
+        except OSError:
+            pass
+
+    def discard(self, username, upload_id):
+        for p in self._paths(username, upload_id):
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+    def cleanup(self):
+        """Xóa các upload dở dang quá stale_after giây."""
+        cutoff = time.time() - self.stale_after
+        for name in os.listdir(self.directory):
+            if not name.endswith((".part", ".meta")):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
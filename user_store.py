@@ -0,0 +1,162 @@
+import json
+import os
+import sqlite3
+import threading
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    data     TEXT NOT NULL
+);
+"""
+
+
+class UserStore:
+    """
+    Tài khoản trong SQLite (WAL), bảng users(username PRIMARY KEY, data JSON).
+
+    Mọi tài khoản được nạp vào dict trong bộ nhớ lúc khởi động nên đọc
+    (đăng nhập, kiểm tra trùng tên) không chạm đĩa. Mỗi lần đăng ký / sửa
+    tài khoản chỉ ghi một dòng trong một transaction (không viết lại cả
+    file như users.json), ghi xong mới trả về.
+
+    Lần đầu chạy, users.json cũ được chép vào DB rồi đổi tên thành
+    users.json.migrated.
+
+    persist=False: chỉ đọc DB lúc khởi động rồi giữ trong bộ nhớ (worker
+    phụ trong cụm nhiều process; worker chính ghi vào cùng file DB). Riêng
+    add() vẫn INSERT vào file DB chung: khóa chính username quyết định ai
+    đăng ký được tên, kể cả khi hai worker nhận cùng một tên cùng lúc.
+    """
+
+    def __init__(self, path="users.db", legacy_path="users.json", persist=True):
+        self.path = path
+        self.persist = persist
+        self._lock = threading.Lock()
+        self._users = {}
+        self._db = None
+
+        db = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        if persist:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(_SCHEMA)
+            if db.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None:
+                self._migrate(db, legacy_path)
+        self._load(db)
+        if not self._users and not persist:
+            # worker phụ khởi động trước khi worker chính chuyển xong users.json
+            self._users = self._load_legacy(legacy_path)
+            if self._users is None:
+                self._users = {}
+                self._load(db)
+        if persist:
+            self._db = db
+        else:
+            db.close()
+
+    # ------------------ API ------------------
+    def __contains__(self, username):
+        return username in self._users
+
+    def __len__(self):
+        return len(self._users)
+
+    def get(self, username):
+        return self._users.get(username)
+
+    def add(self, username, record):
+        """
+        Tạo tài khoản; False nếu tên đã có - trong bộ nhớ, hoặc trong DB do
+        process khác vừa đăng ký (IntegrityError của khóa chính).
+        """
+        with self._lock:
+            if username in self._users:
+                return False
+            try:
+                self._insert(username, record)
+            except sqlite3.IntegrityError:
+                return False
+            self._users[username] = record
+            return True
+
+    def put(self, username, record):
+        """Tạo hoặc thay bản ghi của một tài khoản (vd. mã băm mật khẩu mới)."""
+        self.put_many({username: record})
+
+    def put_many(self, users):
+        with self._lock:
+            self._write(list(users.items()))
+            self._users.update(users)
+
+    def replace(self, users):
+        """Thay toàn bộ tài khoản (standby nhận snapshot)."""
+        with self._lock:
+            if self._db is not None:
+                with self._db:
+                    self._db.execute("DELETE FROM users")
+            self._users = {}
+        self.put_many(users)
+
+    def items(self):
+        """Bản sao (username, record) - duyệt không giữ lock."""
+        return list(self._users.items())
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    # ------------------ INTERNAL ------------------
+    def _insert(self, username, record):
+        """INSERT thường (không REPLACE) để UNIQUE chặn tên trùng giữa các process."""
+        db = self._db
+        if db is None:
+            # worker phụ: mở kết nối ngắn tới file DB chung
+            db = sqlite3.connect(self.path, timeout=10)
+            db.executescript(_SCHEMA)
+        try:
+            with db:
+                db.execute("INSERT INTO users (username, data) VALUES (?, ?)",
+                           (username, json.dumps(record, ensure_ascii=False)))
+        finally:
+            if db is not self._db:
+                db.close()
+
+    def _write(self, rows):
+        if self._db is None or not rows:
+            return
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO users (username, data) VALUES (?, ?)",
+                [(u, json.dumps(r, ensure_ascii=False)) for u, r in rows])
+
+    def _load(self, db):
+        try:
+            for username, data in db.execute("SELECT username, data FROM users"):
+                self._users[username] = json.loads(data)
+        except sqlite3.Error:
+            pass  # bảng chưa được tạo
+
+    @staticmethod
+    def _load_legacy(legacy_path):
+        """Dict tài khoản trong users.json, None nếu không đọc được."""
+        if not legacy_path or not os.path.exists(legacy_path):
+            return None
+        try:
+            with open(legacy_path, "r", encoding="utf-8") as f:
+                users = json.load(f)
+        except:
+            return None
+        return users if isinstance(users, dict) else None
+
+    def _migrate(self, db, legacy_path):
+        users = self._load_legacy(legacy_path)
+        if users is None:
+            return
+        with db:
+            db.executemany("INSERT OR REPLACE INTO users (username, data) VALUES (?, ?)",
+                           [(u, json.dumps(r, ensure_ascii=False)) for u, r in users.items()])
+        os.replace(legacy_path, legacy_path + ".migrated")
+        print(f"USERS: migrated {len(users)} accounts {legacy_path} -> {self.path}")